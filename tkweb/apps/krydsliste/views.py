@@ -8,11 +8,15 @@ from django.template.loader import get_template
 from django.http import HttpResponse, HttpResponseRedirect
 from django.utils import timezone
 from django.shortcuts import redirect
+from constance import config
 from tkweb.apps.krydsliste.models import Sheet
 from tkweb.apps.krydsliste.forms import SheetForm
 from tkweb.apps.regnskab.views.auth import regnskab_permission_required_method
 from tkweb.apps.regnskab.texrender import tex_to_pdf, RenderError
-from tkweb.apps.regnskab.views import BalancePrint
+from tkweb.apps.regnskab.models import (
+    LeaderboardEntry, get_leaderboard, get_profiles_title_status,
+)
+from tkweb.apps.regnskab.views.printing import profile_tex_alias
 
 try:
     from tkweb.apps.uniprint.api import print_new_document
@@ -165,15 +169,17 @@ class SheetCreate(CreateView, PrintMixin):
         return super().dispatch(request, *args, **kwargs)
 
     def get_highscore(self, count=None, limit=None):
-        context = BalancePrint.get_tex_context_data()
-        personer = sorted(
-            context['personer'], key=lambda p: p['total']['betalt'], reverse=True
-        )
+        period = config.GFYEAR
+        paid = {profile_id: totals.get(LeaderboardEntry.PAID, 0)
+                for profile_id, totals in get_leaderboard(period)}
+        personer = [p for p in get_profiles_title_status(period=period)
+                    if p.status and p.status.end_time is None]
+        personer.sort(key=lambda p: paid.get(p.id, 0), reverse=True)
         if count is not None:
             personer = personer[:count]
         if limit is not None:
-            personer = [p for p in personer if p['total']['betalt'] >= limit]
-        names = [p['alias'] for p in personer]
+            personer = [p for p in personer if paid.get(p.id, 0) >= limit]
+        names = [profile_tex_alias(p, period) for p in personer]
         return Sheet.format_persons(names)
 
 
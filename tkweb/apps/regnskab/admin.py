@@ -1,10 +1,13 @@
+from django.db import transaction
 from django.utils import timezone
 from django.contrib import admin
 from django.urls import reverse
 from django.utils.html import format_html
 from tkweb.apps.regnskab.models import (
     Alias, Transaction, Sheet, EmailTemplate, Session,
-    SheetImage, Newsletter,
+    SheetImage, Newsletter, ExtractionJob,
+    transactions_changed, delete_sheet,
+    sheet_row_leaderboard_changes, update_leaderboard,
 )
 
 
@@ -37,6 +40,23 @@ class TransactionAdmin(admin.ModelAdmin):
 
     has_delete_permission = has_change_permission
 
+    # Keep balance snapshots, rollups and the leaderboard in step with
+    # edits made here.
+    def save_model(self, request, obj, form, change):
+        old = [Transaction.objects.get(pk=obj.pk)] if change else []
+        with transaction.atomic():
+            obj.save()
+            transactions_changed(old, [obj])
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, Transaction.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        old = list(queryset)
+        with transaction.atomic():
+            queryset.delete()
+            transactions_changed(old, [])
+
 
 class SheetAdmin(admin.ModelAdmin):
     def has_add_permission(self, request, obj=None):
@@ -49,6 +69,27 @@ class SheetAdmin(admin.ModelAdmin):
 
     has_delete_permission = has_change_permission
 
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.save()
+            return
+        # The leaderboard counts the purchases in the period of the sheet.
+        old = Sheet.objects.get(pk=obj.pk)
+        rows = old.rows(titles=False)
+        with transaction.atomic():
+            obj.save()
+            update_leaderboard(
+                sheet_row_leaderboard_changes(old, rows, []) +
+                sheet_row_leaderboard_changes(obj, [], rows))
+
+    def delete_model(self, request, obj):
+        delete_sheet(obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            for sheet in queryset:
+                delete_sheet(sheet)
+
 
 class EmailTemplateAdmin(admin.ModelAdmin):
     list_display = ('subject', 'created_time')
@@ -83,6 +124,10 @@ class SheetImageAdmin(admin.ModelAdmin):
     pass
 
 
+class ExtractionJobAdmin(admin.ModelAdmin):
+    list_display = ('sheet', 'state', 'created_time', 'end_time')
+
+
 class NewsletterAdmin(admin.ModelAdmin):
     list_display = ('subject', 'send_time', 'period',
                     'created_by')
@@ -106,3 +151,4 @@ admin.site.register(EmailTemplate, EmailTemplateAdmin)
 admin.site.register(Session, SessionAdmin)
 admin.site.register(SheetImage, SheetImageAdmin)
 admin.site.register(Newsletter, NewsletterAdmin)
+admin.site.register(ExtractionJob, ExtractionJobAdmin)
@@ -0,0 +1,77 @@
+'''
+Sending of Email and NewsletterEmail objects.
+
+Messages are built and sent in batches over a single connection to the
+email backend, and each email gets its send_time as soon as the backend
+has accepted it. If sending is interrupted, sending the emails that still
+have send_time=None resumes where it stopped.
+
+The inline images of each batch are loaded in one query, and each image
+is encoded once and shared by all the messages that show it.
+'''
+
+import logging
+from typing import Callable, List, Optional
+
+import django.core.mail
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
+
+from tkweb.apps.regnskab.models import InlineCache
+
+logger = logging.getLogger('regnskab')
+
+
+SEND_BATCH_SIZE = 25
+
+
+def send_emails(emails, override_recipient: Optional[str] = None,
+                prepare: Optional[Callable[[List, List], None]] = None,
+                connection=None, batch_size: int = SEND_BATCH_SIZE) -> int:
+    '''
+    Send the given emails and return the number of messages sent.
+
+    Only one batch of messages is kept in memory at a time.
+    If given, prepare(emails, messages) is called for each batch
+    before sending, e.g. to add attachments.
+    If override_recipient is given, all messages are sent to that address
+    instead, and the emails are not marked as sent.
+    '''
+    emails = list(emails)
+    if not emails:
+        return 0
+    model = type(emails[0])
+    if connection is None:
+        connection = django.core.mail.get_connection()
+    inlines = InlineCache()
+    sent = 0
+    with connection:
+        for i in range(0, len(emails), batch_size):
+            batch = emails[i:i + batch_size]
+            # Compactly stored emails are rendered from their template.
+            prefetch_related_objects(batch, 'email_template')
+            for e in batch:
+                e.render()
+            inlines.load(e.body_html for e in batch)
+            messages = [e.to_message(inlines) for e in batch]
+            if prepare is not None:
+                prepare(batch, messages)
+            if override_recipient:
+                for m in messages:
+                    m.to = [override_recipient]
+            sent_emails = []
+            try:
+                for email, message in zip(batch, messages):
+                    if connection.send_messages([message]):
+                        sent_emails.append(email)
+            finally:
+                sent += len(sent_emails)
+                if sent_emails and not override_recipient:
+                    now = timezone.now()
+                    model.objects.filter(
+                        pk__in=[e.pk for e in sent_emails]).update(
+                            send_time=now)
+                    for e in sent_emails:
+                        e.send_time = now
+            logger.info("Sendt %s af %s emails", sent, len(emails))
+    return sent
@@ -13,6 +13,143 @@ def format_count(c):
     return ('%.2f' % c).rstrip('0').rstrip('.').replace('.', ',')
 
 
+VARIABLE = r'#([A-Z][^#]*)#'
+
+
+def is_zero(value):
+    return value.strip('0,.') == ''
+
+
+def format_regex(template, context):
+    '''
+    Format a template with newlines normalized using regexes.
+    Used by Template for templates that it cannot compile.
+    '''
+    def hide_zero(s):
+        if any(is_zero(context[m.group(1)])
+               for m in re.finditer(VARIABLE, s)):
+            return ''
+        else:
+            return s
+
+    res = re.sub(r'#SKJULNUL:#(.*\n?)',
+                 lambda mo: hide_zero(mo.group(1)), template)
+    res = re.sub(VARIABLE, lambda mo: context[mo.group(1)], res)
+    res = re.sub(r'\n\n+', '\n\n', res)
+    return res
+
+
+class Template:
+    r'''
+    An email template parsed once, so that it can be rendered for many
+    recipients without running any regexes.
+
+    The template is split into segments (hide, parts), where parts is a
+    list of (literal text, variable name or None) and hide is the list
+    of variables on a #SKJULNUL:# line, or None outside such lines.
+    A #SKJULNUL:# segment is left out if any of its variables is zero.
+
+    If `variables` is given, unknown variables raise KeyError here
+    instead of when rendering.
+
+    >>> t = Template('Hi #NAVN#.\n#SKJULNUL:#You owe #GAELD#\nBye')
+    >>> sorted(t.variables)
+    ['GAELD', 'NAVN']
+    >>> t.render(dict(NAVN='Bob', GAELD='0,00'))
+    'Hi Bob.\nBye'
+    >>> Template('#NAVN# #NUMMER#', variables={'NAVN'})
+    Traceback (most recent call last):
+      ...
+    KeyError: 'NUMMER'
+    '''
+
+    def __init__(self, template, variables=None):
+        self.template = re.sub(r'\r\n|\n|\r', '\n', template)
+        self.segments = []
+        self.variables = set()
+        stray = False
+        i = 0
+        for mo in re.finditer(r'#SKJULNUL:#(.*\n?)', self.template):
+            stray |= self._add(self.template[i:mo.start()], hide=False)
+            stray |= self._add(mo.group(1), hide=True)
+            i = mo.end()
+        stray |= self._add(self.template[i:], hide=False)
+        if stray:
+            # A '#' outside a variable may pair up with a '#' in another
+            # segment depending on which lines are hidden.
+            self.segments = None
+        if variables is not None:
+            unknown = self.variables - set(variables)
+            if unknown:
+                raise KeyError(min(unknown))
+
+    def _add(self, text, hide):
+        '''
+        Append a segment and return True if text has a stray '#'.
+        '''
+        parts = []
+        i = 0
+        for mo in re.finditer(VARIABLE, text):
+            parts.append((text[i:mo.start()], mo.group(1)))
+            i = mo.end()
+        parts.append((text[i:], None))
+        names = [n for t, n in parts if n is not None]
+        self.variables.update(names)
+        self.segments.append((names if hide else None, parts))
+        return text.count('#') != 2 * len(names)
+
+    def render(self, context):
+        if self.segments is None:
+            return format_regex(self.template, context)
+        res = []
+        for hide, parts in self.segments:
+            if hide and any(is_zero(context[n]) for n in hide):
+                continue
+            for text, name in parts:
+                res.append(text)
+                if name is not None:
+                    res.append(context[name])
+        res = ''.join(res)
+        if '\n\n\n' in res:
+            res = re.sub(r'\n\n+', '\n\n', res)
+        return res
+
+    def match(self, text):
+        r'''
+        Find the values of the variables in text rendered from this
+        template. Returns None if text does not match the template.
+        Variables that only occur in hidden lines are left out.
+        The caller should check that the result renders to text.
+
+        >>> t = Template('Hi #NAVN#.\n#SKJULNUL:#You owe #GAELD#\nBye')
+        >>> t.match('Hi Bob.\nYou owe 12,00\nBye')
+        {'NAVN': 'Bob', 'GAELD': '12,00'}
+        >>> t.match('Hi Bob.\nBye')
+        {'NAVN': 'Bob'}
+        '''
+        if self.segments is None:
+            return None
+        pattern = []
+        names = []
+        for hide, parts in self.segments:
+            segment = []
+            for literal, name in parts:
+                segment.append(re.escape(literal))
+                if name is not None:
+                    segment.append('(.*?)')
+                    names.append(name)
+            segment = ''.join(segment)
+            pattern.append('(?:%s)?' % segment if hide else segment)
+        mo = re.fullmatch(''.join(pattern), text, re.DOTALL)
+        if mo is None:
+            return None
+        context = {}
+        for name, value in zip(names, mo.groups()):
+            if value is not None and context.setdefault(name, value) != value:
+                return None
+        return context
+
+
 def format(template, context):
     r'''
     >>> format('Hello #TARGET#!', dict(TARGET='world'))
@@ -30,18 +167,4 @@ def format(template, context):
     ...        dict(X='1', Y='0'))
     ''
     '''
-    pattern = r'#([A-Z][^#]*)#'
-    res = re.sub(r'\r\n|\n|\r', '\n', template)
-
-    def hide_zero(s):
-        if any(context[m.group(1)].strip('0,.') == ''
-               for m in re.finditer(pattern, s)):
-            return ''
-        else:
-            return s
-
-    res = re.sub(r'#SKJULNUL:#(.*\n?)',
-                 lambda mo: hide_zero(mo.group(1)), res)
-    res = re.sub(pattern, lambda mo: context[mo.group(1)], res)
-    res = re.sub(r'\n\n+', '\n\n', res)
-    return res
+    return Template(template).render(context)
@@ -191,33 +191,36 @@ class TransactionBatchForm(forms.Form):
 
     def _init(self, profiles):
         self._profiles = []
+        self._display_names = {}
         for profile, amount, selected in profiles:
             p = 'profile%d_' % profile.id
             if profile.title:
-                profile.display_name = (
+                display_name = (
                     '%s %s' %
                     (tk.prefix(profile.title, type='unicode')
                      if profile.title.period else profile.title.root,
                      profile.name))
             else:
-                profile.display_name = profile.name
+                display_name = profile.name
+            self._display_names[profile.id] = display_name
             self.fields[p + 'selected'] = forms.BooleanField(
                 initial=selected,
-                required=False, label='%s markeret' % profile.display_name)
+                required=False, label='%s markeret' % display_name)
             amount_str = '%g' % amount
             try:
                 int(amount_str)
             except ValueError:
                 amount_str = '%.2f' % amount
             self.fields[p + 'amount'] = forms.FloatField(
-                initial=amount_str, label='%s beløb' % profile.display_name,
+                initial=amount_str, label='%s beløb' % display_name,
                 widget=forms.TextInput())
             self._profiles.append(profile)
 
     def profile_fields(self):
         for profile in self._profiles:
             p = 'profile%d_' % profile.id
-            yield (profile, self[p + 'amount'], self[p + 'selected'])
+            yield (profile, self._display_names[profile.id],
+                   self[p + 'amount'], self[p + 'selected'])
 
     def profile_data(self):
         data = self.cleaned_data
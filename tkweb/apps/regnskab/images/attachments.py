@@ -0,0 +1,137 @@
+"""
+The krydser.png attachment of each Email in a Session.
+
+The attachment consists of the crops of the stitched row images of the
+sheets in the session belonging to the recipient. build_row_images()
+decodes each row image once, cuts out the crops of every recipient in
+one pass and stores the PNG in Email.row_image. Email.row_image_key
+records which crops the stored PNG was built from, so only emails whose
+sheet rows have changed are rebuilt. The PNGs are stored when the emails
+are sent; preview_row_image() renders an out of date PNG in memory.
+"""
+
+import json
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import imageio
+from django.core.files.base import ContentFile
+
+from .utils import save_png
+
+
+def row_image_key(crops: List[Tuple[str, int, int]]) -> str:
+    if not crops:
+        return ''
+    return hashlib.sha1(json.dumps(crops).encode()).hexdigest()
+
+
+def stack_crops(images: List[np.ndarray]) -> np.ndarray:
+    image_width = max(image.shape[1] for image in images)
+    for i, image in enumerate(images):
+        if image.shape[1] < image_width:
+            images[i] = np.pad(
+                image,
+                [(0, 0), (0, image_width - image.shape[1])] +
+                [(0, 0)] * (image.ndim - 2),
+                'maximum')
+    return np.concatenate(images)
+
+
+def render_row_images(
+    session, emails
+) -> List[Tuple["Email", str, Optional[bytes]]]:
+    '''
+    Return (email, row_image_key, png_data) for the given emails whose
+    stored Email.row_image is out of date, without saving anything.
+    '''
+    from tkweb.apps.regnskab.models import SheetRow
+
+    emails = [email for email in emails if email.profile_id]
+    assert all(email.session_id == session.id for email in emails)
+    if not emails:
+        return []
+
+    rows = SheetRow.objects.filter(
+        sheet__session=session,
+        profile_id__in=[email.profile_id for email in emails],
+        image_start__isnull=False, image_stop__isnull=False)
+    rows = rows.exclude(sheet__row_image=None).exclude(sheet__row_image='')
+    rows = rows.select_related('sheet')
+    rows = rows.order_by('sheet__start_date', 'sheet_id', 'position')
+    crops = {}  # type: Dict[int, List[Tuple[str, int, int]]]
+    sheets = {}
+    for row in rows:
+        sheets[row.sheet_id] = row.sheet
+        crops.setdefault(row.profile_id, []).append(
+            (row.sheet.row_image.name, row.image_start, row.image_stop))
+
+    keys = {email.profile_id: row_image_key(crops.get(email.profile_id, []))
+            for email in emails}
+    stale = [email for email in emails
+             if email.row_image_key != keys[email.profile_id] or
+             bool(email.row_image) != bool(keys[email.profile_id])]
+    if not stale:
+        return []
+
+    # Decode each row image once and copy out the crops of every
+    # stale email before moving on to the next sheet.
+    wanted = {}  # type: Dict[str, List[Tuple[int, int, int]]]
+    for email in stale:
+        for name, start, stop in crops.get(email.profile_id, []):
+            wanted.setdefault(name, []).append(
+                (email.profile_id, start, stop))
+    images = {email.profile_id: [] for email in stale}
+    for sheet in sheets.values():
+        name = sheet.row_image.name
+        if name not in wanted:
+            continue
+        with sheet.row_image.open('rb') as fp:
+            row_image = np.asarray(imageio.imread(fp.read()))
+        for profile_id, start, stop in wanted.pop(name):
+            images[profile_id].append(row_image[start:stop].copy())
+
+    result = []
+    for email in stale:
+        key = keys[email.profile_id]
+        if key:
+            png_data = save_png(stack_crops(images[email.profile_id]))
+        else:
+            png_data = None
+        result.append((email, key, png_data))
+    return result
+
+
+def build_row_images(session, emails=None) -> None:
+    '''
+    Make sure that Email.row_image is up to date for the given emails
+    (default: all emails of the session).
+    '''
+    if emails is None:
+        emails = list(session.email_set.exclude(profile=None))
+    for email, key, png_data in render_row_images(session, emails):
+        if png_data is not None:
+            email.row_image.save('%s.png' % key[:16], ContentFile(png_data),
+                                 save=False)
+        else:
+            email.row_image = None
+        email.row_image_key = key
+        email.save(update_fields=['row_image', 'row_image_key'])
+
+
+def preview_row_image(session, email) -> Optional[bytes]:
+    '''
+    The krydser.png of email as it would be sent, rendered in memory
+    if the stored Email.row_image is out of date.
+    '''
+    for email, key, png_data in render_row_images(session, [email]):
+        return png_data
+    return row_image_png(email)
+
+
+def row_image_png(email) -> Optional[bytes]:
+    if not email.row_image:
+        return None
+    with email.row_image.open('rb') as fp:
+        return fp.read()
@@ -0,0 +1,179 @@
+"""
+Benchmark of cross detection on a synthetic crosses sheet.
+
+Run with ``python -m tkweb.apps.regnskab.images.benchmark``.
+The per-cell loop (both with the weight kernel recomputed for every cell,
+as naive_cross_value used to, and with the cached kernel) is compared
+against cross_value_matrix, and the results are checked to agree.
+"""
+
+import argparse
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from .extract import (
+    extract_cross_images, get_cross_values, get_crosses_from_field,
+    get_projected_image, naive_cross_value,
+)
+from .parameters import default_parameters
+from .quadrilateral import Quadrilateral, extract_quadrilateral
+
+
+# Column layout of the crosses part of the sheet: øl, guldøl, sodavand.
+KIND_COLUMNS = (15, 6, 15)
+
+
+class SyntheticSheetImage:
+    """
+    Stand-in for SheetImage with a generated page, a known quadrilateral
+    and known row/column boundaries.
+    """
+
+    def __init__(self, image, quad, rows, cols, person_rows, crosses):
+        self._image = image
+        self.quad = quad
+        self.rows = rows
+        self.cols = cols
+        self.person_rows = person_rows
+        self.crosses = crosses
+        self.parameters = {}
+
+    def get_image(self):
+        return self._image
+
+    def get_projected_image(self):
+        return extract_quadrilateral(self._image, Quadrilateral(self.quad))
+
+
+def draw_cross(im, y1, y2, x1, x2):
+    h, w = y2 - y1, x2 - x1
+    t = np.linspace(0.15, 0.85, 2 * max(h, w))
+    for ys, xs in ((t, t), (t, t[::-1])):
+        im[(y1 + ys * h).astype(int), (x1 + xs * w).astype(int)] = 0.1
+
+
+def synthetic_sheet_image(
+    rng: np.random.RandomState,
+    n_rows: int = 40,
+    width: int = 1240,
+    height: int = 1754,
+    margin: int = 60,
+) -> SyntheticSheetImage:
+    n_cols = sum(KIND_COLUMNS)
+    im = np.ones((height, width, 3))
+    im += rng.normal(0, 0.02, im.shape)
+    np.clip(im, 0, 1, out=im)
+    x0, y0 = margin, margin
+    x1, y1 = width - margin, height - margin
+    inner_w, inner_h = x1 - x0, y1 - y0
+    name_width = 0.25
+    rows = np.linspace(0, 1, n_rows + 1)
+    cols = name_width + (1 - name_width) * np.linspace(0, 1, n_cols + 1)
+    ys = (y0 + rows * inner_h).astype(int)
+    xs = (x0 + cols * inner_w).astype(int)
+    for y in ys:
+        im[y:y+2, x0:x1] = 0
+    for x in np.concatenate([[x0], xs]):
+        im[y0:y1, x:x+2] = 0
+    crosses = rng.random_sample((n_rows, n_cols)) < 0.2
+    for i, j in zip(*crosses.nonzero()):
+        draw_cross(im, ys[i], ys[i+1], xs[j], xs[j+1])
+    quad = [[x0, x1, x1, x0], [y0, y0, y1, y1]]
+    return SyntheticSheetImage(
+        im, quad, rows.tolist(), cols.tolist(), [1] * n_rows,
+        crosses.tolist())
+
+
+def uncached_cross_value(data: np.ndarray) -> float:
+    if data.max() > 1:
+        data = data / data.max()
+    height, width, depth = data.shape
+    i, j = np.mgrid[0:height, 0:width].astype(np.float64)
+    neg_i = (height - 1) - i
+    neg_j = (width - 1) - j
+    weights = np.minimum(
+        np.minimum(i, neg_i) / (height - 1),
+        np.minimum(j, neg_j) / (width - 1),
+    )
+    weights = weights ** 2
+    weights /= weights.sum() * depth
+    return ((1 - data) * weights[:, :, np.newaxis]).sum()
+
+
+def per_cell_values(sheet_image, input_transform, f) -> np.ndarray:
+    return np.array([
+        [f(c) for c in row]
+        for row in extract_cross_images(sheet_image, input_transform)
+    ])
+
+
+def reconcile(sheet_image, values) -> List[Tuple[int, int]]:
+    crosses = np.asarray(sheet_image.crosses)
+    col_bounds = np.cumsum((0,) + KIND_COLUMNS)
+    result = []  # type: List[Tuple[int, int]]
+    for i in range(len(crosses)):
+        for c1, c2 in zip(col_bounds[:-1], col_bounds[1:]):
+            singles = int(crosses[i, c1:c2].sum())
+            result.extend(get_crosses_from_field(
+                values[i:i+1, c1:c2], singles, 0, i, c1))
+    return result
+
+
+def timed(f, *args):
+    t1 = time.perf_counter()
+    result = f(*args)
+    t2 = time.perf_counter()
+    return t2 - t1, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    pages = [synthetic_sheet_image(rng, args.rows) for _ in range(args.pages)]
+    lo = default_parameters.extract_crosses_lo
+    hi = default_parameters.extract_crosses_hi
+
+    kernels = [
+        ('uncached', uncached_cross_value),
+        ('naive_cross_value', naive_cross_value),
+    ]
+    totals = dict.fromkeys(['warp', 'matrix'] + [k for k, f in kernels], 0.0)
+    for page in pages:
+        t, input_transform = timed(get_projected_image, page)
+        totals['warp'] += t
+        best = dict.fromkeys(totals, float('inf'))
+        for _ in range(args.repeat):
+            for k, f in kernels:
+                t, expected = timed(per_cell_values, page, input_transform, f)
+                best[k] = min(best[k], t)
+            t, values = timed(get_cross_values, page, input_transform)
+            best['matrix'] = min(best['matrix'], t)
+        for k, f in kernels:
+            totals[k] += best[k]
+        totals['matrix'] += best['matrix']
+        assert values.shape == expected.shape, (values.shape, expected.shape)
+        assert np.allclose(values, expected), np.abs(values - expected).max()
+        assert reconcile(page, values) == reconcile(page, expected)
+        truth = np.asarray(page.crosses)
+        detected = (values >= hi) | ((values > lo) & truth)
+        print("Page: %s cells, %s crosses, %s detected" %
+              (values.size, truth.sum(), (detected & truth).sum()))
+
+    print("%s pages x %s rows x %s columns, best of %s" %
+          (args.pages, args.rows, sum(KIND_COLUMNS), args.repeat))
+    print("%-20s %.3f s" % ('warp', totals['warp']))
+    for k in [k for k, f in kernels] + ['matrix']:
+        print("%-20s %.3f s (%.1fx)" %
+              (k, totals[k], totals['uncached'] / totals[k]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+On-disk cache of rasterized sheet pages.
+
+Rasterizing a page of a scanned sheet and projecting it onto the
+quadrilateral found by extract_quad is expensive, and the image views
+do it on every request. Both the raw page (uint8) and the projected page
+(float32) are stored as .npy files in REGNSKAB_PAGE_CACHE_DIR (default:
+regnskab/pagecache under MEDIA_ROOT) and loaded memory-mapped.
+
+Entries are keyed by the hash of the sheet file and the page number,
+and projected pages additionally by the quad, so uploading a new file
+or changing the quad never returns a stale image. When a projected page
+is stored, projections of the same page with other quads are removed.
+The modification time of an entry is bumped when it is read, and the
+least recently used entries are removed when the total size of the cache
+exceeds REGNSKAB_PAGE_CACHE_SIZE bytes (default 1 GB).
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from typing import Callable, Iterable, List, Optional
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger('regnskab')
+
+
+def get_cache_dir() -> str:
+    return getattr(settings, 'REGNSKAB_PAGE_CACHE_DIR',
+                   os.path.join(settings.MEDIA_ROOT, 'regnskab', 'pagecache'))
+
+
+def get_cache_size() -> int:
+    return getattr(settings, 'REGNSKAB_PAGE_CACHE_SIZE', 2 ** 30)
+
+
+def file_hash(filename: str) -> str:
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(2 ** 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def quad_key(quad) -> str:
+    return hashlib.sha1(json.dumps(quad).encode()).hexdigest()[:16]
+
+
+def page_path(image_hash: str, page: int, quad=None) -> str:
+    if quad is None:
+        name = '%s-%s.npy' % (image_hash, page)
+    else:
+        name = '%s-%s-%s.npy' % (image_hash, page, quad_key(quad))
+    return os.path.join(get_cache_dir(), name)
+
+
+def load(path: str) -> Optional[np.ndarray]:
+    try:
+        a = np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return a
+
+
+def evict(max_size: int) -> None:
+    cache_dir = get_cache_dir()
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def store(path: str, a: np.ndarray) -> None:
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                np.save(fp, a)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        evict(get_cache_size())
+    except OSError:
+        logger.exception("Kunne ikke gemme %s i billedcachen", path)
+
+
+def remove_projections(image_hash: str, page: int) -> None:
+    prefix = '%s-%s-' % (image_hash, page)
+    cache_dir = get_cache_dir()
+    try:
+        names = os.listdir(cache_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(prefix) and name.endswith('.npy'):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+def cached_pages(
+    image_hash: Optional[str], pages: List[int],
+    load_pages: Callable[[List[int]], Iterable[np.ndarray]],
+) -> List[np.ndarray]:
+    """
+    Get the raw pages (1-indexed) of a sheet file.
+    Pages that are not in the cache are loaded with a single call to
+    load_pages (which is given 0-indexed pages) and stored.
+    """
+    if image_hash is None:
+        return list(load_pages([p - 1 for p in pages]))
+    result = {p: load(page_path(image_hash, p)) for p in pages}
+    missing = [p for p in pages if result[p] is None]
+    if missing:
+        loaded = load_pages([p - 1 for p in missing])
+        for p, a in zip(missing, loaded):
+            store(page_path(image_hash, p), a)
+            result[p] = a
+    return [result[p] for p in pages]
+
+
+def cached_page(
+    image_hash: Optional[str], page: int, load_page: Callable[[], np.ndarray]
+) -> np.ndarray:
+    a, = cached_pages(image_hash, [page], lambda pages: [load_page()])
+    return a
+
+
+def cached_projected_page(
+    image_hash: Optional[str], page: int, quad,
+    project: Callable[[], np.ndarray],
+) -> np.ndarray:
+    """
+    Get a page projected onto the given quad, computing it with project()
+    if it is not in the cache.
+    """
+    if image_hash is None:
+        return project().astype(np.float32)
+    path = page_path(image_hash, page, quad)
+    a = load(path)
+    if a is None:
+        a = project().astype(np.float32)
+        remove_projections(image_hash, page)
+        store(path, a)
+    return a
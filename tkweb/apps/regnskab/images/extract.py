@@ -1,3 +1,4 @@
+import functools
 from typing import Any, Tuple, Optional, List, TYPE_CHECKING, NamedTuple
 
 from django.core.files.base import ContentFile
@@ -6,8 +7,10 @@ import scipy.ndimage
 import scipy.signal
 
 from .parameters import Parameters, default_parameters
-from .utils import save_png
+from .utils import save_png, load_pdf_pages, pdf_page_count
+from .cache import cached_pages
 from .quadrilateral import Quadrilateral, extract_quadrilateral
+from ..profiling import section
 
 import matplotlib
 matplotlib.use('Agg')
@@ -217,10 +220,7 @@ def extract_person_rows(
 def extract_rows_cols(sheet_image: "SheetImage") -> None:
     parameters = get_parameters(sheet_image)
     put_parameters(sheet_image, parameters)
-    im = sheet_image.get_image()
-    input_bbox = Quadrilateral(sheet_image.quad)
-
-    input_transform = extract_quadrilateral(im, input_bbox)
+    input_transform = get_projected_image(sheet_image)
     input_grey = to_grey(input_transform, parameters)
 
     extract_cols(sheet_image, input_grey, parameters)
@@ -230,10 +230,7 @@ def extract_rows_cols(sheet_image: "SheetImage") -> None:
 
 def plot_extract_rows_cols(sheet_image: "SheetImage") -> plt.Figure:
     parameters = get_parameters(sheet_image)
-    im = sheet_image.get_image()
-    input_bbox = Quadrilateral(sheet_image.quad)
-
-    input_transform = extract_quadrilateral(im, input_bbox)
+    input_transform = get_projected_image(sheet_image)
     input_grey = to_grey(input_transform, parameters)
     names_grey = get_name_part(sheet_image, input_grey)
     crosses_grey = get_crosses_part(sheet_image, input_grey)
@@ -270,15 +267,25 @@ def plot_extract_rows_cols(sheet_image: "SheetImage") -> plt.Figure:
     return fig
 
 
-def extract_cross_images(sheet_image: "SheetImage") -> List[List[np.ndarray]]:
-    im = sheet_image.get_image()
-    quad = Quadrilateral(sheet_image.quad)
-    input_transform = extract_quadrilateral(im, quad)
+def get_projected_image(sheet_image: "SheetImage") -> np.ndarray:
+    return sheet_image.get_projected_image()
 
-    height, width, _depth = input_transform.shape
 
+def get_cell_bounds(
+    sheet_image: "SheetImage", input_transform: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    height, width = input_transform.shape[:2]
     rows = np.multiply(sheet_image.rows, height).astype(np.intp)
     cols = np.multiply(sheet_image.cols, width).astype(np.intp)
+    return rows, cols
+
+
+def extract_cross_images(
+    sheet_image: "SheetImage", input_transform: Optional[np.ndarray] = None
+) -> List[List[np.ndarray]]:
+    if input_transform is None:
+        input_transform = get_projected_image(sheet_image)
+    rows, cols = get_cell_bounds(sheet_image, input_transform)
 
     cross_imgs = []  # type: List[List[np.ndarray]]
     for i, (y1, y2) in enumerate(zip(rows[:-1], rows[1:])):
@@ -290,10 +297,12 @@ def extract_cross_images(sheet_image: "SheetImage") -> List[List[np.ndarray]]:
     return cross_imgs
 
 
-def naive_cross_value(data: np.ndarray) -> float:
-    if data.max() > 1:
-        data = data / data.max()
-    height, width, depth = data.shape
+@functools.lru_cache(maxsize=64)
+def cross_weights(height: int, width: int, depth: int) -> np.ndarray:
+    """
+    Weight kernel used by naive_cross_value for a cell of the given shape,
+    normalized so that the weights over all channels sum to 1.
+    """
     i, j = np.mgrid[0:height, 0:width].astype(np.float64)
     neg_i = (height - 1) - i
     neg_j = (width - 1) - j
@@ -303,10 +312,78 @@ def naive_cross_value(data: np.ndarray) -> float:
     )
     weights = weights ** 2
     weights /= weights.sum() * depth
+    weights.setflags(write=False)
+    return weights
+
+
+def naive_cross_value(data: np.ndarray) -> float:
+    if data.max() > 1:
+        data = data / data.max()
+    height, width, depth = data.shape
+    weights = cross_weights(height, width, depth)
     return ((1 - data) * weights[:, :, np.newaxis]).sum()
     # return (v - lo) / (hi - lo)
 
 
+def cross_value_matrix(
+    input_transform: np.ndarray, rows: np.ndarray, cols: np.ndarray
+) -> np.ndarray:
+    """
+    Compute naive_cross_value of every cell in the grid given by the
+    row and column boundaries in one pass.
+
+    Cells are grouped by shape (rows and columns only differ in size by
+    a pixel or two due to rounding), and each group is cut out of the
+    channel-summed image as a single (rows, height, cols, width) tensor
+    that is scored against the shared weight kernel.
+    """
+    if input_transform.ndim == 2:
+        input_transform = input_transform[:, :, np.newaxis]
+    depth = input_transform.shape[2]
+    # Only look at the part of the page covered by the grid.
+    input_transform = input_transform[rows[0]:rows[-1], cols[0]:cols[-1]]
+    rows = rows - rows[0]
+    cols = cols - cols[0]
+    # The weights are the same for every channel,
+    # so sum the channels once for the whole grid.
+    # (A matrix product is much faster than sum(axis=2) here.)
+    dark = input_transform @ np.ones(depth)
+    # naive_cross_value rescales cells whose maximum exceeds 1,
+    # which doesn't happen for images in [0, 1].
+    rescale = input_transform.max() > 1
+    if rescale:
+        page_max = input_transform.max(axis=2)
+    heights = np.diff(rows)
+    widths = np.diff(cols)
+    values = np.empty((len(heights), len(widths)))
+    for height in np.unique(heights):
+        row_idx = (heights == height).nonzero()[0]
+        ys = rows[row_idx, np.newaxis] + np.arange(height)
+        for width in np.unique(widths):
+            col_idx = (widths == width).nonzero()[0]
+            xs = cols[col_idx, np.newaxis] + np.arange(width)
+            # cells[a, i, b, j] is pixel (i, j) of cell (row_idx[a],
+            # col_idx[b]). Indexing rows and columns in two steps
+            # is faster than one broadcast fancy index.
+            cells = dark[ys][:, :, xs]
+            weights = cross_weights(int(height), int(width), depth)
+            group = np.tensordot(cells, weights, axes=([1, 3], [0, 1]))
+            if rescale:
+                cell_max = page_max[ys][:, :, xs].max(axis=(1, 3))
+                group /= np.where(cell_max > 1, cell_max, 1)
+            values[np.ix_(row_idx, col_idx)] = 1 - group
+    return values
+
+
+def get_cross_values(
+    sheet_image: "SheetImage", input_transform: Optional[np.ndarray] = None
+) -> np.ndarray:
+    if input_transform is None:
+        input_transform = get_projected_image(sheet_image)
+    rows, cols = get_cell_bounds(sheet_image, input_transform)
+    return cross_value_matrix(input_transform, rows, cols)
+
+
 def extract_crosses(
     sheet_image: "SheetImage"
 ) -> None:
@@ -314,11 +391,7 @@ def extract_crosses(
     put_parameters(sheet_image, parameters)
     lo = parameters.extract_crosses_lo
     hi = parameters.extract_crosses_hi
-    cross_imgs = extract_cross_images(sheet_image)
-    values = [
-        [naive_cross_value(c) for c in row]
-        for row in cross_imgs
-    ]
+    values = get_cross_values(sheet_image).tolist()
     # Treat values <= lo as "definitely False"
     # and values >= hi as "definitely True".
     # Mark values between lo and hi as True if they are between
@@ -388,23 +461,19 @@ def get_cross_counts(
 
 
 def get_crosses_from_field(
-    cross_imgs: List[List[np.ndarray]],
+    values: np.ndarray,
     singles: int,
     boxes: int,
     row_offset: int,
     col_offset: int,
 ) -> List[Tuple[int, int]]:
-    assert cross_imgs, cross_imgs
+    assert values.size, values
     if singles == boxes == 0:
         return []
-    n = len(cross_imgs)
-    m = len(cross_imgs[0])
-    values = {
-        (i, j): naive_cross_value(c)
-        for i, row in enumerate(cross_imgs)
-        for j, c in enumerate(row)
-    }
-    order = sorted(values.keys(), key=lambda k: values[k], reverse=True)
+    n, m = values.shape
+    # Stable sort, so ties are broken in row-major order.
+    order = [divmod(int(k), m)
+             for k in np.argsort(-values.ravel(), kind='stable')]
     rank = {k: i for i, k in enumerate(order)}
     min_extra = int(2*boxes)
     if singles + min_extra > n*m:
@@ -467,7 +536,9 @@ def get_crosses_from_counts(
     KINDS = 'øl guldøl sodavand'.split()
     cross_counts = get_cross_counts(sheet_image, KINDS)
     assert sum(sheet_image.person_rows) == len(sheet_image.rows) - 1
-    cross_imgs = extract_cross_images(sheet_image)
+    input_transform = get_projected_image(sheet_image)
+    cross_imgs = extract_cross_images(sheet_image, input_transform)
+    values = get_cross_values(sheet_image, input_transform)
     col_bounds = np.cumsum([0, øl, guldøl, sodavand])
     assert sum(sheet_image.person_rows) == len(cross_imgs)
     row_bounds = np.cumsum([0] + sheet_image.person_rows)
@@ -483,8 +554,7 @@ def get_crosses_from_counts(
             assert singles == int(singles)
             assert 0 <= r1 < r2 <= len(cross_imgs), (r1, r2, len(cross_imgs))
             add = get_crosses_from_field(
-                [row[c1:c2] for row in cross_imgs[r1:r2]],
-                int(singles), boxes, r1, c1)
+                values[r1:r2, c1:c2], int(singles), boxes, r1, c1)
             assert all(r1 <= r < r2 for r, c in add), add
             assert all(c1 <= c < c2 for r, c in add), add
             assert len(set(add)) == len(add), add
@@ -518,25 +588,21 @@ def get_person_crosses(
 
 def get_images(sheet: "Sheet") -> List["SheetImage"]:
     from tkweb.apps.regnskab import models
+    images = []  # type: List["SheetImage"]
     if sheet.pk:
-        existing = list(models.SheetImage.objects.filter(sheet=sheet))
-        if existing:
-            for o in existing:
-                o.get_image()
-            return existing
-    images = []  # type: List[np.ndarray]
-    with sheet.image_file_name():
-        i = 1
-        while i < 1000:
-            try:
-                im = models.SheetImage(sheet=sheet, page=i)
-                im.get_image()
-                images.append(im)
-            except Exception:
-                if i == 1:
-                    raise
-                break
-            i += 1
+        images = list(models.SheetImage.objects.filter(sheet=sheet))
+    image_hash = sheet.image_file_hash()
+    with sheet.image_file_name() as filename:
+        if not images:
+            images = [models.SheetImage(sheet=sheet, page=i + 1)
+                      for i in range(pdf_page_count(filename))]
+        pages = cached_pages(
+            image_hash, [o.page for o in images],
+            lambda pages: load_pdf_pages(filename, pages))
+        for o, page in zip(images, pages):
+            o._image = page
+    if not images:
+        raise ValueError('Could not read any pages from %s' % sheet)
     return images
 
 
@@ -553,6 +619,7 @@ def put_parameters(sheet_image: "SheetImage", parameters: Parameters) -> None:
     sheet_image.parameters = parameters._asdict()
 
 
+@section('extract_images')
 def extract_images(
     sheet: "Sheet", kinds: List[str]
 ) -> Tuple[List["SheetImage"], Any, Any]:
@@ -580,33 +647,65 @@ def rerun_extract_images(sheet):
         im.save()
 
 
+ROW_IMAGE_WIDTH = 920
+
+
+def extract_person_images(
+    im: "SheetImage", width: int = ROW_IMAGE_WIDTH
+) -> List[np.ndarray]:
+    """
+    Cut out the part of the page belonging to each person in im.person_rows,
+    projected to a fixed width.
+    """
+    quad = Quadrilateral(im.quad)
+    im_rows = im.rows
+    result = []  # type: List[np.ndarray]
+    i = 0
+    for person_row_count in im.person_rows:
+        assert person_row_count != 0
+        j = i + person_row_count
+        y1, y2 = im_rows[i], im_rows[j]
+        corners = quad.to_world([[0, 1, 1, 0], [y1, y1, y2, y2]])
+        person_quad = Quadrilateral(corners)
+        result.append(extract_quadrilateral(
+            im.get_image(), person_quad, width, height=None))
+        i = j
+    return result
+
+
 def extract_row_image(
-    sheet: "Sheet", kinds: List[str], images: List["SheetImage"]
+    sheet: "Sheet", kinds: List[str], images: List["SheetImage"],
+    person_images: Optional[List[List[np.ndarray]]] = None,
 ) -> Tuple[List["SheetRow"], List["Purchase"], ContentFile]:
+    """
+    Create SheetRows and Purchases from the crosses found in `images`
+    and stitch together the row image of the sheet.
+
+    If `person_images` is given, it must contain the result of
+    extract_person_images() for each of the images.
+    """
     from tkweb.apps.regnskab import models
     rows = []  # type: List["SheetRow"]
     purchases = []  # type: List["Purchase"]
 
+    if person_images is None:
+        person_images = [extract_person_images(im) for im in images]
+
     stitched_image = []
     stitched_image_height = 0
-    sheet.row_image_width = width = 920
+    sheet.row_image_width = ROW_IMAGE_WIDTH
     position = 1
-    for im in images:
+    for im, im_person_images in zip(images, person_images):
         parameters = get_parameters(im)
         put_parameters(im, parameters)
-        quad = Quadrilateral(im.quad)
-        im_rows = im.rows
+        assert len(im_person_images) == len(im.person_rows)
         i = 0
-        for person_row_count in im.person_rows:
-            assert person_row_count != 0
+        for person_row_count, person_image in zip(im.person_rows,
+                                                  im_person_images):
             j = i + person_row_count
 
-            y1, y2 = im_rows[i], im_rows[j]
-            corners = quad.to_world([[0, 1, 1, 0], [y1, y1, y2, y2]])
-            person_quad = Quadrilateral(corners)
-            stitched_image.append(extract_quadrilateral(
-                im.get_image(), person_quad, width, height=None))
-            height = stitched_image[-1].shape[0]
+            stitched_image.append(person_image)
+            height = person_image.shape[0]
 
             rows.append(
                 models.SheetRow(
@@ -0,0 +1,156 @@
+"""
+Background processing of ExtractionJob objects.
+
+SheetCreate queues an ExtractionJob instead of running extract_images()
+inside the request. The "extractworker" management command picks up
+pending jobs with claim_next_job() and runs them with run_job().
+The pages of a PDF are processed in parallel in a process pool by
+extract_page(), which does not access the database.
+"""
+
+import logging
+import traceback
+import concurrent.futures
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .extract import (
+    extract_quad, extract_rows_cols, extract_crosses,
+    extract_person_images, extract_row_image,
+)
+from .utils import load_pdf_page, pdf_page_count
+from .cache import cached_page
+
+logger = logging.getLogger('regnskab')
+
+
+def extract_page(
+    filename: str, page: int, parameters: Dict, image_hash: str
+) -> Tuple[Dict, List[np.ndarray]]:
+    """
+    Run extract_quad, extract_rows_cols and extract_crosses on a single page
+    and cut out the person rows used for the row image.
+
+    Runs in a worker process, so it must not access the database.
+    Returns the computed SheetImage fields and the person images.
+    The raw and projected page are left in the page cache for the views.
+    """
+    from tkweb.apps.regnskab.models import SheetImage
+
+    im = SheetImage(page=page, parameters=parameters)
+    im._image_file_hash = image_hash
+    im._image = cached_page(image_hash, page,
+                            lambda: load_pdf_page(filename, page - 1))
+    extract_quad(im)
+    extract_rows_cols(im)
+    extract_crosses(im)
+    # Convert to uint8 here to avoid pickling float64 images;
+    # this is the same conversion that save_png() does.
+    person_images = [(255 * a).astype(np.uint8)
+                     for a in extract_person_images(im)]
+    fields = dict(parameters=im.parameters, quad=im.quad, cols=im.cols,
+                  rows=im.rows, person_rows=im.person_rows,
+                  crosses=im.crosses)
+    return fields, person_images
+
+
+def claim_next_job() -> Optional["ExtractionJob"]:
+    from tkweb.apps.regnskab.models import ExtractionJob
+
+    with transaction.atomic():
+        qs = ExtractionJob.objects.select_for_update()
+        qs = qs.filter(state=ExtractionJob.PENDING).order_by('created_time')
+        job = qs.first()
+        if job is None:
+            return None
+        job.state = ExtractionJob.RUNNING
+        job.start_time = timezone.now()
+        job.save()
+    return job
+
+
+def process_job(job: "ExtractionJob", max_workers=None) -> None:
+    from tkweb.apps.regnskab.models import SheetImage
+
+    sheet = job.sheet
+    kinds = list(sheet.columns())
+    image_hash = sheet.image_file_hash()
+    with sheet.image_file_name() as filename:
+        page_count = pdf_page_count(filename)
+        if page_count < 1:
+            raise ValueError('Could not read any pages from %s' % filename)
+        sheet.sheetimage_set.all().delete()
+        images = []
+        for i in range(page_count):
+            im = SheetImage(sheet=sheet, page=i + 1,
+                            state=SheetImage.PENDING)
+            im.save()
+            images.append(im)
+
+        # Don't share the database connection with the worker processes.
+        connections.close_all()
+        person_images = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            futures = {
+                pool.submit(extract_page, filename, im.page, im.parameters,
+                            image_hash): im
+                for im in images
+            }
+            sheet.sheetimage_set.update(state=SheetImage.RUNNING)
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    im = futures[future]
+                    fields, person_images[im.page] = future.result()
+                    for k, v in fields.items():
+                        setattr(im, k, v)
+                    im.state = SheetImage.DONE
+                    im.save()
+            except BaseException:
+                sheet.sheetimage_set.exclude(state=SheetImage.DONE).update(
+                    state=SheetImage.FAILED)
+                raise
+
+    rows, purchases, png_file = extract_row_image(
+        sheet, kinds, images, [person_images[im.page] for im in images])
+    save_extracted_rows(sheet, rows, purchases, png_file)
+
+
+def save_extracted_rows(sheet: "Sheet", rows: List["SheetRow"],
+                        purchases: List["Purchase"], png_file) -> None:
+    """
+    Save the row image and, unless rows were entered while the job was
+    running, the extracted rows and purchases of a sheet.
+
+    The sheet was created when the job was queued, so balance snapshots
+    taken since then are updated along with the rows.
+    """
+    from tkweb.apps.regnskab.models import replace_sheet_rows
+
+    with transaction.atomic():
+        sheet.row_image = png_file
+        sheet.save()
+        if sheet.sheetrow_set.exists():
+            # The rows were entered manually while the job was running.
+            logger.info("Krydsliste %s har allerede rækker; " +
+                        "gemmer kun billeder", sheet.pk)
+            return
+        replace_sheet_rows(sheet, rows, purchases)
+
+
+def run_job(job: "ExtractionJob", max_workers=None) -> None:
+    from tkweb.apps.regnskab.models import ExtractionJob
+
+    try:
+        process_job(job, max_workers)
+    except Exception as exn:
+        logger.exception("Billedbehandling af krydsliste %s fejlede",
+                         job.sheet_id)
+        job.state = ExtractionJob.FAILED
+        job.error = '%s\n\n%s' % (exn, traceback.format_exc())
+    else:
+        job.state = ExtractionJob.DONE
+    job.end_time = timezone.now()
+    job.save()
@@ -142,6 +142,9 @@ def extract_quadrilateral(
     for c in cs:
         s = (slice(None), slice(None)) + c
         output[s] = scipy.ndimage.interpolation.map_coordinates(
-            im[s], (y, x), order=1).reshape(
+            im[s], (y, x), order=1, output=np.float64).reshape(
             (output.shape[0], output.shape[1]))
+    if im.dtype == np.uint8:
+        # Pages are loaded as uint8; the projected image is in [0, 1].
+        output /= 255
     return output
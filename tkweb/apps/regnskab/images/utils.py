@@ -2,11 +2,21 @@ import io
 import base64
 import tempfile
 import subprocess
+from typing import Iterable, Iterator, Optional
 
 import numpy as np
 import imageio
 import PIL
 
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+
+# Resolution in dots per inch that PDF pages are rasterized at.
+PDF_DENSITY = 150
+
 
 def imagemagick_page_count(filename):
     """
@@ -41,17 +51,69 @@ def load_tiff_page(filename, page):
     return a / 255.0
 
 
-def load_pdf_page(filename: str, page: int) -> np.ndarray:
+def convert_pdf_page(filename: str, page: int) -> np.ndarray:
+    """
+    Rasterize a single page (0-indexed) of a PDF as a uint8 RGB array
+    using ImageMagick. Used when pypdfium2 is not installed.
+    """
     # convert -density 150 '2221_001.pdf[0]' 2221_001_1.png
     with tempfile.NamedTemporaryFile(suffix='.ppm') as fp:
         subprocess.check_call(
-            ('convert', '-density', '150', '-depth', '8',
+            ('convert', '-density', str(PDF_DENSITY), '-depth', '8',
              # '-background', 'white', '-alpha', 'remove',
              '%s[%s]' % (filename, page),
              fp.name))
-        img = np.asarray(imageio.imread(fp.name))
+        return np.asarray(imageio.imread(fp.name))
+
+
+def render_pdfium_page(pdf: "pypdfium2.PdfDocument", page: int) -> np.ndarray:
+    bitmap = pdf[page].render(scale=PDF_DENSITY / 72, rev_byteorder=True)
+    # to_numpy() returns a view of the bitmap buffer, so copy it.
+    return np.array(bitmap.to_numpy())
+
+
+def pdf_page_count(filename: str) -> int:
+    """
+    Get the number of pages in a PDF without rasterizing any of them.
+    """
+    if pypdfium2 is None:
+        return imagemagick_page_count(filename)
+    pdf = pypdfium2.PdfDocument(filename)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
 
-    return img / 255.0
+def load_pdf_pages(
+    filename: str, pages: Optional[Iterable[int]] = None
+) -> Iterator[np.ndarray]:
+    """
+    Rasterize the given pages (0-indexed, default all pages) of a PDF,
+    opening the file only once. Yields uint8 RGB arrays.
+    """
+    if pypdfium2 is None:
+        if pages is None:
+            pages = range(imagemagick_page_count(filename))
+        for page in pages:
+            yield convert_pdf_page(filename, page)
+        return
+    pdf = pypdfium2.PdfDocument(filename)
+    try:
+        if pages is None:
+            pages = range(len(pdf))
+        for page in pages:
+            yield render_pdfium_page(pdf, page)
+    finally:
+        pdf.close()
+
+
+def load_pdf_page(filename: str, page: int) -> np.ndarray:
+    """
+    Rasterize a single page (0-indexed) of a PDF as a uint8 RGB array.
+    """
+    im, = load_pdf_pages(filename, [page])
+    return im
 
 
 def save_png(im_array):
@@ -0,0 +1,179 @@
+'''
+The ledger of a single profile, as shown by ProfileDetail.
+
+The ledger consists of the purchases of the profile grouped by sheet,
+the transactions of the profile and the emails sent to the profile,
+ordered by date. A single query takes the UNION of the three, computes
+the running balance with a window function and returns one page of
+entries, newest first. Pages are selected by the (date, order, ref_id)
+key of the last entry shown (keyset pagination), so a page costs the
+same no matter how long the history is.
+
+On databases without window functions the balance is computed in Python
+from the whole ledger.
+'''
+
+import datetime
+from decimal import Decimal
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+from tkweb.apps.regnskab.models import (
+    Email, Purchase, PurchaseKind, Session, Sheet, SheetRow, Transaction,
+)
+
+
+PAGE_SIZE = 100
+
+# Entries on the same date are ordered transactions, sheets, emails.
+TRANSACTION, SHEET, EMAIL = 0, 1, 2
+
+
+class LedgerEntry(NamedTuple):
+    date: datetime.date
+    order: int
+    # Transaction, Sheet or Email id depending on order
+    ref_id: int
+    session_id: Optional[int]
+    amount: Optional[Decimal]
+    balance: Decimal
+
+    @property
+    def key(self) -> str:
+        return '%s,%s,%s' % (self.date.isoformat(), self.order, self.ref_id)
+
+
+def parse_key(s: str) -> Optional[Tuple[datetime.date, int, int]]:
+    try:
+        date, order, ref_id = s.split(',')
+        return (datetime.date.fromisoformat(date), int(order), int(ref_id))
+    except (AttributeError, ValueError):
+        return None
+
+
+def ledger_sql(profile_id: int) -> Tuple[str, list]:
+    '''
+    SQL selecting (date, entry_order, ref_id, session_id, amount) of
+    every entry of the profile.
+    '''
+    qn = connection.ops.quote_name
+    t = {model.__name__: qn(model._meta.db_table)
+         for model in (Email, Purchase, PurchaseKind, Session, Sheet,
+                       SheetRow, Transaction)}
+    # Dates of transactions and emails in UTC like datetime.date()
+    # of the values returned by the ORM.
+    tzname = 'UTC' if settings.USE_TZ else None
+    transaction_date = connection.ops.datetime_cast_date_sql(
+        't.%s' % qn('time'), tzname)
+    email_date = connection.ops.datetime_cast_date_sql(
+        'sess.%s' % qn('send_time'), tzname)
+    sql = '''
+    SELECT s.end_date AS entry_date, %(sheet)s AS entry_order, s.id AS ref_id,
+           s.session_id AS session_id,
+           SUM(p.count * k.unit_price) AS amount
+    FROM %(Purchase)s p
+    INNER JOIN %(SheetRow)s r ON p.row_id = r.id
+    INNER JOIN %(Sheet)s s ON r.sheet_id = s.id
+    INNER JOIN %(PurchaseKind)s k ON p.kind_id = k.id
+    WHERE r.profile_id = %%s
+    GROUP BY s.id, s.end_date, s.session_id
+    UNION ALL
+    SELECT COALESCE(
+               (SELECT MIN(s2.end_date)
+                FROM %(Purchase)s p2
+                INNER JOIN %(SheetRow)s r2 ON p2.row_id = r2.id
+                INNER JOIN %(Sheet)s s2 ON r2.sheet_id = s2.id
+                WHERE r2.profile_id = %%s AND t.kind = %%s
+                AND s2.session_id = t.session_id),
+               %(transaction_date)s),
+           %(transaction)s, t.id, t.session_id, t.amount
+    FROM %(Transaction)s t
+    WHERE t.profile_id = %%s
+    UNION ALL
+    SELECT %(email_date)s, %(email)s, e.id, e.session_id, NULL
+    FROM %(Email)s e
+    INNER JOIN %(Session)s sess ON e.session_id = sess.id
+    WHERE e.profile_id = %%s AND sess.send_time IS NOT NULL
+    ''' % dict(t, sheet=SHEET, transaction=TRANSACTION, email=EMAIL,
+               transaction_date=transaction_date, email_date=email_date)
+    # A payment is shown on the date of the first sheet of its session
+    # on which the profile has purchases.
+    params = [profile_id, profile_id, Transaction.PAYMENT, profile_id,
+              profile_id]
+    return sql, params
+
+
+def to_date(v) -> datetime.date:
+    if isinstance(v, datetime.datetime):
+        return v.date()
+    if isinstance(v, datetime.date):
+        return v
+    return datetime.date.fromisoformat(str(v)[:10])
+
+
+def to_decimal(v) -> Optional[Decimal]:
+    if v is None or isinstance(v, Decimal):
+        return v
+    # SQLite returns sums of decimal columns as floats.
+    return Decimal(repr(v)).quantize(Decimal('0.0001'))
+
+
+def get_ledger_page(profile_id: int, before=None, limit: int = PAGE_SIZE
+                    ) -> Tuple[List[LedgerEntry], bool]:
+    '''
+    Return the `limit` newest entries that are older than the key
+    `before` (from LedgerEntry.key), newest first, and whether there
+    are older entries.
+    '''
+    sql, params = ledger_sql(profile_id)
+    order = 'entry_date DESC, entry_order DESC, ref_id DESC'
+    if connection.features.supports_over_clause:
+        sql = '''
+        SELECT entry_date, entry_order, ref_id, session_id, amount, balance
+        FROM (
+            SELECT entry_date, entry_order, ref_id, session_id, amount,
+                   SUM(amount) OVER (
+                       ORDER BY entry_date, entry_order, ref_id
+                       ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                   ) AS balance
+            FROM (%s) entries
+        ) ledger
+        ''' % sql
+        key = parse_key(before) if before else None
+        if key is not None:
+            date, entry_order, ref_id = key
+            sql += '''
+            WHERE entry_date < %s OR (entry_date = %s AND (
+                entry_order < %s OR (entry_order = %s AND ref_id < %s)))
+            '''
+            date = connection.ops.adapt_datefield_value(date)
+            params += [date, date, entry_order, entry_order, ref_id]
+        sql += ' ORDER BY %s LIMIT %s' % (order, limit + 1)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT * FROM (%s) entries' % sql, params)
+            rows = cursor.fetchall()
+        rows = [(to_date(date), o, ref_id, session_id, amount)
+                for date, o, ref_id, session_id, amount in rows]
+        rows.sort(key=lambda row: row[:3])
+        balance = Decimal()
+        with_balance = []
+        for row in rows:
+            if row[4] is not None:
+                balance += to_decimal(row[4])
+            with_balance.append(row + (balance,))
+        key = parse_key(before) if before else None
+        rows = [row for row in reversed(with_balance)
+                if key is None or row[:3] < key][:limit + 1]
+
+    entries = [
+        LedgerEntry(date=to_date(date), order=o, ref_id=ref_id,
+                    session_id=session_id, amount=to_decimal(amount),
+                    balance=to_decimal(balance) or Decimal())
+        for date, o, ref_id, session_id, amount, balance in rows]
+    return entries[:limit], len(entries) > limit
@@ -25,7 +25,9 @@ def main():
 
 
 def import_aliases(data, fp):
-    from tkweb.apps.regnskab.models import Alias, Title, Profile
+    from tkweb.apps.regnskab.models import (
+        Alias, Title, Profile, invalidate_title_index,
+    )
     profiles = {p.name: p for p in Profile.objects.all()}
 
     aliases = []
@@ -50,6 +52,7 @@ def import_aliases(data, fp):
 
     fp.write("Create %s aliases\n" % len(new))
     Alias.objects.bulk_create(new)
+    invalidate_title_index()
 
 
 if __name__ == "__main__":
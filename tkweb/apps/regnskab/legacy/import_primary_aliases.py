@@ -25,7 +25,9 @@ def main():
 
 
 def import_primary_aliases(data, fp):
-    from tkweb.apps.regnskab.models import Alias, Profile
+    from tkweb.apps.regnskab.models import (
+        Alias, Profile, invalidate_title_index,
+    )
     profiles = {p.name: p for p in Profile.objects.all()}
 
     primary_ids = []
@@ -63,6 +65,7 @@ def import_primary_aliases(data, fp):
     qs = Alias.objects.filter(id__in=primary_ids)
     print(qs, file=fp)
     qs.update(is_title=True)
+    invalidate_title_index()
 
 
 if __name__ == "__main__":
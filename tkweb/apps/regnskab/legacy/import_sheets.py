@@ -87,8 +87,11 @@ def get_profiles(data):
 
 
 def make_profiles(data, save_all):
+    from tkweb.apps.regnskab.models import invalidate_title_index
     profiles = get_profiles(data)
     profiles = save_all(profiles, ['name'])
+    # save_all may bulk_create, which does not send post_save.
+    invalidate_title_index()
     return {p.name: p for p in profiles}
 
 
@@ -30,7 +30,9 @@ def main():
 
 
 def import_statuses(data, fp):
-    from tkweb.apps.regnskab.models import SheetStatus
+    from tkweb.apps.regnskab.models import (
+        SheetStatus, invalidate_title_index,
+    )
     profiles = get_profiles_without_data()
     objects = []
     for o in data:
@@ -44,6 +46,7 @@ def import_statuses(data, fp):
                         end_time=strptime(o['end_time'])))
     fp.write("Create %s statuses\n" % len(objects))
     SheetStatus.objects.bulk_create(objects)
+    invalidate_title_index()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+from django.core.management.base import CommandError
+from ._private import RegnskabCommand
+
+from tkweb.apps.regnskab.models import (
+    BalanceSnapshot, Session, Newsletter, aggregate_balance,
+)
+
+
+class Command(RegnskabCommand):
+    help = 'Rebuild or verify BalanceSnapshot objects.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--rebuild', action='store_true')
+        parser.add_argument('-v', '--verify', action='store_true')
+
+    def handle(self, *args, **options):
+        self.at_least_one(options, ['rebuild', 'verify'])
+        if options['rebuild']:
+            self.rebuild()
+        if options['verify']:
+            self.verify()
+
+    def snapshot_times(self):
+        times = set(Session.objects.values_list('created_time', flat=True))
+        times |= set(
+            Newsletter.objects.values_list('created_time', flat=True))
+        return sorted(times)
+
+    def rebuild(self):
+        BalanceSnapshot.objects.all().delete()
+        snapshots = []
+        for time in self.progress(self.snapshot_times()):
+            snapshots.extend(
+                BalanceSnapshot(profile_id=profile_id, time=time,
+                                balance=balance)
+                for profile_id, balance in aggregate_balance(
+                    created_before=time).items())
+        self.save_all(snapshots, bulk=True)
+
+    def verify(self):
+        qs = BalanceSnapshot.objects.order_by('time')
+        stored = {}
+        for profile_id, time, balance in qs.values_list(
+                'profile_id', 'time', 'balance'):
+            stored.setdefault(time, {})[profile_id] = balance
+        errors = 0
+        for time in self.progress(sorted(stored.keys())):
+            expected = aggregate_balance(created_before=time)
+            actual = stored[time]
+            for profile_id in expected.keys() | actual.keys():
+                e = expected.get(profile_id, 0)
+                a = actual.get(profile_id, 0)
+                if e != a:
+                    self.stdout.write('%s profile=%s: expected %s, got %s' %
+                                      (time, profile_id, e, a))
+                    errors += 1
+        if errors:
+            raise CommandError('%s incorrect balances; run with --rebuild' %
+                               errors)
+        self.stdout.write('%s snapshots OK' % len(stored))
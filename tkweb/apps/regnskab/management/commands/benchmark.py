@@ -0,0 +1,159 @@
+import json
+import time
+import statistics
+
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, setup_test_environment, teardown_test_environment,
+)
+from django.urls import reverse
+
+from ._private import RegnskabCommand
+
+from tkweb.apps.regnskab.models import (
+    Profile, Purchase, Session, SheetGrid, SheetRow, Transaction,
+    compute_balance,
+)
+
+
+class Command(RegnskabCommand):
+    help = ('Time the hot paths of regnskab (use syntheticdata to ' +
+            'generate a data set) and compare with a stored baseline.')
+
+    scenarios = [
+        'compute_balance', 'profile_list', 'session_list',
+        'payment_purchase_list', 'balance_print', 'regenerate_emails',
+        'save_rows',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--repeat', type=int, default=3)
+        parser.add_argument('-o', '--output',
+                            help='Write the results as JSON to this file')
+        parser.add_argument('-b', '--baseline',
+                            help='Compare with results written by --output')
+        parser.add_argument('-t', '--tolerance', type=float, default=0.25,
+                            help='Allowed relative increase in time')
+        parser.add_argument('scenario', nargs='*',
+                            help=', '.join(self.scenarios))
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenario']) - set(self.scenarios)
+        if unknown:
+            raise CommandError('Unknown scenarios %s' %
+                               ', '.join(sorted(unknown)))
+        self.session = Session.objects.filter(send_time=None).latest()
+        self.sheet = self.session.sheet_set.order_by('pk').first()
+        if self.sheet is None:
+            raise CommandError('The latest unsent session has no sheets')
+        user = User.objects.get_or_create(
+            username='benchmark',
+            defaults=dict(is_staff=True, is_superuser=True))[0]
+        setup_test_environment()
+        try:
+            self.client = Client()
+            self.client.force_login(user)
+            results = {}
+            for name in options['scenario'] or self.scenarios:
+                results[name] = self.run(name, options['repeat'])
+                self.stdout.write('%-22s %8.3f s %6d queries' %
+                                  (name, results[name]['wall_time'],
+                                   results[name]['queries']))
+        finally:
+            teardown_test_environment()
+
+        data = dict(dataset=self.dataset(), results=results)
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                json.dump(data, fp, indent=2, sort_keys=True)
+        if options['baseline']:
+            with open(options['baseline']) as fp:
+                baseline = json.load(fp)
+            self.compare(baseline, data, options['tolerance'])
+
+    def dataset(self):
+        return {model.__name__: model.objects.count()
+                for model in (Profile, Session, SheetRow, Purchase,
+                              Transaction)}
+
+    def run(self, name, repeat):
+        fn = getattr(self, 'bench_%s' % name)
+        times = []
+        for i in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                t = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - t)
+        return dict(wall_time=statistics.median(times),
+                    min_wall_time=min(times),
+                    queries=len(queries.captured_queries))
+
+    def compare(self, baseline, data, tolerance):
+        if baseline.get('dataset') != data['dataset']:
+            self.stdout.write('Warning: The baseline was made with ' +
+                              'another data set: %s' % baseline.get('dataset'))
+        regressions = []
+        for name, r in data['results'].items():
+            b = baseline['results'].get(name)
+            if b is None:
+                continue
+            ratio = r['wall_time'] / b['wall_time'] if b['wall_time'] else 1
+            slower = ratio > 1 + tolerance
+            more_queries = r['queries'] > b['queries']
+            self.stdout.write('%-22s %+6.0f%% time, %+d queries%s' % (
+                name, 100 * (ratio - 1), r['queries'] - b['queries'],
+                ' REGRESSION' if slower or more_queries else ''))
+            if slower or more_queries:
+                regressions.append(name)
+        if regressions:
+            raise CommandError('Regressions in %s' % ', '.join(regressions))
+
+    def get(self, url_name, **kwargs):
+        response = self.client.get(reverse('regnskab:' + url_name,
+                                           kwargs=kwargs))
+        if response.status_code != 200:
+            raise CommandError('%s returned %s' %
+                               (url_name, response.status_code))
+        return response
+
+    def bench_compute_balance(self):
+        compute_balance()
+
+    def bench_profile_list(self):
+        self.get('profile_list')
+
+    def bench_session_list(self):
+        self.get('session_list')
+
+    def bench_payment_purchase_list(self):
+        self.get('payment_purchase_list', pk=self.session.pk)
+
+    def bench_balance_print(self):
+        # The TeX source is made by BalancePrint.get_tex_context_data
+        # without running LaTeX.
+        url = reverse('regnskab:balance_print',
+                      kwargs=dict(pk=self.session.pk))
+        response = self.client.post(url, dict(mode='source', highlight='on'))
+        if response.status_code != 200:
+            raise CommandError('balance_print returned %s' %
+                               response.status_code)
+
+    def bench_regenerate_emails(self):
+        self.session.regenerate_emails()
+
+    def bench_save_rows(self):
+        # Toggle a count in the first row between 1 and 2,
+        # so that every run saves a change.
+        rows = SheetGrid(self.sheet).editor_data()
+        counts = rows[0]['counts']
+        counts[0] = 1 if counts[0] != 1 else 2
+        url = reverse('regnskab:sheet_update', kwargs=dict(pk=self.sheet.pk))
+        response = self.client.post(url, dict(
+            start_date=self.sheet.start_date.strftime('%d.%m.%Y'),
+            end_date=self.sheet.end_date.strftime('%d.%m.%Y'),
+            data=json.dumps(rows)))
+        if response.status_code != 200 or not response.context.get('saved'):
+            raise CommandError('save_rows: the sheet was not saved')
@@ -0,0 +1,39 @@
+from django.db import transaction
+
+from ._private import RegnskabCommand
+
+from tkweb.apps.regnskab.models import Session, Newsletter, compact_email
+
+
+class Command(RegnskabCommand):
+    help = ('Store the emails of sent sessions and newsletters as ' +
+            'EmailTemplate and context instead of rendered text.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        email_sets = []
+        for model in (Session, Newsletter):
+            qs = model.objects.exclude(send_time=None)
+            qs = qs.exclude(email_template=None)
+            qs = qs.select_related('email_template').order_by('send_time')
+            email_sets.extend(qs)
+
+        compacted = skipped = saved = 0
+        for email_set in self.progress(email_sets):
+            with transaction.atomic():
+                for email in email_set.email_set.filter(context=None):
+                    size = (len(email.subject) + len(email.body_plain) +
+                            len(email.body_html or ''))
+                    # Only compacted if the stored text can be rendered
+                    # exactly from the template of the email set.
+                    if compact_email(email, email_set.email_template):
+                        compacted += 1
+                        saved += size
+                    else:
+                        skipped += 1
+                if options['dry_run']:
+                    transaction.set_rollback(True)
+        self.stdout.write('%s emails compacted (%s characters), %s skipped' %
+                          (compacted, saved, skipped))
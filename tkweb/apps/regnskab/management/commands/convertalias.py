@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand
 
-from tkweb.apps.regnskab.models import Alias, Title, config
+from tkweb.apps.regnskab.models import (
+    Alias, Title, config, invalidate_title_index,
+)
 from tkweb.apps.regnskab.legacy.export import is_title
 
 
@@ -26,4 +28,5 @@ class Command(BaseCommand):
                                  period=a.period))
                 delete_ids.append(a.id)
         Title.objects.bulk_create(new)
+        invalidate_title_index()
         Alias.objects.filter(id__in=delete_ids).delete()
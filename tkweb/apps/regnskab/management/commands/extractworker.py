@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from tkweb.apps.regnskab.images.jobs import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = 'Process queued ExtractionJob objects.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-1', '--once', action='store_true',
+                            help='Exit when there are no pending jobs')
+        parser.add_argument('-j', '--processes', type=int,
+                            help='Number of pages to process in parallel')
+        parser.add_argument('-s', '--sleep', type=float, default=2,
+                            help='Seconds to wait between polls')
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write('Processing %s' % job)
+            run_job(job, options['processes'])
+            self.stdout.write('%s' % job)
@@ -6,6 +6,9 @@ from tkweb.apps.regnskab.legacy.export import export_data
 from tkweb.apps.regnskab.legacy.import_sheets import import_sheets, import_profiles
 from tkweb.apps.regnskab.legacy.import_aliases import import_aliases
 from tkweb.apps.regnskab.legacy.import_statuses import import_statuses
+from tkweb.apps.regnskab.models import (
+    update_purchase_rollups, update_transaction_rollups, update_leaderboard,
+)
 
 
 class Command(RegnskabCommand):
@@ -56,3 +59,6 @@ class Command(RegnskabCommand):
             import_sheets(sheets, self)
             import_aliases(aliases, self.stdout)
             import_statuses(statuses, self.stdout)
+            update_purchase_rollups()
+            update_transaction_rollups()
+            update_leaderboard()
@@ -0,0 +1,61 @@
+from django.core.management.base import CommandError
+from ._private import RegnskabCommand
+
+from tkweb.apps.regnskab.models import (
+    PurchaseRollup, TransactionRollup, LeaderboardEntry,
+    aggregate_purchase_rollups, aggregate_transaction_rollups,
+    aggregate_leaderboard,
+    update_purchase_rollups, update_transaction_rollups, update_leaderboard,
+)
+
+
+class Command(RegnskabCommand):
+    help = ('Rebuild or verify PurchaseRollup, TransactionRollup ' +
+            'and LeaderboardEntry objects.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--rebuild', action='store_true')
+        parser.add_argument('-v', '--verify', action='store_true')
+
+    def handle(self, *args, **options):
+        self.at_least_one(options, ['rebuild', 'verify'])
+        if options['rebuild']:
+            update_purchase_rollups()
+            update_transaction_rollups()
+            update_leaderboard()
+        if options['verify']:
+            self.verify()
+
+    def verify(self):
+        def purchase_key(o):
+            return (o.sheet_id, o.kind_name)
+
+        def transaction_key(o):
+            return (o.session_id, o.period, o.kind, o.time)
+
+        def leaderboard_key(o):
+            return (o.profile_id, o.period, o.key)
+
+        errors = 0
+        checks = [
+            (PurchaseRollup.objects.all(), aggregate_purchase_rollups(),
+             purchase_key, 'count'),
+            (TransactionRollup.objects.all(), aggregate_transaction_rollups(),
+             transaction_key, 'amount'),
+            (LeaderboardEntry.objects.all(), aggregate_leaderboard(),
+             leaderboard_key, 'amount'),
+        ]
+        for stored_qs, expected_list, key, field in checks:
+            stored = {key(o): getattr(o, field) for o in stored_qs}
+            expected = {key(o): getattr(o, field) for o in expected_list}
+            for k in stored.keys() | expected.keys():
+                e = expected.get(k)
+                a = stored.get(k)
+                if e != a:
+                    self.stdout.write('%s %s: expected %s, got %s' %
+                                      (stored_qs.model.__name__, k, e, a))
+                    errors += 1
+        if errors:
+            raise CommandError('%s incorrect rollups; run with --rebuild' %
+                               errors)
+        self.stdout.write('Rollups OK')
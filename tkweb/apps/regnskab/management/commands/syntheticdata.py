@@ -0,0 +1,218 @@
+import datetime
+import random
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from ._private import RegnskabCommand
+
+from tkweb.apps.regnskab.models import (
+    Alias, EmailTemplate, Profile, Purchase, PurchaseKind, Session, Sheet,
+    SheetRow, SheetStatus, Title, Transaction, BEST_ORDER, config,
+    invalidate_title_index,
+)
+from tkweb.apps.regnskab.rules import get_default_prices
+
+
+FIRST_NAMES = '''Anders Anna Bo Camilla Christian Ditte Emil Freja Frederik
+Ida Jakob Julie Kasper Laura Mads Maria Mathias Mette Nikolaj Rasmus
+Sara Signe Simon Sofie Thomas'''.split()
+LAST_NAMES = '''Andersen Christensen Hansen Jensen Johansen Larsen Madsen
+Mortensen Nielsen Olsen Pedersen Petersen Poulsen Rasmussen Sørensen
+Thomsen'''.split()
+
+EMAIL_BODY = '''Kære #TITEL ##NAVN#
+
+Din gæld er #GAELD# kr. (før opgørelsen: #GAELDFOER# kr.).
+'''
+
+BATCH_SIZE = 5000
+COUNTS = [Decimal(c) for c in '1 1 1 2 3 5 0.5'.split()]
+# Number of years a profile stays on the sheet
+ACTIVE_YEARS = 6
+
+
+class Command(RegnskabCommand):
+    help = ('Generate a deterministic synthetic data set ' +
+            'for the benchmark command.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=2000)
+        parser.add_argument('--years', type=int, default=20)
+        parser.add_argument('--sessions-per-year', type=int, default=10)
+        parser.add_argument('--sheets-per-session', type=int, default=5)
+        parser.add_argument('--purchases', type=int, default=500000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--force', action='store_true',
+                            help='Run even if the database has profiles')
+
+    def handle(self, *args, **options):
+        if Profile.objects.exists() and not options['force']:
+            raise CommandError('The database already contains profiles; ' +
+                               'use --force to add synthetic data anyway')
+        self.rng = random.Random(options['seed'])
+        with transaction.atomic():
+            self.generate(options)
+        invalidate_title_index()
+        call_command('balancesnapshots', rebuild=True, stdout=self.stdout)
+        call_command('statsrollups', rebuild=True, stdout=self.stdout)
+
+    def next_id(self, model):
+        # bulk_create does not return primary keys on SQLite and MySQL,
+        # so objects that are referenced are given explicit ids.
+        return (model.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+
+    def bulk_create(self, model, objects):
+        model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+        self.stdout.write('Created %s %s objects' %
+                          (len(objects), model.__name__))
+
+    def generate(self, options):
+        rng = self.rng
+        last_period = config.GFYEAR
+        periods = list(range(last_period - options['years'] + 1,
+                             last_period + 1))
+
+        def period_time(period, day):
+            return timezone.make_aware(
+                datetime.datetime(period, 9, 1) + datetime.timedelta(day))
+
+        # Profiles join evenly over the periods
+        n = options['profiles']
+        first_id = self.next_id(Profile)
+        profiles = []
+        joined = {}
+        for i in range(n):
+            name = '%s %s' % (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+            profiles.append(Profile(
+                id=first_id + i, name=name,
+                email='person%s@example.com' % (first_id + i)))
+            joined[first_id + i] = periods[i * len(periods) // n]
+        self.bulk_create(Profile, profiles)
+
+        statuses = []
+        for p_id, period in joined.items():
+            end = period + ACTIVE_YEARS
+            statuses.append(SheetStatus(
+                profile_id=p_id, start_time=period_time(period, 0),
+                end_time=period_time(end, 0) if end <= last_period else None))
+        self.bulk_create(SheetStatus, statuses)
+
+        by_period = {}
+        for p_id, period in joined.items():
+            by_period.setdefault(period, []).append(p_id)
+        titles = []
+        aliases = []
+        for period in periods:
+            members = by_period.get(period, [])
+            best = rng.sample(members, min(len(BEST_ORDER), len(members)))
+            for root, p_id in zip(BEST_ORDER, best):
+                titles.append(Title(profile_id=p_id, root=root,
+                                    period=period, kind=Title.BEST))
+            fu = [p_id for p_id in members if p_id not in best]
+            fu_roots = rng.sample(
+                ['FU%s%s' % (a, b) for a in 'ABDEHKLMNRST' for b in 'AEIOU'],
+                min(10, len(fu)))
+            for root, p_id in zip(fu_roots, fu):
+                titles.append(Title(profile_id=p_id, root=root,
+                                    period=period, kind=Title.FU))
+            for p_id in members:
+                if rng.random() < 0.2:
+                    aliases.append(Alias(
+                        profile_id=p_id, root=rng.choice(FIRST_NAMES) + 'ø',
+                        start_time=period_time(period, 30)))
+        self.bulk_create(Title, titles)
+        self.bulk_create(Alias, aliases)
+
+        kinds = [PurchaseKind.get_or_create(name=name, position=i + 1,
+                                            unit_price=unit_price)
+                 for i, (name, unit_price) in enumerate(get_default_prices())]
+        template = EmailTemplate.objects.get_or_create(
+            name='Standard',
+            defaults=dict(subject='Regning', body=EMAIL_BODY,
+                          format=EmailTemplate.POUND,
+                          markup=EmailTemplate.PLAIN))[0]
+
+        n_sessions = len(periods) * options['sessions_per_year']
+        n_sheets = n_sessions * options['sheets_per_session']
+        purchases_left = options['purchases']
+        session_id = self.next_id(Session)
+        sheet_id = self.next_id(Sheet)
+        row_id = self.next_id(SheetRow)
+        sessions = []
+        sheets = []
+        sheet_kinds = []
+        rows = []
+        purchases = []
+        transactions = []
+        session_times = {}
+        for period in periods:
+            active = [p_id for p_id, j in joined.items()
+                      if j <= period < j + ACTIVE_YEARS]
+            for k in range(options['sessions_per_year']):
+                time = period_time(period, 1 + k * 36)
+                last = (period == last_period and
+                        k == options['sessions_per_year'] - 1)
+                sessions.append(Session(
+                    id=session_id, period=period, email_template=template,
+                    send_time=None if last else time + datetime.timedelta(2)))
+                session_times[session_id] = time
+                for p_id in rng.sample(active, len(active) // 3):
+                    transactions.append(Transaction(
+                        session_id=session_id, kind=Transaction.PAYMENT,
+                        profile_id=p_id, time=time, period=period,
+                        amount=-Decimal(rng.randrange(50, 500))))
+                for s in range(options['sheets_per_session']):
+                    sheets.append(Sheet(
+                        id=sheet_id, session_id=session_id, period=period,
+                        name='Syntetisk %s' % (s + 1),
+                        start_date=(time - datetime.timedelta(30)).date(),
+                        end_date=(time - datetime.timedelta(1)).date()))
+                    sheet_kinds.extend(
+                        PurchaseKind.sheets.through(
+                            purchasekind_id=kind.id, sheet_id=sheet_id)
+                        for kind in kinds)
+                    # Spread the purchases evenly over the remaining sheets
+                    sheets_left = n_sheets - len(sheets) + 1
+                    target = purchases_left // sheets_left
+                    purchases_left -= target
+                    position = 0
+                    while target > 0:
+                        position += 1
+                        p_id = rng.choice(active) if active else None
+                        if rng.random() < 0.01:
+                            p_id = None
+                        rows.append(SheetRow(
+                            id=row_id, sheet_id=sheet_id, position=position,
+                            profile_id=p_id,
+                            name=None if p_id else rng.choice(FIRST_NAMES)))
+                        n_kinds = min(target, rng.randint(1, 5))
+                        for kind in rng.sample(kinds, n_kinds):
+                            purchases.append(Purchase(
+                                row_id=row_id, kind=kind,
+                                count=rng.choice(COUNTS)))
+                        target -= n_kinds
+                        row_id += 1
+                    sheet_id += 1
+                session_id += 1
+
+        self.bulk_create(Session, sessions)
+        self.bulk_create(Sheet, sheets)
+        PurchaseKind.sheets.through.objects.bulk_create(
+            sheet_kinds, batch_size=BATCH_SIZE)
+        self.bulk_create(SheetRow, rows)
+        self.bulk_create(Purchase, purchases)
+        self.bulk_create(Transaction, transactions)
+
+        # created_time has auto_now_add, so set it afterwards.
+        for s_id, time in self.progress(session_times.items(),
+                                        len(session_times)):
+            Session.objects.filter(id=s_id).update(created_time=time)
+            Sheet.objects.filter(session_id=s_id).update(
+                created_time=time - datetime.timedelta(1))
+            Transaction.objects.filter(session_id=s_id).update(
+                created_time=time)
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0018_newsletter_newsletteremail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('balance', models.DecimalField(decimal_places=6, max_digits=18)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='idm.Profile')),
+            ],
+            options={
+                'ordering': ['time', 'profile'],
+                'unique_together': {('profile', 'time')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0019_balancesnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sheetimage',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Venter'), ('running', 'Behandles'), ('done', 'Færdig'), ('failed', 'Fejlet')], default='done', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='ExtractionJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('state', models.CharField(choices=[('pending', 'Venter'), ('running', 'Behandles'), ('done', 'Færdig'), ('failed', 'Fejlet')], default='pending', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('end_time', models.DateTimeField(blank=True, null=True)),
+                ('sheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='regnskab.Sheet')),
+            ],
+            options={
+                'ordering': ['created_time'],
+                'get_latest_by': 'created_time',
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import tkweb.apps.regnskab.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0020_extractionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='row_image',
+            field=models.FileField(blank=True, null=True, upload_to=tkweb.apps.regnskab.models.email_row_image_upload_to),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='row_image_key',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def set_send_time(apps, schema_editor):
+    # Emails of sessions and newsletters that have already been sent
+    # were sent at the time of the session or newsletter.
+    Session = apps.get_model('regnskab', 'Session')
+    Email = apps.get_model('regnskab', 'Email')
+    Newsletter = apps.get_model('regnskab', 'Newsletter')
+    NewsletterEmail = apps.get_model('regnskab', 'NewsletterEmail')
+    Email.objects.exclude(session__send_time=None).update(
+        send_time=Subquery(Session.objects.filter(
+            pk=OuterRef('session_id')).values('send_time')[:1]))
+    NewsletterEmail.objects.exclude(newsletter__send_time=None).update(
+        send_time=Subquery(Newsletter.objects.filter(
+            pk=OuterRef('newsletter_id')).values('send_time')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0021_email_row_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='send_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='newsletteremail',
+            name='send_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_send_time, migrations.RunPython.noop),
+    ]
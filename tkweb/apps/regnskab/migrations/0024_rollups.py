@@ -0,0 +1,61 @@
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def build_rollups(apps, schema_editor):
+    Purchase = apps.get_model('regnskab', 'Purchase')
+    Transaction = apps.get_model('regnskab', 'Transaction')
+    PurchaseRollup = apps.get_model('regnskab', 'PurchaseRollup')
+    TransactionRollup = apps.get_model('regnskab', 'TransactionRollup')
+    qs = Purchase.objects.order_by().values_list(
+        'row__sheet_id', 'kind__name').annotate(Sum('count'))
+    PurchaseRollup.objects.bulk_create(
+        PurchaseRollup(sheet_id=sheet_id, kind_name=kind_name, count=count)
+        for sheet_id, kind_name, count in qs)
+    qs = Transaction.objects.order_by()
+    session_qs = qs.exclude(session=None).values_list(
+        'session_id', 'period', 'kind').annotate(Sum('amount'))
+    TransactionRollup.objects.bulk_create(
+        TransactionRollup(session_id=session_id, period=period, kind=kind,
+                          amount=amount)
+        for session_id, period, kind, amount in session_qs)
+    legacy_qs = qs.filter(session=None).values_list(
+        'period', 'kind', 'time').annotate(Sum('amount'))
+    TransactionRollup.objects.bulk_create(
+        TransactionRollup(period=period, kind=kind, time=time, amount=amount)
+        for period, kind, time, amount in legacy_qs)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0023_cacheversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurchaseRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind_name', models.CharField(max_length=200)),
+                ('count', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('sheet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='regnskab.sheet')),
+            ],
+            options={
+                'unique_together': {('sheet', 'kind_name')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TransactionRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.IntegerField()),
+                ('kind', models.CharField(max_length=10)),
+                ('time', models.DateTimeField(blank=True, null=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=18)),
+                ('session', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='regnskab.session')),
+            ],
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
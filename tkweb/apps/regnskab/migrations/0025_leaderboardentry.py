@@ -0,0 +1,51 @@
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def build_leaderboard(apps, schema_editor):
+    Purchase = apps.get_model('regnskab', 'Purchase')
+    Transaction = apps.get_model('regnskab', 'Transaction')
+    LeaderboardEntry = apps.get_model('regnskab', 'LeaderboardEntry')
+    qs = Purchase.objects.order_by().exclude(row__profile=None).values_list(
+        'row__profile_id', 'row__sheet__period', 'kind__name')
+    totals = {(profile_id, period, name): count
+              for profile_id, period, name, count
+              in qs.annotate(Sum('count'))}
+    qs = Transaction.objects.order_by().values_list(
+        'profile_id', 'period', 'kind').annotate(Sum('amount'))
+    for profile_id, period, kind, amount in qs:
+        if kind == 'payment':
+            key, amount = 'betalt', -amount
+        else:
+            key = 'andet'
+        totals[profile_id, period, key] = (
+            totals.get((profile_id, period, key), 0) + amount)
+    LeaderboardEntry.objects.bulk_create(
+        LeaderboardEntry(profile_id=profile_id, period=period, key=key,
+                         amount=amount)
+        for (profile_id, period, key), amount in totals.items() if amount)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0024_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.IntegerField()),
+                ('key', models.CharField(max_length=200)),
+                ('amount', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='idm.Profile')),
+            ],
+            options={
+                'unique_together': {('profile', 'period', 'key')},
+            },
+        ),
+        migrations.RunPython(build_leaderboard, migrations.RunPython.noop),
+    ]
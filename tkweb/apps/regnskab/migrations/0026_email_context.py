@@ -0,0 +1,43 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('regnskab', '0025_leaderboardentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='email_template',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='regnskab.EmailTemplate'),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='context',
+            field=jsonfield.fields.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='context_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='newsletteremail',
+            name='email_template',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='regnskab.EmailTemplate'),
+        ),
+        migrations.AddField(
+            model_name='newsletteremail',
+            name='context',
+            field=jsonfield.fields.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='newsletteremail',
+            name='context_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -1,19 +1,27 @@
 import os
 import re
+import json
 import base64
 import hashlib
 import logging
 import datetime
 import tempfile
+import operator
 import functools
 import itertools
 import contextlib
 from collections import OrderedDict
+from typing import Any, NamedTuple, Optional, Tuple
 from decimal import Decimal
 
-from django.core.exceptions import ValidationError, ImproperlyConfigured
-from django.db import models
-from django.db.models import F
+from django.core.exceptions import (
+    ValidationError, ImproperlyConfigured, ObjectDoesNotExist,
+)
+from django.db import connection, models, transaction
+from django.db.models import F, Q, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.mail import EmailMessage
@@ -27,8 +35,10 @@ from jsonfield import JSONField
 import tktitler as tk
 
 from tkweb.apps.regnskab.rules import get_default_prices
+from tkweb.apps.regnskab.profiling import section
 from tkweb.apps.regnskab.utils import (
-    sum_vector, sum_matrix, plain_to_html, html_to_plain, EmailMultiRelated,
+    sum_vector, aggregate_matrix, plain_to_html, html_to_plain,
+    EmailMultiRelated,
 )
 
 from constance import config
@@ -227,78 +237,8 @@ class Sheet(models.Model):
         qs = self.purchasekind_set.all()
         return qs.order_by('position')
 
-    def rows(self):
-        result = []
-        transactions = self.legacy_transactions()
-        kinds = list(self.columns())
-        kind_dict = {kind.id: kind for kind in kinds}
-        sheetrow_qs = self.sheetrow_set.all()
-        sheetrow_qs = sheetrow_qs.select_related('profile')
-        sheetrow_qs = sheetrow_qs.prefetch_related('purchase_set')
-        for row in sheetrow_qs:
-            purchases = {
-                p.kind_id: p
-                for p in row.purchase_set.all()
-            }
-            for purchase in purchases.values():
-                # Use cached kind
-                purchase.kind = kind_dict[purchase.kind_id]
-            purchase_list = [
-                purchases.get(kind.id, Purchase(row=row, kind=kind, count=0))
-                for kind in kinds
-            ]
-            for p in purchase_list:
-                if p.count % 1 == 0:
-                    p.counter = range(int(p.count))
-                else:
-                    p.counter = None
-            im_url, im_width, im_start, im_stop = row.image_data()
-            if im_url:
-                image = dict(url=im_url, width=im_width,
-                             start=im_start, stop=im_stop,
-                             height=im_stop - im_start)
-            else:
-                image = None
-            row_empty = not any(p.count for p in purchase_list)
-            result.append(dict(
-                id=row.id,
-                profile=row.profile,
-                position=row.position,  # needed?
-                name=row.name,
-                kinds=purchase_list,
-                image=image,
-                empty=row_empty,
-                legacy_transactions=transactions.pop(row.profile_id, {}),
-            ))
-        profile_ids = set(row['profile'] for row in result)
-        titles = get_primary_titles(profile_ids=profile_ids,
-                                    period=self.period)
-
-        for row in result:
-            try:
-                title = row['title'] = titles[row['profile'].id]
-            except (KeyError, AttributeError):
-                title = row['title'] = row['display_title'] = None
-                row['title_name'] = (
-                    row['profile'].name if row['profile'] else '')
-            else:
-                row['display_title'] = (
-                    tk.prefix(title, self.period, type='unicode')
-                    if title.period else title.root)
-                row['title_name'] = ' '.join(
-                    (row['display_title'], row['profile'].name))
-
-        if self.legacy_style():
-            # Sort rows by title, period
-            def key(row):
-                if isinstance(row['title'], Title):
-                    return (0, -row['title'].period,
-                            row['title'].kind,
-                            row['title'].root)
-                return (1,)
-
-            result.sort(key=key)
-        return result
+    def rows(self, titles=True):
+        return SheetGrid(self).rows(titles=titles)
 
     def legacy_style(self):
         return self.session_id is None
@@ -321,6 +261,24 @@ class Sheet(models.Model):
                 for_profile[t.kind] = amount
         return transactions
 
+    def image_file_hash(self):
+        '''
+        Hash of the contents of the image file, used as the key of
+        cached rasterized pages.
+        '''
+        try:
+            return self._image_file_hash
+        except AttributeError:
+            pass
+        from tkweb.apps.regnskab.images.cache import file_hash
+
+        if not self.image_file:
+            self._image_file_hash = None
+        else:
+            with self.image_file_name() as filename:
+                self._image_file_hash = file_hash(filename)
+        return self._image_file_hash
+
     @contextlib.contextmanager
     def image_file_name(self):
         '''
@@ -478,12 +436,309 @@ class Purchase(models.Model):
         verbose_name_plural = verbose_name
 
 
-def compute_balance(profile_ids=None, created_before=None, *,
-                    output_matrix=False, purchases_after=None):
+class SheetCell(NamedTuple):
+    '''A purchase count in a row of Sheet.rows().'''
+    kind: PurchaseKind
+    count: Decimal
+    # The id of the Purchase, or None if the row has none of this kind
+    id: Optional[int] = None
+
+    @property
+    def kind_id(self):
+        return self.kind.id
+
+    @property
+    def counter(self):
+        return range(int(self.count)) if self.count % 1 == 0 else None
+
+    def get_count_display(self):
+        return Purchase.get_count_display(self)
+
+
+class SheetGrid:
+    '''
+    The rows of a sheet loaded in a fixed number of queries: one for the
+    purchase kinds, one for the rows and their profiles and one for the
+    purchase counts, plus two for the titles if they are needed.
+
+    counts[i][j] is the count of kinds[j] in rows[i], or None if the row
+    has no Purchase of that kind, and purchase_ids[i][j] is the id of
+    that Purchase. The same grid is used by the sheet detail page, the
+    sheet editor and SheetRowDiff.
+    '''
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.kinds = list(sheet.columns())
+        column = {kind.id: j for j, kind in enumerate(self.kinds)}
+        self.row_objects = list(
+            sheet.sheetrow_set.all().select_related('profile'))
+        index = {row.id: i for i, row in enumerate(self.row_objects)}
+        self.counts = [[None] * len(self.kinds) for _ in self.row_objects]
+        self.purchase_ids = [[None] * len(self.kinds)
+                             for _ in self.row_objects]
+        purchases = Purchase.objects.filter(row__sheet=sheet).order_by()
+        for p_id, row_id, kind_id, count in purchases.values_list(
+                'id', 'row_id', 'kind_id', 'count'):
+            i, j = index[row_id], column[kind_id]
+            self.counts[i][j] = count
+            self.purchase_ids[i][j] = p_id
+
+    def image(self, row):
+        if row.image_start is None or row.image_stop is None:
+            return None
+        sheet = self.sheet
+        if not sheet.row_image or not sheet.row_image_width:
+            return None
+        return dict(url=sheet.row_image.url, width=sheet.row_image_width,
+                    start=row.image_start, stop=row.image_stop,
+                    height=row.image_stop - row.image_start)
+
+    def editor_data(self):
+        '''The rows as the JSON-compatible data of the sheet editor.'''
+        return [
+            dict(profile_id=row.profile_id,
+                 name=row.name or '',
+                 counts=[None if c is None else float(c) for c in counts],
+                 image=self.image(row))
+            for row, counts in zip(self.row_objects, self.counts)
+        ]
+
+    def rows(self, titles=True):
+        '''
+        The rows as dicts with 'id', 'profile', 'position', 'name',
+        'kinds' (a SheetCell for each column), 'image_start',
+        'image_stop', 'image', 'empty' and 'legacy_transactions',
+        and 'title', 'display_title' and 'title_name' if titles is True.
+        '''
+        sheet = self.sheet
+        transactions = sheet.legacy_transactions()
+        result = []
+        for row, counts, purchase_ids in zip(
+                self.row_objects, self.counts, self.purchase_ids):
+            cells = [SheetCell(kind, Decimal(0) if c is None else c, p_id)
+                     for kind, c, p_id in zip(self.kinds, counts,
+                                              purchase_ids)]
+            result.append(dict(
+                id=row.id,
+                profile=row.profile,
+                position=row.position,
+                name=row.name,
+                kinds=cells,
+                image_start=row.image_start,
+                image_stop=row.image_stop,
+                image=self.image(row),
+                empty=not any(counts),
+                legacy_transactions=transactions.pop(row.profile_id, {}),
+            ))
+        if not titles:
+            return result
+
+        profile_ids = set(row.profile_id for row in self.row_objects
+                          if row.profile_id)
+        primary_titles = get_primary_titles(
+            profile_ids=profile_ids, period=sheet.period)
+        for row in result:
+            title = row['title'] = (
+                row['profile'] and primary_titles.get(row['profile'].id))
+            if title is None:
+                row['title'] = row['display_title'] = None
+                row['title_name'] = (
+                    row['profile'].name if row['profile'] else '')
+            else:
+                row['display_title'] = (
+                    tk.prefix(title, sheet.period, type='unicode')
+                    if title.period else title.root)
+                row['title_name'] = ' '.join(
+                    (row['display_title'], row['profile'].name))
+
+        if sheet.legacy_style():
+            # Sort rows by title, period
+            def key(row):
+                if isinstance(row['title'], Title):
+                    return (0, -row['title'].period,
+                            row['title'].kind,
+                            row['title'].root)
+                return (1,)
+
+            result.sort(key=key)
+        return result
+
+
+def sheet_row_profile_id(row):
+    return row['profile'] and row['profile'].id
+
+
+def sheet_row_content(row):
+    '''The parts of a row dict that affect balances and emails.'''
+    return (sheet_row_profile_id(row),
+            tuple((p.kind_id, p.count) for p in row['kinds'] if p.count))
+
+
+class SheetRowDiff:
+    '''
+    The changes that turn the rows of a SheetGrid into `new_rows`, a list
+    of dicts with 'profile', 'name', 'position', 'image_start',
+    'image_stop' and 'kinds' (Purchase or SheetCell objects).
+
+    Rows are matched first by identical contents, then by profile and
+    name, and finally in order, so that moving a row only changes the
+    positions and editing a count only changes that Purchase. Matched
+    rows are in `updated` if their profile or counts changed and in
+    `moved` if only their name, position or image changed.
+    '''
+
+    ROW_FIELDS = ('profile_id', 'name', 'position',
+                  'image_start', 'image_stop')
+
+    def __init__(self, grid, new_rows):
+        self.sheet = grid.sheet
+        old_rows = grid.rows(titles=False)
+
+        def full_key(row):
+            return (sheet_row_content(row), row['name'],
+                    row['image_start'], row['image_stop'])
+
+        def name_key(row):
+            return (sheet_row_profile_id(row), row['name'])
+
+        pairs = {}  # index in new_rows -> old row
+        unmatched = list(range(len(new_rows)))
+        remaining = old_rows
+        for key in (full_key, name_key):
+            by_key = {}
+            for old in remaining:
+                by_key.setdefault(key(old), []).append(old)
+            still_unmatched = []
+            for i in unmatched:
+                candidates = by_key.get(key(new_rows[i]))
+                if candidates:
+                    pairs[i] = candidates.pop(0)
+                else:
+                    still_unmatched.append(i)
+            unmatched = still_unmatched
+            matched = set(id(old) for old in pairs.values())
+            remaining = [old for old in remaining if id(old) not in matched]
+        for i, old in zip(unmatched, remaining):
+            pairs[i] = old
+
+        self.updated = []
+        self.moved = []
+        self.inserted = [new for i, new in enumerate(new_rows)
+                         if i not in pairs]
+        self.deleted = remaining[len(unmatched):]
+        for i, old in sorted(pairs.items()):
+            new = new_rows[i]
+            if sheet_row_content(old) != sheet_row_content(new):
+                self.updated.append((old, new))
+            elif self.row_values(old) != self.row_values(new):
+                self.moved.append((old, new))
+
+    def row_values(self, row):
+        return (sheet_row_profile_id(row), row['name'], row['position'],
+                row['image_start'], row['image_stop'])
+
+    def apply(self):
+        '''
+        Write the changes with bulk queries in a single transaction.
+        SheetRowDiff only touches SheetRow and Purchase; balance snapshots
+        and rollups are updated by the caller.
+        '''
+        sheet = self.sheet
+        update_rows = []
+        create_purchases = []
+        update_purchases = []
+        delete_purchase_ids = []
+        for old, new in self.updated + self.moved:
+            row = SheetRow(id=old['id'], sheet=sheet)
+            for field, value in zip(self.ROW_FIELDS, self.row_values(new)):
+                setattr(row, field, value)
+            update_rows.append(row)
+            for old_cell, new_cell in zip(old['kinds'], new['kinds']):
+                if old_cell.count == new_cell.count:
+                    continue
+                if not new_cell.count:
+                    delete_purchase_ids.append(old_cell.id)
+                elif old_cell.id is None:
+                    create_purchases.append(Purchase(
+                        row_id=old['id'], kind_id=new_cell.kind_id,
+                        count=new_cell.count))
+                else:
+                    update_purchases.append(Purchase(
+                        id=old_cell.id, count=new_cell.count))
+
+        with transaction.atomic():
+            SheetRow.objects.filter(
+                id__in=[old['id'] for old in self.deleted]).delete()
+            Purchase.objects.filter(id__in=delete_purchase_ids).delete()
+            SheetRow.objects.bulk_update(update_rows, self.ROW_FIELDS)
+            Purchase.objects.bulk_update(update_purchases, ['count'])
+            new_rows = [
+                SheetRow(sheet=sheet, profile=new['profile'],
+                         name=new['name'], position=new['position'],
+                         image_start=new['image_start'],
+                         image_stop=new['image_stop'])
+                for new in self.inserted]
+            if connection.features.can_return_rows_from_bulk_insert:
+                SheetRow.objects.bulk_create(new_rows)
+            else:
+                for row in new_rows:
+                    row.save()
+            for row, new in zip(new_rows, self.inserted):
+                create_purchases.extend(
+                    Purchase(row=row, kind_id=c.kind_id, count=c.count)
+                    for c in new['kinds'] if c.count)
+            Purchase.objects.bulk_create(create_purchases)
+
+    def old_rows(self):
+        '''The rows removed or changed, as they were before.'''
+        return self.deleted + [old for old, new in self.updated]
+
+    def new_rows(self):
+        '''The rows added or changed, as they are after.'''
+        return self.inserted + [new for old, new in self.updated]
+
+    def profile_ids(self):
+        '''Profiles whose purchases on the sheet changed.'''
+        return set(sheet_row_profile_id(r)
+                   for r in self.old_rows() + self.new_rows()
+                   if r['profile'])
+
+
+class BalanceSnapshot(models.Model):
+    '''
+    Materialized result of compute_balance(created_before=time)
+    for a single profile.
+
+    Snapshots are taken when a Session or Newsletter is created,
+    and they are kept up to date by update_balance_snapshots()
+    when purchases or transactions created before `time` are changed.
+    '''
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    time = models.DateTimeField(db_index=True)
+    balance = models.DecimalField(max_digits=18, decimal_places=6)
+
+    class Meta:
+        ordering = ['time', 'profile']
+        unique_together = [('profile', 'time')]
+
+    def __str__(self):
+        return '%s %s: %s' % (self.time, self.profile_id, self.balance)
+
+
+def aggregate_balance(profile_ids=None, created_before=None,
+                      created_after=None):
+    '''
+    Compute balances directly from the Purchase and Transaction tables,
+    only including entries created in [created_after, created_before).
+    '''
     purchase_qs = Purchase.objects.all()
     if created_before:
         purchase_qs = purchase_qs.filter(
             row__sheet__created_time__lt=created_before)
+    if created_after:
+        purchase_qs = purchase_qs.filter(
+            row__sheet__created_time__gte=created_after)
     if profile_ids:
         purchase_qs = purchase_qs.filter(row__profile_id__in=profile_ids)
     purchase_qs = purchase_qs.exclude(row__profile_id=None)
@@ -495,21 +750,496 @@ def compute_balance(profile_ids=None, created_before=None, *,
         transaction_qs = transaction_qs.filter(profile_id__in=profile_ids)
     if created_before:
         transaction_qs = transaction_qs.filter(created_time__lt=created_before)
+    if created_after:
+        transaction_qs = transaction_qs.filter(created_time__gte=created_after)
     transaction_balance = sum_vector(transaction_qs, 'profile_id', 'amount')
     for profile_id, amount in transaction_balance.items():
         try:
             balance[profile_id] += amount
         except KeyError:
             balance[profile_id] = amount
+    return balance
+
+
+def snapshot_balance(profile_ids=None, created_before=None):
+    '''
+    Same as aggregate_balance(profile_ids, created_before), but start from
+    the latest BalanceSnapshot taken no later than created_before
+    and only aggregate the entries created since then.
+    '''
+    snapshot_qs = BalanceSnapshot.objects.all()
+    if created_before:
+        snapshot_qs = snapshot_qs.filter(time__lte=created_before)
+    snapshot_time, = snapshot_qs.aggregate(models.Max('time')).values()
+    if snapshot_time is None:
+        return aggregate_balance(profile_ids, created_before)
+
+    snapshot_qs = BalanceSnapshot.objects.filter(time=snapshot_time)
+    if profile_ids:
+        snapshot_qs = snapshot_qs.filter(profile_id__in=profile_ids)
+    balance = dict(snapshot_qs.values_list('profile_id', 'balance'))
+    delta = aggregate_balance(profile_ids, created_before,
+                              created_after=snapshot_time)
+    for profile_id, amount in delta.items():
+        try:
+            balance[profile_id] += amount
+        except KeyError:
+            balance[profile_id] = amount
+    return balance
+
+
+def take_balance_snapshot(time):
+    '''
+    Store the balance of every profile as of the given time.
+    Does nothing if a snapshot was already taken at that time.
+    '''
+    if BalanceSnapshot.objects.filter(time=time).exists():
+        return
+    BalanceSnapshot.objects.bulk_create([
+        BalanceSnapshot(profile_id=profile_id, time=time, balance=balance)
+        for profile_id, balance in snapshot_balance(
+            created_before=time).items()
+    ])
+
+
+def update_balance_snapshots(changes):
+    '''
+    Update BalanceSnapshot objects after purchases or transactions
+    have been changed.
+
+    `changes` is an iterable of (profile_id, created_time, amount) where
+    `amount` has been added to the balance of the profile
+    by an entry created at `created_time`.
+    For sheet purchases, created_time is the created_time of the Sheet.
+    '''
+    changes = [(p_id, t, amount) for p_id, t, amount in changes
+               if p_id is not None and amount]
+    if not changes:
+        return
+    snapshot_times = list(
+        BalanceSnapshot.objects.filter(
+            time__gt=min(t for p_id, t, amount in changes))
+        .order_by().values_list('time', flat=True).distinct())
+    if not snapshot_times:
+        return
+
+    deltas = {}
+    for p_id, t, amount in changes:
+        for snapshot_time in snapshot_times:
+            if t < snapshot_time:
+                key = (p_id, snapshot_time)
+                deltas[key] = deltas.get(key, Decimal()) + amount
+
+    existing_qs = BalanceSnapshot.objects.filter(
+        time__in=snapshot_times,
+        profile_id__in=set(p_id for p_id, t in deltas))
+    existing = {(o.profile_id, o.time): o for o in existing_qs}
+    new = []
+    for (p_id, snapshot_time), delta in deltas.items():
+        try:
+            o = existing[p_id, snapshot_time]
+        except KeyError:
+            new.append(BalanceSnapshot(profile_id=p_id, time=snapshot_time,
+                                       balance=delta))
+        else:
+            o.balance += delta
+    BalanceSnapshot.objects.bulk_update(existing.values(), ['balance'])
+    BalanceSnapshot.objects.bulk_create(new)
+
+
+def sheet_row_balance_changes(sheet, old_rows, new_rows):
+    '''
+    Compute the argument to update_balance_snapshots() when the rows of
+    `sheet` are changed from `old_rows` to `new_rows`, where each row is
+    a dict with 'profile' and 'kinds' as returned by SheetGrid.rows().
+    '''
+    amounts = {}
+    for sign, rows in ((-1, old_rows), (1, new_rows)):
+        for row in rows:
+            if not row['profile']:
+                continue
+            # Counts posted from the sheet editor are floats.
+            amount = sum((Decimal(str(p.count)) * p.kind.unit_price
+                          for p in row['kinds']), Decimal())
+            p_id = row['profile'].id
+            amounts[p_id] = amounts.get(p_id, Decimal()) + sign * amount
+    return [(p_id, sheet.created_time, amount)
+            for p_id, amount in amounts.items()]
+
+
+class PurchaseRollup(models.Model):
+    '''
+    Materialized sum of Purchase.count per sheet and purchase kind name,
+    read by SessionList instead of the Purchase table.
+
+    Kept up to date by update_purchase_rollups() when the rows of a sheet
+    are changed, and rebuilt by the statsrollups management command.
+    '''
+    sheet = models.ForeignKey(Sheet, on_delete=models.CASCADE)
+    kind_name = models.CharField(max_length=200)
+    count = models.DecimalField(max_digits=18, decimal_places=4)
+
+    class Meta:
+        unique_together = [('sheet', 'kind_name')]
+
+
+class TransactionRollup(models.Model):
+    '''
+    Materialized sum of Transaction.amount per session, period and kind.
+    Transactions without a session (imported from the old system) are
+    also grouped by time, since SessionList matches them to sheets by date.
+
+    Kept up to date by update_transaction_rollups().
+    '''
+    session = models.ForeignKey('Session', on_delete=models.CASCADE,
+                                null=True, blank=True)
+    period = models.IntegerField()
+    kind = models.CharField(max_length=10)
+    time = models.DateTimeField(null=True, blank=True)
+    amount = models.DecimalField(max_digits=18, decimal_places=2)
+
+
+def aggregate_purchase_rollups(sheet_ids=None):
+    qs = Purchase.objects.order_by()
+    if sheet_ids is not None:
+        qs = qs.filter(row__sheet_id__in=sheet_ids)
+    qs = qs.values_list('row__sheet_id', 'kind__name').annotate(Sum('count'))
+    return [PurchaseRollup(sheet_id=sheet_id, kind_name=kind_name,
+                           count=count)
+            for sheet_id, kind_name, count in qs]
+
+
+def update_purchase_rollups(sheet_ids=None):
+    '''
+    Recompute the PurchaseRollup objects of the given sheets
+    (default: all sheets).
+    '''
+    qs = PurchaseRollup.objects.all()
+    if sheet_ids is not None:
+        sheet_ids = set(sheet_ids)
+        if not sheet_ids:
+            return
+        qs = qs.filter(sheet_id__in=sheet_ids)
+    with transaction.atomic():
+        qs.delete()
+        PurchaseRollup.objects.bulk_create(
+            aggregate_purchase_rollups(sheet_ids))
+
+
+def transaction_rollup_filter(keys):
+    return functools.reduce(
+        operator.or_,
+        (Q(session_id=session_id, period=period)
+         for session_id, period in keys))
+
+
+def aggregate_transaction_rollups(keys=None):
+    qs = Transaction.objects.order_by()
+    if keys is not None:
+        qs = qs.filter(transaction_rollup_filter(keys))
+    session_qs = qs.exclude(session=None).values_list(
+        'session_id', 'period', 'kind').annotate(Sum('amount'))
+    legacy_qs = qs.filter(session=None).values_list(
+        'period', 'kind', 'time').annotate(Sum('amount'))
+    return ([TransactionRollup(session_id=session_id, period=period,
+                               kind=kind, amount=amount)
+             for session_id, period, kind, amount in session_qs] +
+            [TransactionRollup(session=None, period=period, kind=kind,
+                               time=time, amount=amount)
+             for period, kind, time, amount in legacy_qs])
+
+
+def update_transaction_rollups(keys=None):
+    '''
+    Recompute the TransactionRollup objects for the given
+    (session_id, period) pairs (default: all transactions).
+    '''
+    qs = TransactionRollup.objects.all()
+    if keys is not None:
+        keys = set(keys)
+        if not keys:
+            return
+        qs = qs.filter(transaction_rollup_filter(keys))
+    with transaction.atomic():
+        qs.delete()
+        TransactionRollup.objects.bulk_create(
+            aggregate_transaction_rollups(keys))
+
+
+class LeaderboardEntry(models.Model):
+    '''
+    Materialized per-period total of a profile: the number of crosses
+    of each purchase kind name on sheets of the period, and the amounts
+    paid (PAID) and bought otherwise (OTHER) in transactions of the period.
+
+    Kept up to date by update_leaderboard() from the changes of each
+    write, rebuilt by the statsrollups management command and read
+    through get_leaderboard().
+    '''
+    PAID, OTHER = 'betalt', 'andet'
+
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    period = models.IntegerField()
+    key = models.CharField(max_length=200)
+    amount = models.DecimalField(max_digits=18, decimal_places=4)
+
+    class Meta:
+        unique_together = [('profile', 'period', 'key')]
+
+
+def transaction_leaderboard_key(kind):
+    if kind == Transaction.PAYMENT:
+        return LeaderboardEntry.PAID
+    return LeaderboardEntry.OTHER
+
+
+def transaction_leaderboard_changes(transactions, sign=1):
+    return [(o.profile_id, o.period, transaction_leaderboard_key(o.kind),
+             sign * (-o.amount if o.kind == Transaction.PAYMENT
+                     else o.amount))
+            for o in transactions]
+
+
+def sheet_row_leaderboard_changes(sheet, old_rows, new_rows):
+    '''
+    Compute the argument to update_leaderboard() when the rows of `sheet`
+    are changed from `old_rows` to `new_rows` (as for
+    sheet_row_balance_changes).
+    '''
+    return [(row['profile'].id, sheet.period, p.kind.name,
+             sign * Decimal(str(p.count)))
+            for sign, rows in ((-1, old_rows), (1, new_rows))
+            for row in rows if row['profile']
+            for p in row['kinds'] if p.count]
+
+
+def aggregate_leaderboard():
+    purchase_qs = Purchase.objects.order_by().exclude(row__profile=None)
+    purchase_qs = purchase_qs.values_list(
+        'row__profile_id', 'row__sheet__period', 'kind__name')
+    totals = {(profile_id, period, name): count
+              for profile_id, period, name, count
+              in purchase_qs.annotate(Sum('count'))}
+    transaction_qs = Transaction.objects.order_by().values_list(
+        'profile_id', 'period', 'kind').annotate(Sum('amount'))
+    for profile_id, period, kind, amount in transaction_qs:
+        if kind == Transaction.PAYMENT:
+            amount = -amount
+        k = (profile_id, period, transaction_leaderboard_key(kind))
+        totals[k] = totals.get(k, Decimal()) + amount
+    return [LeaderboardEntry(profile_id=profile_id, period=period, key=key,
+                             amount=amount)
+            for (profile_id, period, key), amount in totals.items()
+            if amount]
+
+
+def update_leaderboard(changes=None):
+    '''
+    Add `changes`, an iterable of (profile_id, period, key, amount), to the
+    LeaderboardEntry objects. If changes is None, rebuild all entries.
+    '''
+    if changes is None:
+        with transaction.atomic():
+            LeaderboardEntry.objects.all().delete()
+            LeaderboardEntry.objects.bulk_create(aggregate_leaderboard())
+        return
+    deltas = {}
+    for profile_id, period, key, amount in changes:
+        k = (profile_id, period, key)
+        deltas[k] = deltas.get(k, Decimal()) + amount
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    with transaction.atomic():
+        qs = LeaderboardEntry.objects.select_for_update().filter(
+            profile_id__in=set(k[0] for k in deltas),
+            period__in=set(k[1] for k in deltas))
+        existing = {(o.profile_id, o.period, o.key): o for o in qs}
+        update = []
+        create = []
+        delete = []
+        for k, amount in deltas.items():
+            try:
+                o = existing[k]
+            except KeyError:
+                profile_id, period, key = k
+                create.append(LeaderboardEntry(
+                    profile_id=profile_id, period=period, key=key,
+                    amount=amount))
+            else:
+                o.amount += amount
+                (update if o.amount else delete).append(o)
+        LeaderboardEntry.objects.filter(
+            id__in=[o.id for o in delete]).delete()
+        LeaderboardEntry.objects.bulk_update(update, ['amount'])
+        LeaderboardEntry.objects.bulk_create(create)
+
+
+def replace_sheet_rows(sheet, rows, purchases):
+    '''
+    Replace the rows of `sheet` by the unsaved SheetRow and Purchase
+    objects returned by extract_images(), and update the balance
+    snapshots, leaderboard and rollups in the same transaction.
+    '''
+    with transaction.atomic():
+        old_rows = sheet.rows(titles=False)
+        sheet.sheetrow_set.all().delete()
+        for o in rows:
+            o.sheet = o.sheet  # Update sheet_id
+            o.save()
+        for o in purchases:
+            o.row = o.row  # Update row_id
+        Purchase.objects.bulk_create(purchases)
+        new_rows = sheet.rows(titles=False)
+        update_balance_snapshots(
+            sheet_row_balance_changes(sheet, old_rows, new_rows))
+        update_leaderboard(
+            sheet_row_leaderboard_changes(sheet, old_rows, new_rows))
+        update_purchase_rollups([sheet.id])
+
+
+def delete_sheet(sheet):
+    '''
+    Delete `sheet` and remove its purchases from the balance snapshots
+    and leaderboard.
+    '''
+    rows = sheet.rows(titles=False)
+    with transaction.atomic():
+        update_balance_snapshots(sheet_row_balance_changes(sheet, rows, []))
+        update_leaderboard(sheet_row_leaderboard_changes(sheet, rows, []))
+        sheet.delete()
+
+
+def get_leaderboard(period, key=LeaderboardEntry.PAID, profile_ids=None,
+                    balance=False):
+    '''
+    Return a list of (profile_id, totals) for the profiles with entries in
+    `period`, sorted by totals[key] with the largest first. totals maps
+    each key to the total of the period, and if `balance` is True,
+    'balance' to the current balance of the profile.
+    '''
+    qs = LeaderboardEntry.objects.filter(period=period)
+    if profile_ids is not None:
+        qs = qs.filter(profile_id__in=profile_ids)
+    board = {}
+    for profile_id, k, amount in qs.values_list('profile_id', 'key',
+                                                'amount'):
+        board.setdefault(profile_id, {})[k] = amount
+    if balance and board:
+        balances = compute_balance(list(board))
+        for profile_id, totals in board.items():
+            totals['balance'] = balances.get(profile_id, Decimal())
+    return sorted(board.items(),
+                  key=lambda item: item[1].get(key, Decimal()),
+                  reverse=True)
+
+
+def transactions_changed(old, new):
+    '''
+    Update the balance snapshots, rollups and leaderboard after the saved
+    transactions `old` have been replaced by `new` one at a time, e.g. in
+    the admin. Call inside the transaction that saves them.
+    '''
+    update_balance_snapshots(
+        [(o.profile_id, o.created_time, o.amount) for o in new] +
+        [(o.profile_id, o.created_time, -o.amount) for o in old])
+    update_transaction_rollups((o.session_id, o.period) for o in old + new)
+    update_leaderboard(transaction_leaderboard_changes(new) +
+                       transaction_leaderboard_changes(old, sign=-1))
+
+
+def save_transaction_batch(session, kind, amounts, existing, user, note=''):
+    '''
+    Make the transactions of kind `kind` in `session` match `amounts`,
+    a mapping from profile id to amount, where `existing` maps profile
+    id to the Transaction currently entered for the profile.
+
+    Unchanged transactions are left alone, and changed, new and removed
+    transactions are written with one bulk query each in a single
+    transaction together with the snapshot and rollup updates.
+    The batch is logged as a single JSON audit record.
+    Returns the ids of the profiles whose transactions changed.
+    '''
+    now = timezone.now()
+    create = []
+    update = []
+    old = []
+    for p_id, amount in amounts.items():
+        amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+        e = existing.get(p_id)
+        if e is not None and (e.amount, e.period, e.note) == (
+                amount, session.period, note):
+            continue
+        o = Transaction(
+            period=session.period, kind=kind, profile_id=p_id, time=now,
+            amount=amount, created_by=user, created_time=now, note=note,
+            session=session)
+        if e is None:
+            create.append(o)
+        else:
+            o.id = e.id
+            update.append(o)
+            old.append(e)
+    delete = [e for p_id, e in existing.items() if p_id not in amounts]
+    changed = create + update + delete
+    if not changed:
+        return set()
+
+    balance_changes = [(o.profile_id, o.created_time, o.amount)
+                       for o in create + update]
+    balance_changes += [(o.profile_id, o.created_time, -o.amount)
+                        for o in old + delete]
+    with transaction.atomic():
+        Transaction.objects.bulk_create(create)
+        Transaction.objects.bulk_update(
+            update, ['amount', 'period', 'time', 'note',
+                     'created_by', 'created_time'])
+        Transaction.objects.filter(id__in=[o.id for o in delete]).delete()
+        update_balance_snapshots(balance_changes)
+        update_transaction_rollups(
+            (o.session_id, o.period) for o in changed)
+        update_leaderboard(
+            transaction_leaderboard_changes(create + update) +
+            transaction_leaderboard_changes(old + delete, sign=-1))
+
+    logger.info("%s: Gem %s i opgørelse %s: %s", user, kind, session.pk,
+                json.dumps(dict(
+                    note=note,
+                    created={o.profile_id: str(o.amount) for o in create},
+                    updated={o.profile_id: str(o.amount) for o in update},
+                    deleted=sorted(o.profile_id for o in delete),
+                ), sort_keys=True))
+    return set(o.profile_id for o in changed)
+
+
+@section('compute_balance')
+def compute_balance(profile_ids=None, created_before=None, *,
+                    output_matrix=False, purchases_after=None):
+    balance = snapshot_balance(profile_ids, created_before)
     if output_matrix:
+        purchase_qs = Purchase.objects.all()
+        if created_before:
+            purchase_qs = purchase_qs.filter(
+                row__sheet__created_time__lt=created_before)
+        if profile_ids:
+            purchase_qs = purchase_qs.filter(row__profile_id__in=profile_ids)
+        purchase_qs = purchase_qs.exclude(row__profile_id=None)
+        transaction_qs = Transaction.objects.all()
+        if profile_ids:
+            transaction_qs = transaction_qs.filter(profile_id__in=profile_ids)
+        if created_before:
+            transaction_qs = transaction_qs.filter(
+                created_time__lt=created_before)
         if purchases_after:
             purchase_qs = purchase_qs.filter(
                 row__sheet__start_date__gte=purchases_after)
             transaction_qs = transaction_qs.filter(time__gt=purchases_after)
-        purchases = sum_matrix(purchase_qs, 'kind__name',
-                               'row__profile_id', 'count')
-        purchases.update(sum_matrix(transaction_qs, 'kind',
-                                    'profile_id', 'amount'))
+        # Purchase counts and transaction amounts in a single Aggregate
+        # with purchase kind names and transaction kinds as columns.
+        purchases = aggregate_matrix([
+            (purchase_qs, 'kind__name', 'row__profile_id', 'count'),
+            (transaction_qs, 'kind', 'profile_id', 'amount'),
+        ], places=4)
         return balance, purchases
     else:
         return balance
@@ -537,44 +1267,104 @@ class EmailTemplateInline(models.Model):
             return o
 
 
-def _process_inlines(body_html, cb):
+CID_PATTERN = r'([\'"])cid:regnskab-(\d+)-([a-zA-Z0-9-]+)([\'"])'
+
+
+class InlineCache:
+    '''
+    EmailTemplateInline objects referenced by cid:-URIs in email bodies.
+    load() fetches every inline referenced by a batch of bodies in one
+    query, and each inline is encoded as a MIME part only once, so the
+    part can be shared by all messages that show the image.
+    '''
+
+    def __init__(self):
+        # (pk, hash) -> EmailTemplateInline or None if it does not exist
+        self.inlines = {}
+        # hash -> MIMEBase
+        self.parts = {}
+
+    def load(self, bodies):
+        refs = set()
+        for body in bodies:
+            if body:
+                refs.update((int(pk), hash) for q1, pk, hash, q2
+                            in re.findall(CID_PATTERN, body))
+        refs -= self.inlines.keys()
+        if not refs:
+            return
+        qs = EmailTemplateInline.objects.filter(
+            pk__in=set(pk for pk, hash in refs))
+        found = {(o.pk, o.hash): o for o in qs}
+        for ref in refs:
+            self.inlines[ref] = found.get(ref)
+
+    def get(self, pk, hash):
+        key = (int(pk), hash)
+        if key not in self.inlines:
+            self.load(['"cid:regnskab-%s-%s"' % key])
+        return self.inlines[key]
+
+    def mime_part(self, inline):
+        try:
+            return self.parts[inline.hash]
+        except KeyError:
+            part = EmailMultiRelated().create_related(
+                inline.blob, inline.mime_type, inline.hash)
+            self.parts[inline.hash] = part
+            return part
+
+
+@functools.lru_cache(maxsize=64)
+def inline_data_uri(pk, hash):
     '''
-    Internal helper used by body_html_data_uris and body_html_inlines.
+    Return the data:-URI of an EmailTemplateInline, or None if it does
+    not exist. Inlines are never changed, so this is cached by hash.
+    '''
+    try:
+        inline = EmailTemplateInline.objects.get(pk=pk, hash=hash)
+    except EmailTemplateInline.DoesNotExist:
+        return None
+    return 'data:%s;base64,%s' % (
+        inline.mime_type, base64.b64encode(inline.blob).decode())
+
+
+def body_html_data_uris(body_html):
+    '''
+    Returns HTML with valid cid:-URIs replaced by data:-URIs.
     '''
     def repl(mo):
         q1, inline_pk, hash, q2 = mo.groups()
-        try:
-            inline = EmailTemplateInline.objects.get(
-                pk=inline_pk, hash=hash)
-        except EmailTemplateInline.DoesNotExist:
-            res = cb(None)
-            return mo.group() if res is None else q1 + res + q2
-        else:
-            return q1 + cb(inline) + q2
+        data_uri = inline_data_uri(int(inline_pk), hash)
+        return mo.group() if data_uri is None else q1 + data_uri + q2
 
-    pattern = r'([\'"])cid:regnskab-(\d+)-([a-zA-Z0-9-]+)([\'"])'
-    return re.sub(pattern, repl, body_html)
+    return re.sub(CID_PATTERN, repl, body_html)
 
 
-def body_html_inlines(body_html):
+def body_html_inlines(body_html, inlines=None):
     '''
     Returns (html, inlines), where `html` is the HTML body including
     images with cid:-URIs and `inlines` is a list mapping each
     "cid:foobar"-URI to ('foobar', <EmailTemplateInline object>).
+    Inlines are looked up in the given InlineCache if any.
     '''
     # Invisible GIF, https://stackoverflow.com/a/15960901/1570972
     invis = ('data:image/gif;base64,' +
              'R0lGODlhAQABAAAAACH5BAEAAAAALAAAAAABAAEAAAI=')
-    inlines = []
+    if inlines is None:
+        inlines = InlineCache()
+    inlines.load([body_html])
+    result = []
 
-    def cb(inline):
-        if inline is not None:
-            cid = inline.hash
-            inlines.append((cid, inline))
-            return 'cid:%s' % cid
-        return invis
+    def repl(mo):
+        q1, inline_pk, hash, q2 = mo.groups()
+        inline = inlines.get(inline_pk, hash)
+        if inline is None:
+            return q1 + invis + q2
+        result.append((inline.hash, inline))
+        return '%scid:%s%s' % (q1, inline.hash, q2)
 
-    return _process_inlines(body_html, cb), inlines
+    return re.sub(CID_PATTERN, repl, body_html), result
 
 
 class EmailTemplate(models.Model):
@@ -611,17 +1401,24 @@ class EmailTemplate(models.Model):
         if self.name == '':
             raise AssertionError('make_template_editable: anonymous template')
         sessions = Session.objects.filter(email_template_id=self.id)
-        if sessions.exists():
+        # Compactly stored emails must keep rendering the old text.
+        emails = [Email.objects.filter(email_template_id=self.id),
+                  NewsletterEmail.objects.filter(email_template_id=self.id)]
+        if sessions.exists() or any(qs.exists() for qs in emails):
             # Move Session objects pointing to self to a new anonymous
-            # EmailTemplate.
+            # EmailTemplate. Copy the saved text, since a ModelForm may
+            # already have changed self.
+            old = EmailTemplate.objects.get(pk=self.pk)
             backup = EmailTemplate(
                 name='',
-                subject=self.subject,
-                body=self.body,
-                format=self.format,
-                markup=self.markup,
+                subject=old.subject,
+                body=old.body,
+                format=old.format,
+                markup=old.markup,
                 created_by=user)
             backup.save()
+            for qs in emails:
+                qs.update(email_template=backup)
             sessions.update(email_template=backup)
 
     def clean(self):
@@ -651,12 +1448,7 @@ class EmailTemplate(models.Model):
         '''
         Returns HTML with valid cid:-URIs replaced by data:-URIs.
         '''
-        def cb(inline):
-            if inline is not None:
-                return 'data:%s;base64,%s' % (
-                    inline.mime_type, base64.b64encode(inline.blob).decode())
-
-        return _process_inlines(self.body_html(), cb)
+        return body_html_data_uris(self.body_html())
 
     def body_html(self):
         '''
@@ -680,11 +1472,58 @@ class EmailTemplate(models.Model):
         else:
             raise ValueError(self.markup)
 
+    def compile(self, variables=None):
+        '''
+        Return the subject and bodies as emailtemplate.Template objects.
+        Raises KeyError if a variable not in `variables` is used.
+        '''
+        return compile_email_template(self.subject, self.body, self.markup,
+                                      frozenset(variables or ()) or None)
+
     def __str__(self):
         return self.name or str(self.created_time)
 
 
-def regenerate_emails(email_set):
+class CompiledEmailTemplate(NamedTuple):
+    subject: Any
+    body_plain: Any
+    # None for plain text templates
+    body_html: Any
+
+    @property
+    def variables(self):
+        return set().union(*(t.variables for t in self if t is not None))
+
+
+@functools.lru_cache(maxsize=32)
+def compile_email_template(subject, body, markup, variables):
+    '''
+    Parse an email template once per revision. The cache is keyed on the
+    template text, so the HTML to plain text conversion is only done
+    when the template is changed.
+    '''
+    from tkweb.apps.regnskab.emailtemplate import Template
+
+    template = EmailTemplate(subject=subject, body=body, markup=markup)
+    body_html = None
+    if markup == EmailTemplate.HTML:
+        body_html = Template(template.body_html(), variables)
+    return CompiledEmailTemplate(
+        subject=Template(subject, variables),
+        body_plain=Template(template.body_plain(), variables),
+        body_html=body_html)
+
+
+@section('regenerate_emails')
+def regenerate_emails(email_set, profile_ids=None):
+    '''
+    Create, update or delete the Email objects of `email_set`.
+
+    If `profile_ids` is given, only the emails of those profiles are
+    regenerated. This is used after sheet rows or transactions have been
+    saved, since those only change the email context of the profiles they
+    belong to. A change to the EmailTemplate requires a full pass.
+    '''
     assert isinstance(email_set, (Session, Newsletter))
 
     if email_set.email_template is None:
@@ -701,25 +1540,40 @@ def regenerate_emails(email_set):
             raise ValidationError(
                 '#SKJULNUL:# kan ikke bruges i HTML-emails')
 
-    recipients = email_set.get_recipient_data()
+    if profile_ids is not None:
+        profile_ids = set(profile_ids) - {None}
+        if not profile_ids:
+            return
+
+    try:
+        template = email_set.email_template.compile(email_set.email_variables)
+    except KeyError as exn:
+        raise ValidationError("Emailskabelon har en ukendt variabel %r" %
+                              exn.args[0])
+
+    recipients = email_set.get_recipient_data(profile_ids)
 
     for profile_id, profile_data in recipients.items():
-        regenerate_email(email_set, profile_data)
+        regenerate_email(email_set, profile_data, template)
 
 
-def get_base_recipient_data(email_set):
+def get_base_recipient_data(email_set, profile_ids=None):
     assert isinstance(email_set, (Session, Newsletter))
     recipients = {}
-    profiles = get_profiles_title_status(period=email_set.period)
+    profiles = get_profiles_title_status(period=email_set.period,
+                                         profile_ids=profile_ids)
     for profile in profiles:
         recipients[profile.id] = dict(profile=profile, title=profile.title)
-    initial_balances = compute_balance(created_before=email_set.created_time)
+    initial_balances = compute_balance(profile_ids=profile_ids,
+                                       created_before=email_set.created_time)
     for p_id, initial_balance in initial_balances.items():
         recipients[p_id]['initial_balance'] = initial_balance
-    for p_id, balance in compute_balance().items():
+    for p_id, balance in compute_balance(profile_ids=profile_ids).items():
         recipients[p_id]['balance'] = balance
 
     emails = email_set.email_set.all()
+    if profile_ids is not None:
+        emails = emails.filter(profile_id__in=profile_ids)
     emails = emails.order_by('profile_id')
     for email in emails:
         recipients[email.profile_id]['email'] = email
@@ -734,6 +1588,12 @@ def get_base_recipient_data(email_set):
     return recipients
 
 
+# Variables in the context returned by get_base_email_context
+BASE_EMAIL_VARIABLES = frozenset([
+    'TITEL ', 'NAVN', 'GAELDFOER', 'GAELD', 'MAXGAELD', 'INKA', 'GINKA',
+])
+
+
 def get_base_email_context(email_set, profile_data):
     assert isinstance(email_set, (Session, Newsletter))
 
@@ -762,7 +1622,7 @@ def get_base_email_context(email_set, profile_data):
     return context
 
 
-def regenerate_email(email_set, profile_data):
+def regenerate_email(email_set, profile_data, template=None):
     assert isinstance(email_set, (Session, Newsletter))
 
     if isinstance(email_set, Session):
@@ -772,7 +1632,8 @@ def regenerate_email(email_set, profile_data):
     else:
         raise TypeError(type(email_set))
 
-    from tkweb.apps.regnskab.emailtemplate import format
+    if template is None:
+        template = email_set.email_template.compile()
     context = email_set.get_email_context(profile_data)
     existing_email = profile_data.get('email')
     if context is None:
@@ -782,29 +1643,43 @@ def regenerate_email(email_set, profile_data):
     profile = profile_data['profile']
 
     email_fields = ('subject', 'body_plain', 'body_html',
-                    'recipient_name', 'recipient_email')
+                    'recipient_name', 'recipient_email',
+                    'email_template_id', 'context_hash')
+    email = email_class(
+        profile_id=profile.id,
+        recipient_name=profile.name,
+        recipient_email=profile.email,
+    )
+    email.email_set = email_set
     try:
-        email = email_class(
-            profile=profile,
-            subject=format(email_set.email_template.subject, context),
-            body_plain=format(email_set.email_template.body_plain(), context),
-            recipient_name=profile.name,
-            recipient_email=profile.email,
-        )
-        email.email_set = email_set
-        if email_set.email_template.markup == EmailTemplate.HTML:
-            email.body_html = format(
-                email_set.email_template.body_html(), context)
+        # A new EmailTemplate is only saved after its emails are generated.
+        if (getattr(settings, 'REGNSKAB_COMPACT_EMAILS', False) and
+                email_set.email_template.pk is not None):
+            email.subject = email.body_plain = ''
+            email.email_template = email_set.email_template
+            email.context = {k: context[k]
+                             for k in sorted(template.variables)}
+            email.context_hash = email_context_hash(email.context)
+        else:
+            email.subject = template.subject.render(context)
+            email.body_plain = template.body_plain.render(context)
+            if template.body_html is not None:
+                email.body_html = template.body_html.render(context)
     except KeyError as exn:
         raise ValidationError("Emailskabelon har en ukendt variabel %r" %
                               exn.args[0])
     if existing_email:
         changed_keys = [k for k in email_fields
                         if getattr(email, k) != getattr(existing_email, k)]
-        if changed_keys:
-            email.pk = existing_email.pk
-        else:
+        if not changed_keys:
             return
+        if 'context_hash' in changed_keys:
+            changed_keys.append('context')
+        # Update only the generated fields, keeping e.g. send_time.
+        for k in changed_keys:
+            setattr(existing_email, k, getattr(email, k))
+        existing_email.save(update_fields=changed_keys)
+        return
     email.save()
 
 
@@ -819,6 +1694,12 @@ class Session(models.Model):
                                    null=True, blank=False)
     created_time = models.DateTimeField(auto_now_add=True)
 
+    email_variables = BASE_EMAIL_VARIABLES | {
+        'BETALT', 'ANDET', 'POEL', 'PVAND', 'PGULD', 'PKASSER', 'POELKS',
+        'PGULDKS', 'PVANDKS', 'OEL', 'VAND', 'GULD', 'OELKS', 'VANDKS',
+        'GULDKS', 'KASSER',
+    }
+
     class Meta:
         get_latest_by = 'created_time'
 
@@ -826,17 +1707,19 @@ class Session(models.Model):
     def sent(self):
         return bool(self.send_time)
 
-    def regenerate_emails(self):
-        regenerate_emails(self)
+    def regenerate_emails(self, profile_ids=None):
+        regenerate_emails(self, profile_ids)
 
-    def get_recipient_data(self):
-        recipients = get_base_recipient_data(self)
+    def get_recipient_data(self, profile_ids=None):
+        recipients = get_base_recipient_data(self, profile_ids)
 
-        transactions = self.transaction_set.all().order_by('profile_id')
-        transaction_sums = sum_vector(transactions, 'profile_id', 'amount')
-        payment_sums = sum_vector(
-            transactions.filter(kind=Transaction.PAYMENT),
-            'profile_id', 'amount')
+        transactions = self.transaction_set.all()
+        if profile_ids is not None:
+            transactions = transactions.filter(profile_id__in=profile_ids)
+        tmatrix = aggregate_matrix(
+            [(transactions, 'kind', 'profile_id', 'amount')], places=2)
+        transaction_sums = tmatrix.row_sums()
+        payment_sums = tmatrix.column(Transaction.PAYMENT)
         for p_id, transaction_sum in transaction_sums.items():
             recipients[p_id]['transaction_sum'] = transaction_sum
         for p_id, payment_sum in payment_sums.items():
@@ -853,8 +1736,11 @@ class Session(models.Model):
         purchases = Purchase.objects.filter(
             row__sheet__session=self)
         purchases = purchases.exclude(row__profile=None)
-        pmatrix = sum_matrix(purchases, 'row__profile_id', 'kind__name',
-                             F('count'))
+        if profile_ids is not None:
+            purchases = purchases.filter(row__profile_id__in=profile_ids)
+        pmatrix = aggregate_matrix(
+            [(purchases, 'kind__name', 'row__profile_id', 'count')],
+            places=4).row_dicts()
         for p_id, purchase_count in pmatrix.items():
             recipients[p_id]['purchase_count'] = purchase_count
 
@@ -925,6 +1811,8 @@ class Newsletter(models.Model):
                                    null=True, blank=False)
     created_time = models.DateTimeField(auto_now_add=True)
 
+    email_variables = BASE_EMAIL_VARIABLES
+
     class Meta:
         get_latest_by = 'created_time'
 
@@ -932,8 +1820,8 @@ class Newsletter(models.Model):
     def sent(self):
         return bool(self.send_time)
 
-    def regenerate_emails(self):
-        regenerate_emails(self)
+    def regenerate_emails(self, profile_ids=None):
+        regenerate_emails(self, profile_ids)
 
     def get_email_context(self, profile_data):
         profile = profile_data['profile']
@@ -941,12 +1829,79 @@ class Newsletter(models.Model):
             return
         return get_base_email_context(self, profile_data)
 
-    def get_recipient_data(self):
-        return get_base_recipient_data(self)
+    def get_recipient_data(self, profile_ids=None):
+        return get_base_recipient_data(self, profile_ids)
+
 
+def email_context_hash(context):
+    data = json.dumps(context, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
 
-def to_message(email):
+
+def render_email(email):
+    '''
+    Fill in the subject and bodies of an email stored compactly as an
+    EmailTemplate and a context (see REGNSKAB_COMPACT_EMAILS).
+    Other emails, and emails already rendered, are returned unchanged.
+    '''
+    assert isinstance(email, (Email, NewsletterEmail))
+    if email.context is None or getattr(email, '_rendered', False):
+        return email
+    template = email.email_template.compile()
+    email.subject = template.subject.render(email.context)
+    email.body_plain = template.body_plain.render(email.context)
+    if template.body_html is not None:
+        email.body_html = template.body_html.render(email.context)
+    email._rendered = True
+    return email
+
+
+def compact_email(email, email_template):
+    '''
+    Store an email compactly if its text can be rendered from
+    email_template. Returns True if the email was changed.
+    '''
+    assert isinstance(email, (Email, NewsletterEmail))
+    if email.context is not None:
+        return False
+    template = email_template.compile()
+    fields = [(template.subject, email.subject),
+              (template.body_plain, email.body_plain)]
+    if (template.body_html is None) != (email.body_html is None):
+        return False
+    if template.body_html is not None:
+        fields.append((template.body_html, email.body_html))
+    context = {}
+    for t, text in fields:
+        values = t.match(text)
+        if values is None:
+            return False
+        for k, v in values.items():
+            if context.setdefault(k, v) != v:
+                return False
+    # Variables that only occur on hidden #SKJULNUL:# lines
+    for k in template.variables - context.keys():
+        context[k] = '0'
+    context = {k: context[k] for k in sorted(context)}
+    if any(t.render(context) != text for t, text in fields):
+        return False
+    email.subject = email.body_plain = ''
+    email.body_html = None
+    email.email_template = email_template
+    email.context = context
+    email.context_hash = email_context_hash(context)
+    email.save(update_fields=['subject', 'body_plain', 'body_html',
+                              'email_template', 'context', 'context_hash'])
+    return True
+
+
+def to_message(email, inlines=None):
+    '''
+    Build the EmailMessage of an Email or NewsletterEmail. Pass the same
+    InlineCache when building many messages to share their inline images.
+    '''
     assert isinstance(email, (Email, NewsletterEmail))
+    render_email(email)
 
     sender = 'INKA@TAAGEKAMMERET.dk'
     list_requests = 'admin@TAAGEKAMMERET.dk'
@@ -981,10 +1936,13 @@ def to_message(email):
             reply_to=reply_to,
             to=to,
             headers=headers)
-        html, relateds = body_html_inlines(email.body_html)
+        if inlines is None:
+            inlines = InlineCache()
+        html, relateds = body_html_inlines(email.body_html, inlines)
         msg.attach_alternative(html, 'text/html')
-        for cid, r in relateds:
-            msg.attach_related(r.blob, r.mime_type, cid)
+        # Attach each image once, even if it is shown several times.
+        for cid, r in dict(relateds).items():
+            msg.attach_related(inlines.mime_part(r))
         return msg
 
     return EmailMessage(
@@ -1001,15 +1959,15 @@ def email_body_html_data_uris(email):
     Returns HTML with valid cid:-URIs replaced by data:-URIs.
     '''
     assert isinstance(email, (Email, NewsletterEmail))
+    render_email(email)
     if email.body_html is None:
         return format_html('<pre style="white-space: pre-wrap">{}</pre>',
                            email.body_plain)
-    def cb(inline):
-        if inline is not None:
-            return 'data:%s;base64,%s' % (
-                inline.mime_type, base64.b64encode(inline.blob).decode())
+    return body_html_data_uris(email.body_html)
+
 
-    return _process_inlines(email.body_html, cb)
+def email_row_image_upload_to(instance, filename):
+    return 'krydser/%s/%s' % (instance.session_id, filename)
 
 
 class Email(models.Model):
@@ -1022,6 +1980,21 @@ class Email(models.Model):
     body_html = models.TextField(blank=True, null=True)
     recipient_name = models.CharField(max_length=255)
     recipient_email = models.CharField(max_length=255)
+    # If REGNSKAB_COMPACT_EMAILS is set, subject and bodies are left empty
+    # and rendered from email_template and context by render().
+    # PROTECT, since deleting the template would lose the text; the
+    # emails are deleted along with their Session or Newsletter first.
+    email_template = models.ForeignKey(EmailTemplate,
+                                       on_delete=models.PROTECT,
+                                       null=True, blank=True,
+                                       related_name='+')
+    context = JSONField(null=True, blank=True)
+    context_hash = models.CharField(max_length=64, blank=True)
+    # krydser.png attachment, see images.attachments.build_row_images.
+    row_image = models.FileField(upload_to=email_row_image_upload_to,
+                                 blank=True, null=True)
+    row_image_key = models.CharField(max_length=40, blank=True)
+    send_time = models.DateTimeField(null=True, blank=True)
 
     @property
     def email_set(self):
@@ -1031,8 +2004,11 @@ class Email(models.Model):
     def email_set(self, v):
         self.session = v
 
-    def to_message(self):
-        return to_message(self)
+    def render(self):
+        return render_email(self)
+
+    def to_message(self, inlines=None):
+        return to_message(self, inlines)
 
     def body_html_data_uris(self):
         return email_body_html_data_uris(self)
@@ -1051,6 +2027,17 @@ class NewsletterEmail(models.Model):
     body_html = models.TextField(blank=True, null=True)
     recipient_name = models.CharField(max_length=255)
     recipient_email = models.CharField(max_length=255)
+    # If REGNSKAB_COMPACT_EMAILS is set, subject and bodies are left empty
+    # and rendered from email_template and context by render().
+    # PROTECT, since deleting the template would lose the text; the
+    # emails are deleted along with their Session or Newsletter first.
+    email_template = models.ForeignKey(EmailTemplate,
+                                       on_delete=models.PROTECT,
+                                       null=True, blank=True,
+                                       related_name='+')
+    context = JSONField(null=True, blank=True)
+    context_hash = models.CharField(max_length=64, blank=True)
+    send_time = models.DateTimeField(null=True, blank=True)
 
     @property
     def email_set(self):
@@ -1060,8 +2047,11 @@ class NewsletterEmail(models.Model):
     def email_set(self, v):
         self.newsletter = v
 
-    def to_message(self):
-        return to_message(self)
+    def render(self):
+        return render_email(self)
+
+    def to_message(self, inlines=None):
+        return to_message(self, inlines)
 
     def body_html_data_uris(self):
         return email_body_html_data_uris(self)
@@ -1070,7 +2060,80 @@ class NewsletterEmail(models.Model):
         return '%s <%s>' % (self.recipient_name, self.recipient_email)
 
 
-def get_profiles_title_status(period=None, time=None):
+class CacheVersion(models.Model):
+    '''
+    Version counter of a cached index, incremented when the data the index
+    is built from changes. Kept in the database so that all processes
+    see the same version regardless of the cache backend.
+    '''
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '%s v%s' % (self.name, self.version)
+
+
+def get_cache_version(name):
+    try:
+        return CacheVersion.objects.values_list(
+            'version', flat=True).get(name=name)
+    except CacheVersion.DoesNotExist:
+        return 0
+
+
+def bump_cache_version(name):
+    updated = CacheVersion.objects.filter(name=name).update(
+        version=F('version') + 1)
+    if not updated:
+        CacheVersion.objects.get_or_create(name=name,
+                                           defaults=dict(version=1))
+
+
+TITLE_INDEX = 'title_index'
+TITLE_INDEX_TIMEOUT = 24 * 60 * 60
+
+
+class ProfileRecord(NamedTuple):
+    '''
+    Immutable view of a Profile with its titles and sheet status,
+    as returned by get_profiles_title_status.
+    '''
+    id: int
+    name: str
+    email: str
+    titles: Tuple[Any, ...]
+    title: Optional[Any]
+    status: Optional[SheetStatus]
+    title_name: str
+    in_current: bool
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return self.name
+
+
+def invalidate_title_index():
+    bump_cache_version(TITLE_INDEX)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+@receiver(post_save, sender=Title)
+@receiver(post_delete, sender=Title)
+@receiver(post_save, sender=Alias)
+@receiver(post_delete, sender=Alias)
+@receiver(post_save, sender=SheetStatus)
+@receiver(post_delete, sender=SheetStatus)
+def title_index_changed(sender, instance, signal, **kwargs):
+    invalidate_title_index()
+    from tkweb.apps.regnskab.search import update_search_index
+    update_search_index(instance, deleted=signal is post_delete)
+
+
+def build_title_index(period=None, time=None):
     def profile_key(p):
         if p.status is None:
             return (3, p.name)
@@ -1091,29 +2154,64 @@ def get_profiles_title_status(period=None, time=None):
     statuses = {pk: max(s, key=lambda s: (s.end_time is None, s.end_time))
                 for pk, s in groups}
 
-    profiles = list(Profile.objects.all())
-    for p in profiles:
-        p.status = statuses.get(p.id)
-        p.titles = titles.get(p.id, [])
-        p.title = p.titles[0] if p.titles else None
-        if p.title:
-            p.title_name = (
+    profiles = []
+    for p_id, name, email in Profile.objects.values_list('id', 'name',
+                                                         'email'):
+        status = statuses.get(p_id)
+        p_titles = tuple(titles.get(p_id, ()))
+        title = p_titles[0] if p_titles else None
+        if title:
+            title_name = (
                 '%s %s' %
-                (tk.prefix(p.title, period or config.GFYEAR, type='unicode')
-                 if p.title.period else p.title.root,
-                 p.name))
+                (tk.prefix(title, period or config.GFYEAR, type='unicode')
+                 if title.period else title.root,
+                 name))
         else:
-            p.title_name = p.name
-        p.in_current = (p.status and
-                        (p.status.end_time is None or
-                         (time is not None and p.status.end_time > time)))
+            title_name = name
+        in_current = bool(status and
+                          (status.end_time is None or
+                           (time is not None and status.end_time > time)))
+        profiles.append(ProfileRecord(
+            id=p_id, name=name, email=email, titles=p_titles, title=title,
+            status=status, title_name=title_name, in_current=in_current))
     profiles.sort(key=profile_key)
     return profiles
 
 
+@section('get_profiles_title_status')
+def get_profiles_title_status(period=None, time=None, profile_ids=None):
+    '''
+    List of ProfileRecord objects sorted by title, status and name.
+
+    The list for each (period, time) is built once by build_title_index
+    and cached until a Profile, Title, Alias or SheetStatus is changed.
+    '''
+    gfyear = period or config.GFYEAR
+    key = 'regnskab:%s:%s:%s:%s:%s' % (
+        TITLE_INDEX, get_cache_version(TITLE_INDEX), period, gfyear,
+        time.isoformat() if time is not None else '')
+    profiles = cache.get(key)
+    if profiles is None:
+        profiles = build_title_index(period, time)
+        cache.set(key, profiles, TITLE_INDEX_TIMEOUT)
+    if profile_ids is not None:
+        profile_ids = set(profile_ids)
+        profiles = [p for p in profiles if p.id in profile_ids]
+    return list(profiles)
+
+
 class SheetImage(models.Model):
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATE = [
+        (PENDING, 'Venter'),
+        (RUNNING, 'Behandles'),
+        (DONE, 'Færdig'),
+        (FAILED, 'Fejlet'),
+    ]
+
     sheet = models.ForeignKey(Sheet, on_delete=models.CASCADE)
     page = models.PositiveIntegerField()
+    state = models.CharField(max_length=10, choices=STATE, default=DONE)
 
     parameters = JSONField(default={})
     quad = JSONField(default=[])
@@ -1140,19 +2238,59 @@ class SheetImage(models.Model):
             self.verified_time = timezone.now()
             self.verified_by = verified_by
 
+    def image_file_hash(self):
+        try:
+            return self._image_file_hash
+        except AttributeError:
+            pass
+        try:
+            sheet = self.sheet
+        except ObjectDoesNotExist:
+            self._image_file_hash = None
+        else:
+            self._image_file_hash = sheet.image_file_hash()
+        return self._image_file_hash
+
     def get_image(self):
         try:
             return self._image
         except AttributeError:
             pass
 
+        from tkweb.apps.regnskab.images.cache import cached_page
         from tkweb.apps.regnskab.images.utils import load_pdf_page
 
-        with self.sheet.image_file_name() as filename:
-            self._image = load_pdf_page(filename, self.page - 1)
+        def load():
+            with self.sheet.image_file_name() as filename:
+                return load_pdf_page(filename, self.page - 1)
 
+        self._image = cached_page(self.image_file_hash(), self.page, load)
         return self._image
 
+    def get_projected_image(self):
+        quad = self.quad
+        try:
+            image_quad, image = self._projected_image
+        except AttributeError:
+            pass
+        else:
+            if image_quad == quad:
+                return image
+
+        from tkweb.apps.regnskab.images.cache import cached_projected_page
+        from tkweb.apps.regnskab.images.quadrilateral import (
+            Quadrilateral, extract_quadrilateral,
+        )
+
+        def project():
+            return extract_quadrilateral(self.get_image(),
+                                         Quadrilateral(quad))
+
+        image = cached_projected_page(
+            self.image_file_hash(), self.page, quad, project)
+        self._projected_image = (quad, image)
+        return image
+
     def compute_person_counts(self):
         col_bounds = [0, 15, 21, 36]
 
@@ -1178,3 +2316,32 @@ class SheetImage(models.Model):
             res.append(groups)
             i = j
         self.person_counts = res
+
+
+class ExtractionJob(models.Model):
+    '''
+    Request to run image extraction on the scanned PDF of a Sheet.
+    Jobs are processed by the "extractworker" management command;
+    see images.jobs.
+    '''
+    PENDING, RUNNING = SheetImage.PENDING, SheetImage.RUNNING
+    DONE, FAILED = SheetImage.DONE, SheetImage.FAILED
+    STATE = SheetImage.STATE
+
+    sheet = models.ForeignKey(Sheet, on_delete=models.CASCADE)
+    state = models.CharField(max_length=10, choices=STATE, default=PENDING)
+    error = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    start_time = models.DateTimeField(blank=True, null=True)
+    end_time = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created_time']
+        get_latest_by = 'created_time'
+
+    @property
+    def finished(self):
+        return self.state in (ExtractionJob.DONE, ExtractionJob.FAILED)
+
+    def __str__(self):
+        return '%s %s' % (self.sheet, self.get_state_display())
@@ -0,0 +1,226 @@
+'''
+Per-request SQL and timing instrumentation.
+
+ProfilingMiddleware records the number of queries, the total SQL time,
+the wall time and (if REGNSKAB_PROFILING_MEMORY is set) the peak memory
+of each request to a regnskab view. Hot helpers are wrapped in
+section(name), which records the same numbers for the part of the
+request spent in the helper. Each request is written as a JSON line to
+the 'regnskab.profiling' logger and kept in a bounded in-process list,
+which is shown by the ProfilingReport view.
+
+The middleware is only active if REGNSKAB_PROFILING is set.
+Outside of a profiled request, section() does nothing.
+'''
+
+import json
+import time
+import logging
+import threading
+import tracemalloc
+import contextlib
+from collections import Counter, deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger('regnskab.profiling')
+
+
+MAX_RECORDS = 200
+
+_local = threading.local()
+_records_lock = threading.Lock()
+records = deque(maxlen=MAX_RECORDS)
+
+
+class Frame:
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.sql_time = 0.0
+        self.start = time.perf_counter()
+        self.wall_time = None
+        self.start_memory = self.peak_memory = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.start_memory = self.peak_memory = current
+
+    def stop(self):
+        self.wall_time = time.perf_counter() - self.start
+        if self.start_memory is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak_memory = max(self.peak_memory, peak)
+
+    def as_dict(self):
+        memory = (None if self.start_memory is None
+                  else self.peak_memory - self.start_memory)
+        return dict(queries=self.queries,
+                    sql_time=round(self.sql_time, 4),
+                    wall_time=round(self.wall_time, 4),
+                    peak_memory=memory)
+
+
+class RequestProfile:
+    def __init__(self, name):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.root = Frame(name)
+        self.stack = [self.root]
+        self.sections = {}
+        self.sql = Counter()
+
+    def execute(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            for frame in self.stack:
+                frame.queries += 1
+                frame.sql_time += duration
+            self.sql[sql] += 1
+
+    def push(self, name):
+        if tracemalloc.is_tracing():
+            # Peak memory is tracked per frame, so record the peak so far
+            # in the open frames before resetting it for the new frame.
+            current, peak = tracemalloc.get_traced_memory()
+            for frame in self.stack:
+                frame.peak_memory = max(frame.peak_memory, peak)
+            tracemalloc.reset_peak()
+        frame = Frame(name)
+        self.stack.append(frame)
+        return frame
+
+    def pop(self, frame):
+        assert self.stack[-1] is frame
+        self.stack.pop()
+        frame.stop()
+        s = self.sections.setdefault(frame.name, dict(
+            calls=0, queries=0, sql_time=0.0, wall_time=0.0,
+            peak_memory=None))
+        d = frame.as_dict()
+        s['calls'] += 1
+        s['queries'] += d['queries']
+        s['sql_time'] += d['sql_time']
+        s['wall_time'] += d['wall_time']
+        if d['peak_memory'] is not None:
+            s['peak_memory'] = max(s['peak_memory'] or 0, d['peak_memory'])
+
+    def as_dict(self):
+        d = dict(view=self.root.name, **self.root.as_dict())
+        d['duplicate_queries'] = sum(n - 1 for n in self.sql.values())
+        d['sections'] = self.sections
+        return d
+
+
+class section(contextlib.ContextDecorator):
+    '''
+    Record queries, SQL time, wall time and peak memory under the given
+    name in the current request profile. Can be used as a decorator.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = self.frame = None
+
+    def _recreate_cm(self):
+        # Each call of a decorated function gets its own instance.
+        return type(self)(self.name)
+
+    def __enter__(self):
+        self.profile = getattr(_local, 'profile', None)
+        if self.profile is not None:
+            self.frame = self.profile.push(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.pop(self.frame)
+        return False
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'REGNSKAB_PROFILING', False):
+            raise MiddlewareNotUsed()
+        if (getattr(settings, 'REGNSKAB_PROFILING_MEMORY', False) and
+                not tracemalloc.is_tracing()):
+            tracemalloc.start()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = _local.profile = RequestProfile(request.path)
+        try:
+            with connection.execute_wrapper(profile.execute):
+                response = self.get_response(request)
+        finally:
+            del _local.profile
+        profile.root.stop()
+        match = request.resolver_match
+        if match is None or 'regnskab' not in match.namespaces:
+            return response
+        profile.root.name = match.view_name
+        record = profile.as_dict()
+        record.update(path=request.path, method=request.method,
+                      status=response.status_code,
+                      time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        logger.info("%s", json.dumps(record, sort_keys=True))
+        with _records_lock:
+            records.append(record)
+        return response
+
+
+def get_report():
+    '''
+    The recorded requests of this process (newest first) and a summary
+    per view sorted by total wall time.
+    '''
+    with _records_lock:
+        recent = list(records)
+    recent.reverse()
+    views = {}
+    for r in recent:
+        v = views.setdefault(r['view'], dict(
+            view=r['view'], requests=0, queries=0, max_queries=0,
+            sql_time=0.0, wall_time=0.0, max_wall_time=0.0))
+        v['requests'] += 1
+        v['queries'] += r['queries']
+        v['max_queries'] = max(v['max_queries'], r['queries'])
+        v['sql_time'] += r['sql_time']
+        v['wall_time'] += r['wall_time']
+        v['max_wall_time'] = max(v['max_wall_time'], r['wall_time'])
+    summary = sorted(views.values(), key=lambda v: -v['wall_time'])
+    for v in summary:
+        v['mean_queries'] = v['queries'] / v['requests']
+        v['mean_wall_time'] = v['wall_time'] / v['requests']
+    return recent, summary
+
+
+class QueryBudgetMixin:
+    '''
+    TestCase mixin for asserting an upper bound on the number of queries
+    a view uses, so that N+1 query regressions fail the tests.
+    '''
+
+    @contextlib.contextmanager
+    def assertQueryBudget(self, budget):
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        n = len(context.captured_queries)
+        if n > budget:
+            queries = '\n'.join(
+                '%d. %s' % (i, q['sql'])
+                for i, q in enumerate(context.captured_queries, 1))
+            self.fail('%d queries executed, budget is %d\n%s' %
+                      (n, budget, queries))
+
+    def assertViewQueryBudget(self, budget, url, **kwargs):
+        with self.assertQueryBudget(budget):
+            response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response
@@ -0,0 +1,251 @@
+'''
+In-memory search index used by ProfileSearch.
+
+The index holds the name of every profile and the input title of every
+alias and title (as formatted by tk.prefix for a given GFYEAR). Exact
+matches are looked up in dicts, substring matches are found through
+postings from n-grams to entries, and difflib ratios are only computed
+for the entries sharing the most n-grams with the query instead of for
+every row in the database.
+
+The index is kept per process and is tagged with the version of the
+title index (see models.get_cache_version). Changes saved in this
+process are applied to the index by update_search_index, and changes
+made elsewhere (in other processes or by bulk writes) cause the index
+to be rebuilt on the next search.
+'''
+
+import difflib
+import threading
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import tktitler as tk
+
+from tkweb.apps.regnskab.models import (
+    Alias, Profile, SheetStatus, Title, TITLE_INDEX, get_cache_version,
+)
+
+
+MAX_RESULTS = 50
+# Number of entries for which difflib ratios are computed
+FUZZY_CANDIDATES = 200
+NGRAM = 3
+
+ALIAS, TITLE, PROFILE = 'alias', 'title', 'profile'
+
+
+class Entry(NamedTuple):
+    key: Tuple[str, int]
+    profile_id: int
+    text: str
+    # Aliases with an end_time are not shown when searching current people
+    active: bool = True
+    # Title.FU roots other than FUAN, which match the bare root
+    fu_root: Optional[str] = None
+
+
+def ngrams(s: str) -> Set[str]:
+    return {s[i:i + n]
+            for n in range(1, NGRAM + 1)
+            for i in range(len(s) - n + 1)}
+
+
+def query_ngrams(q: str) -> Set[str]:
+    n = min(NGRAM, len(q))
+    return {q[i:i + n] for i in range(len(q) - n + 1)}
+
+
+def alias_entry(o: Alias) -> Entry:
+    return Entry(key=(ALIAS, o.pk), profile_id=o.profile_id,
+                 text=tk.prefix(o) if o.period else o.root,
+                 active=o.end_time is None)
+
+
+def title_entry(o: Title) -> Entry:
+    fu_root = o.root if o.kind == Title.FU and o.root != 'FUAN' else None
+    return Entry(key=(TITLE, o.pk), profile_id=o.profile_id,
+                 text=tk.prefix(o) if o.period else o.root,
+                 fu_root=fu_root)
+
+
+class SearchIndex:
+    def __init__(self, gfyear: int, version: int) -> None:
+        self.gfyear = gfyear
+        self.version = version
+        self.entries = {}  # type: Dict[Tuple[str, int], Entry]
+        # n-gram of lowercased alias or profile name -> keys
+        self.postings = {}  # type: Dict[str, Set[Tuple[str, int]]]
+        # lowercased alias -> keys
+        self.alias_exact = {}  # type: Dict[str, Set[Tuple[str, int]]]
+        # title with $ replaced by S -> keys
+        self.title_exact = {}  # type: Dict[str, Set[Tuple[str, int]]]
+        self.fu_roots = {}  # type: Dict[str, Set[Tuple[str, int]]]
+        # word of lowercased profile name -> keys
+        self.words = {}  # type: Dict[str, Set[Tuple[str, int]]]
+        # Profiles with a SheetStatus with no end_time
+        self.current = set()  # type: Set[int]
+
+    @classmethod
+    def build(cls, gfyear: int, version: int) -> 'SearchIndex':
+        index = cls(gfyear, version)
+        with tk.set_gfyear(gfyear):
+            for o in Alias.objects.all():
+                index.add(alias_entry(o))
+            for o in Title.objects.all():
+                index.add(title_entry(o))
+        for p_id, name in Profile.objects.values_list('id', 'name'):
+            index.add(Entry(key=(PROFILE, p_id), profile_id=p_id, text=name))
+        index.current = set(SheetStatus.objects.filter(
+            end_time=None).values_list('profile_id', flat=True))
+        return index
+
+    def _dicts(self, entry: Entry):
+        kind = entry.key[0]
+        lower = entry.text.lower()
+        if kind == TITLE:
+            yield self.title_exact, entry.text.replace('$', 'S')
+            if entry.fu_root:
+                yield self.fu_roots, entry.fu_root
+            return
+        if kind == ALIAS:
+            yield self.alias_exact, lower
+        else:
+            for word in set(lower.split()):
+                yield self.words, word
+        for gram in ngrams(lower):
+            yield self.postings, gram
+
+    def add(self, entry: Entry) -> None:
+        self.remove(entry.key)
+        self.entries[entry.key] = entry
+        for d, k in self._dicts(entry):
+            d.setdefault(k, set()).add(entry.key)
+
+    def remove(self, key: Tuple[str, int]) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for d, k in self._dicts(entry):
+            keys = d[k]
+            keys.discard(key)
+            if not keys:
+                del d[k]
+
+    def search(self, q: str, only_current: bool) -> List[Tuple[str, int]]:
+        '''
+        Return (matched text, profile id) of the best matches of q,
+        ordered by the same sort keys as the old linear scan.
+        '''
+        def include(entry):
+            if not only_current:
+                return True
+            return entry.active and entry.profile_id in self.current
+
+        def lookup(d, k):
+            entries = (self.entries[key] for key in d.get(k, ()))
+            return [e for e in entries if include(e)]
+
+        q_lower = q.lower()
+        q_upper = q.upper()
+        results = []
+        seen = set()
+
+        def add(sort_key, entry):
+            seen.add(entry.key)
+            results.append((sort_key, (entry.text, entry.profile_id)))
+
+        for e in lookup(self.alias_exact, q_lower):
+            add((4, e.profile_id), e)
+        for e in lookup(self.title_exact, q_upper.replace('$', 'S')):
+            add((4, e.profile_id), e)
+        for e in lookup(self.fu_roots, q_upper):
+            if e.key not in seen:
+                add((3, e.profile_id), e)
+        for e in lookup(self.words, q_lower):
+            add((3, e.text, e.profile_id), e)
+
+        grams = query_ngrams(q_lower)
+        postings = sorted((self.postings.get(g, set()) for g in grams),
+                          key=len)
+        substring = set.intersection(*postings) if postings else set()
+        for key in substring:
+            e = self.entries[key]
+            if (key[0] == PROFILE and key not in seen and include(e) and
+                    q_lower in e.text.lower()):
+                add((2, e.text, e.profile_id), e)
+
+        # Fuzzy matches of aliases and profile names. Only the entries
+        # sharing the most n-grams with q can get a high ratio.
+        shared = Counter()
+        for g in grams:
+            shared.update(self.postings.get(g, ()))
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(q_lower)
+        n = 0
+        for key, count in shared.most_common():
+            if n >= FUZZY_CANDIDATES:
+                break
+            e = self.entries[key]
+            if key in seen or not include(e):
+                continue
+            n += 1
+            matcher.set_seq1(e.text.lower())
+            add((0, matcher.ratio(), e.text, key[1]), e)
+
+        results.sort(key=lambda r: r[0], reverse=True)
+        return [value for sort_key, value in results[:MAX_RESULTS]]
+
+
+_lock = threading.Lock()
+_index = None  # type: Optional[SearchIndex]
+
+
+def get_search_index(gfyear: int) -> SearchIndex:
+    global _index
+    version = get_cache_version(TITLE_INDEX)
+    with _lock:
+        index = _index
+        if (index is None or index.version != version or
+                index.gfyear != gfyear):
+            index = _index = SearchIndex.build(gfyear, version)
+        return index
+
+
+def update_search_index(instance, deleted: bool) -> None:
+    '''
+    Apply a saved or deleted Profile, Alias, Title or SheetStatus to the
+    index of this process. Must be called after the title index version
+    has been bumped for the change.
+    '''
+    global _index
+    with _lock:
+        index = _index
+        if index is None:
+            return
+        if get_cache_version(TITLE_INDEX) != index.version + 1:
+            # Another change has been made elsewhere
+            _index = None
+            return
+        index.version += 1
+        if isinstance(instance, SheetStatus):
+            p_id = instance.profile_id
+            index.current.discard(p_id)
+            if SheetStatus.objects.filter(profile_id=p_id,
+                                          end_time=None).exists():
+                index.current.add(p_id)
+            return
+        if isinstance(instance, Alias):
+            key, make_entry = (ALIAS, instance.pk), alias_entry
+        elif isinstance(instance, Title):
+            key, make_entry = (TITLE, instance.pk), title_entry
+        else:
+            key = (PROFILE, instance.pk)
+
+            def make_entry(o):
+                return Entry(key=key, profile_id=o.pk, text=o.name)
+        if deleted:
+            index.remove(key)
+        else:
+            with tk.set_gfyear(index.gfyear):
+                index.add(make_entry(instance))
@@ -5,7 +5,7 @@ class RegnskabSite(object):
         from django.conf import settings
         from django.conf.urls import url, include
         from tkweb.apps.regnskab import views
-        from tkweb.apps.regnskab.views import images, email
+        from tkweb.apps.regnskab.views import images, email, profiling
         from tkweb.apps import krydsliste
 
         urls = [
@@ -19,6 +19,9 @@ class RegnskabSite(object):
                 name='sheet_update'),
             url(r'^sheet/(?P<pk>\d+)/delete/$', views.SheetDelete.as_view(),
                 name='sheet_delete'),
+            url(r'^sheet/(?P<pk>\d+)/extract/$',
+                images.SheetExtractionProgress.as_view(),
+                name='sheet_extraction_progress'),
             url(r'^template/$', views.EmailTemplateList.as_view(),
                 name='email_template_list'),
             url(r'^template/(?P<pk>\d+)/$',
@@ -96,6 +99,8 @@ class RegnskabSite(object):
             url(r'^news/(?P<pk>\d+)/email/(?P<profile>\d+)/send/$',
                 email.NewsletterEmailSend.as_view(),
                 name='newsletter_email_send'),
+            url(r'^profiling/$', profiling.ProfilingReport.as_view(),
+                name='profiling_report'),
             url(r'^krydsliste/', krydsliste.site.urls),
         ]
         if settings.DEBUG:
@@ -0,0 +1,232 @@
+import datetime
+import tempfile
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.exceptions import ValidationError
+from django.core.mail.backends.locmem import EmailBackend
+from django.db.models import ProtectedError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from tkweb.apps.regnskab.emailsend import send_emails
+from tkweb.apps.regnskab.images.attachments import (
+    build_row_images, preview_row_image, row_image_png,
+)
+from tkweb.apps.regnskab.images.utils import save_png
+from tkweb.apps.regnskab.models import (
+    Profile, Newsletter, NewsletterEmail, EmailTemplate, SheetStatus,
+    EmailTemplateInline, InlineCache, compact_email,
+    Session, Sheet, SheetRow, Email,
+)
+
+
+class FailingEmailBackend(EmailBackend):
+    def __init__(self, fail_after, **kwargs):
+        super().__init__(**kwargs)
+        self.fail_after = fail_after
+
+    def send_messages(self, messages):
+        if len(mail.outbox) >= self.fail_after:
+            raise OSError('Connection lost')
+        return super().send_messages(messages)
+
+
+class SendEmailsTest(TestCase):
+    def setUp(self):
+        self.newsletter = Newsletter.objects.create(period=2015)
+        for i in range(5):
+            profile = Profile.objects.create(name='Person %s' % i)
+            NewsletterEmail.objects.create(
+                newsletter=self.newsletter, profile=profile,
+                subject='Nyhedsbrev', body_plain='Hej %s' % i,
+                recipient_name=profile.name,
+                recipient_email='person%s@example.com' % i)
+
+    def unsent(self):
+        return list(self.newsletter.email_set.filter(send_time=None))
+
+    def test_resume(self):
+        with self.assertRaises(OSError):
+            send_emails(self.unsent(), batch_size=2,
+                        connection=FailingEmailBackend(fail_after=3))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(len(self.unsent()), 2)
+
+        self.assertEqual(send_emails(self.unsent(), batch_size=2), 2)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(len(set(m.to[0] for m in mail.outbox)), 5)
+        self.assertEqual(self.unsent(), [])
+
+    def test_inlines(self):
+        inline = EmailTemplateInline.get_or_create('image/png', b'PNG')
+        body_html = '<img src="cid:regnskab-%s-%s" />' % (inline.pk,
+                                                           inline.hash)
+        self.newsletter.email_set.update(body_html=body_html)
+        emails = self.unsent()
+        inlines = InlineCache()
+        with self.assertNumQueries(1):
+            inlines.load(e.body_html for e in emails)
+        send_emails(emails)
+        part, = mail.outbox[0].relateds
+        self.assertTrue(all(m.relateds == [part] for m in mail.outbox))
+        self.assertEqual(part['Content-ID'], '<%s>' % inline.hash)
+        html, mimetype = mail.outbox[0].alternatives[0]
+        self.assertIn('cid:%s' % inline.hash, html)
+        self.assertIn('data:image/png;base64,UE5H',
+                      emails[0].body_html_data_uris())
+
+    def test_override_recipient(self):
+        email, = self.unsent()[:1]
+        send_emails([email], override_recipient='test@example.com')
+        self.assertEqual(mail.outbox[0].to, ['test@example.com'])
+        self.assertEqual(len(self.unsent()), 5)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class RowImageTest(TestCase):
+    def setUp(self):
+        profile = Profile.objects.create(name='Person')
+        self.session = Session.objects.create(period=2015)
+        today = datetime.date.today()
+        sheet = Sheet(session=self.session, start_date=today,
+                      end_date=today, period=2015)
+        sheet.row_image.save('rows.png', ContentFile(
+            save_png(np.zeros((20, 10, 3), np.uint8))))
+        SheetRow.objects.create(sheet=sheet, profile=profile, position=1,
+                                image_start=5, image_stop=10)
+        self.email = Email.objects.create(
+            session=self.session, profile=profile, subject='Opgørelse',
+            body_plain='Hej', recipient_name=profile.name,
+            recipient_email='p@example.com')
+
+    def test_preview_does_not_save(self):
+        png_data = preview_row_image(self.session, self.email)
+        self.assertTrue(png_data.startswith(b'\x89PNG'))
+        self.email.refresh_from_db()
+        self.assertFalse(self.email.row_image)
+        build_row_images(self.session)
+        self.email.refresh_from_db()
+        self.assertEqual(row_image_png(self.email), png_data)
+        self.assertEqual(preview_row_image(self.session, self.email),
+                         png_data)
+
+    def test_email_detail(self):
+        user = User.objects.create(username='test', is_staff=True,
+                                   is_superuser=True)
+        self.client.force_login(user)
+        url = reverse('regnskab:email_detail', kwargs=dict(
+            pk=self.session.pk, profile=self.email.profile_id))
+        response = self.client.get(url)
+        self.assertTrue(response.context['images'].startswith(
+            'data:image/png'))
+        self.email.refresh_from_db()
+        self.assertFalse(self.email.row_image)
+
+
+class RegenerateEmailsTest(TestCase):
+    def setUp(self):
+        profile = Profile.objects.create(name='Person', email='p@example.com')
+        SheetStatus.objects.create(profile=profile, start_time=timezone.now())
+        self.newsletter = Newsletter.objects.create(period=2015)
+
+    def set_template(self, body, markup=EmailTemplate.PLAIN):
+        self.newsletter.email_template = EmailTemplate.objects.create(
+            subject='Hej #NAVN#', body=body, markup=markup)
+
+    def test_unknown_variable(self):
+        # No emails are generated, but the error is still reported.
+        Profile.objects.update(email='')
+        self.set_template('Du skylder #GAELD# og #BETALT#')
+        with self.assertRaisesMessage(ValidationError, 'BETALT'):
+            self.newsletter.regenerate_emails()
+
+    def test_html(self):
+        self.set_template('<p>Hej <b>#NAVN#</b></p>\n<p>#GAELD# kr.</p>',
+                          markup=EmailTemplate.HTML)
+        self.newsletter.regenerate_emails()
+        email, = self.newsletter.email_set.all()
+        self.assertEqual(email.subject, 'Hej Person')
+        self.assertEqual(email.body_html,
+                         '<p>Hej <b>Person</b></p>\n<p>0,00 kr.</p>')
+        self.assertIn('0,00 kr.', email.body_plain)
+
+    @override_settings(REGNSKAB_COMPACT_EMAILS=True)
+    def test_compact(self):
+        self.set_template('Du skylder #GAELD#\n#SKJULNUL:#Gæld før: #GAELDFOER#\n')
+        self.newsletter.regenerate_emails()
+        email, = self.newsletter.email_set.all()
+        self.assertEqual(email.subject, '')
+        self.assertEqual(email.context['NAVN'], 'Person')
+        email.render()
+        self.assertEqual(email.subject, 'Hej Person')
+        self.assertEqual(email.body_plain, 'Du skylder 0,00\n')
+
+    @override_settings(REGNSKAB_COMPACT_EMAILS=True)
+    def test_edit_sent_template(self):
+        template = EmailTemplate.objects.create(
+            name='Nyhedsbrev', subject='Hej #NAVN#', body='Du skylder #GAELD#',
+            format=EmailTemplate.POUND, markup=EmailTemplate.PLAIN)
+        self.newsletter.email_template = template
+        self.newsletter.save()
+        self.newsletter.regenerate_emails()
+        self.newsletter.send_time = timezone.now()
+        self.newsletter.save()
+
+        user = User.objects.create(username='test', is_staff=True,
+                                   is_superuser=True)
+        self.client.force_login(user)
+        url = reverse('regnskab:email_template_update',
+                      kwargs=dict(pk=template.pk))
+        self.client.post(url, dict(
+            name='Nyhedsbrev', subject='Farvel #NAVN#', body='Ny tekst',
+            format=EmailTemplate.POUND, markup=EmailTemplate.PLAIN,
+            initial_markup=EmailTemplate.PLAIN))
+        template.refresh_from_db()
+        self.assertEqual(template.subject, 'Farvel #NAVN#')
+
+        email, = self.newsletter.email_set.all()
+        self.assertNotEqual(email.email_template_id, template.pk)
+        email.render()
+        self.assertEqual((email.subject, email.body_plain),
+                         ('Hej Person', 'Du skylder 0,00'))
+
+    @override_settings(REGNSKAB_COMPACT_EMAILS=True)
+    def test_delete_compact(self):
+        self.set_template('Du skylder #GAELD#')
+        self.newsletter.regenerate_emails()
+        template = self.newsletter.email_template
+        self.assertEqual(NewsletterEmail.objects.filter(
+            email_template=template).exclude(context=None).count(), 1)
+        # The text of the emails lives in the template and context.
+        with self.assertRaises(ProtectedError):
+            template.delete()
+        # As in NewsletterCreate when the template is invalid. The emails
+        # go with the newsletter, so PROTECT allows deleting the template.
+        self.newsletter.delete()
+        self.assertFalse(NewsletterEmail.objects.exists())
+        template.delete()
+        self.assertFalse(
+            EmailTemplate.objects.filter(pk=template.pk).exists())
+
+    def test_compact_email(self):
+        self.set_template('Du skylder #GAELD#\n#SKJULNUL:#Gæld før: #GAELDFOER#\n')
+        self.newsletter.regenerate_emails()
+        email, = self.newsletter.email_set.all()
+        subject, body = email.subject, email.body_plain
+        self.assertTrue(compact_email(email, self.newsletter.email_template))
+        email, = self.newsletter.email_set.all()
+        self.assertEqual(email.body_plain, '')
+        email.render()
+        self.assertEqual((email.subject, email.body_plain), (subject, body))
+        # Text that the template cannot reproduce is kept as is.
+        other = EmailTemplate.objects.create(subject='Hej', body='Hej',
+                                             markup=EmailTemplate.PLAIN)
+        email = NewsletterEmail.objects.create(
+            newsletter=self.newsletter, profile=email.profile,
+            subject='Hej', body_plain='Farvel',
+            recipient_name='Person', recipient_email='p@example.com')
+        self.assertFalse(compact_email(email, other))
@@ -0,0 +1,323 @@
+import datetime
+import tempfile
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from tkweb.apps.regnskab.models import (
+    Profile, Sheet, SheetRow, Purchase, PurchaseKind, Transaction, Session,
+    BalanceSnapshot, PurchaseRollup, TransactionRollup, SheetGrid,
+    SheetRowDiff,
+    aggregate_balance, compute_balance,
+    take_balance_snapshot, update_balance_snapshots,
+    update_purchase_rollups, update_transaction_rollups,
+    save_transaction_batch, LeaderboardEntry, aggregate_leaderboard,
+    get_leaderboard, sheet_row_leaderboard_changes, update_leaderboard,
+    replace_sheet_rows, ExtractionJob,
+)
+from tkweb.apps.regnskab.images.jobs import save_extracted_rows
+from tkweb.apps.regnskab.ledger import get_ledger_page
+
+
+def nonzero(balance):
+    return {p_id: amount for p_id, amount in balance.items() if amount}
+
+
+class SheetFixtureMixin:
+    '''A session with one sheet, three profiles and one purchase kind.'''
+
+    def setUp(self):
+        self.profiles = [Profile.objects.create(name='Person %s' % i)
+                         for i in range(3)]
+        self.kind = PurchaseKind.objects.create(
+            name='øl', position=1, unit_price=Decimal('12.00'))
+        self.session = Session.objects.create(period=2015)
+        today = datetime.date.today()
+        self.sheet = Sheet.objects.create(
+            session=self.session, start_date=today, end_date=today,
+            period=2015)
+        self.kind.sheets.add(self.sheet)
+
+    def add_purchase(self, profile, count):
+        row = SheetRow.objects.create(
+            sheet=self.sheet, profile=profile,
+            position=self.sheet.sheetrow_set.count() + 1)
+        Purchase.objects.create(row=row, kind=self.kind, count=count)
+        return [(profile.id, self.sheet.created_time,
+                 count * self.kind.unit_price)]
+
+    def add_transaction(self, profile, amount):
+        o = Transaction.objects.create(
+            session=self.session, kind=Transaction.PAYMENT,
+            profile=profile, time=timezone.now(), period=2015, amount=amount)
+        return [(profile.id, o.created_time, amount)]
+
+
+class BalanceSnapshotTest(SheetFixtureMixin, TestCase):
+    def test_snapshot_and_delta(self):
+        self.add_purchase(self.profiles[0], 3)
+        self.add_transaction(self.profiles[1], Decimal('-20'))
+        time = timezone.now()
+        take_balance_snapshot(time)
+        self.assertTrue(BalanceSnapshot.objects.filter(time=time).exists())
+        update_balance_snapshots(self.add_purchase(self.profiles[1], 2))
+        self.add_transaction(self.profiles[2], Decimal('5'))
+
+        self.assertEqual(compute_balance(), aggregate_balance())
+        self.assertEqual(compute_balance(created_before=time),
+                         aggregate_balance(created_before=time))
+
+    def test_update_old_sheet(self):
+        self.add_purchase(self.profiles[0], 1)
+        time = timezone.now()
+        take_balance_snapshot(time)
+        # Edit the sheet that was created before the snapshot.
+        update_balance_snapshots(self.add_purchase(self.profiles[2], 4))
+        self.assertEqual(compute_balance(created_before=time),
+                         aggregate_balance(created_before=time))
+        self.assertEqual(compute_balance(created_before=time)[
+            self.profiles[2].id], Decimal('48'))
+
+    def test_replace_sheet_rows(self):
+        self.add_purchase(self.profiles[0], 2)
+        self.add_purchase(self.profiles[1], 1)
+        time = timezone.now()
+        take_balance_snapshot(time)
+        # Reset the rows of a sheet created before the snapshot,
+        # as SheetImageParameters does.
+        row = SheetRow(sheet=self.sheet, profile=self.profiles[1], position=1)
+        replace_sheet_rows(self.sheet, [row], [
+            Purchase(row=row, kind=self.kind, count=3)])
+        self.assertEqual(self.sheet.sheetrow_set.count(), 1)
+        self.assertEqual(nonzero(compute_balance(created_before=time)),
+                         aggregate_balance(created_before=time))
+        self.assertEqual(compute_balance()[self.profiles[1].id],
+                         Decimal('36'))
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_extraction_job(self):
+        self.add_purchase(self.profiles[1], 1)
+        sheet = Sheet.objects.create(
+            session=self.session, start_date=self.sheet.start_date,
+            end_date=self.sheet.end_date, period=2015)
+        self.kind.sheets.add(sheet)
+        ExtractionJob.objects.create(sheet=sheet)
+        # A snapshot taken while the job is waiting in the queue.
+        time = timezone.now()
+        take_balance_snapshot(time)
+        row = SheetRow(sheet=sheet, profile=self.profiles[0], position=1)
+        save_extracted_rows(sheet, [row], [
+            Purchase(row=row, kind=self.kind, count=2)],
+            ContentFile(b'PNG', 'krydser.png'))
+        self.assertEqual(nonzero(compute_balance(created_before=time)),
+                         aggregate_balance(created_before=time))
+        self.assertEqual(compute_balance()[self.profiles[0].id],
+                         Decimal('24'))
+
+
+class RollupTest(SheetFixtureMixin, TestCase):
+    def test_rollups(self):
+        self.add_purchase(self.profiles[0], 2)
+        self.add_purchase(self.profiles[1], 3)
+        self.add_transaction(self.profiles[0], Decimal('-10'))
+        update_purchase_rollups([self.sheet.id])
+        update_transaction_rollups([(self.session.id, 2015)])
+        rollup, = PurchaseRollup.objects.all()
+        self.assertEqual((rollup.sheet_id, rollup.kind_name, rollup.count),
+                         (self.sheet.id, 'øl', 5))
+        self.add_transaction(self.profiles[1], Decimal('-5'))
+        update_transaction_rollups([(self.session.id, 2015)])
+        rollup, = TransactionRollup.objects.all()
+        self.assertEqual((rollup.session_id, rollup.kind, rollup.amount),
+                         (self.session.id, Transaction.PAYMENT, -15))
+
+
+class SheetGridTest(SheetFixtureMixin, TestCase):
+    def test_fixed_queries(self):
+        for i, profile in enumerate(self.profiles):
+            self.add_purchase(profile, i + 1)
+        # Kinds, rows with profiles and purchase counts
+        with self.assertNumQueries(3):
+            rows = SheetGrid(self.sheet).rows(titles=False)
+        self.assertEqual([row['kinds'][0].count for row in rows], [1, 2, 3])
+        self.assertEqual([row['profile'] for row in rows], self.profiles)
+
+
+class SheetRowDiffTest(SheetFixtureMixin, TestCase):
+    def test_sheet_row_diff(self):
+        self.add_purchase(self.profiles[0], 1)
+        self.add_purchase(self.profiles[1], 2)
+        purchase_ids = set(Purchase.objects.values_list('id', flat=True))
+
+        def row(profile, position, count):
+            return dict(profile=profile, name=None, position=position,
+                        image_start=None, image_stop=None,
+                        kinds=[Purchase(kind=self.kind,
+                                        count=Decimal(count))])
+
+        # Swapping two rows only changes their positions.
+        diff = SheetRowDiff(SheetGrid(self.sheet), [
+            row(self.profiles[1], 1, 2), row(self.profiles[0], 2, 1)])
+        self.assertEqual((len(diff.moved), diff.profile_ids()), (2, set()))
+        diff.apply()
+        self.assertEqual(
+            list(self.sheet.sheetrow_set.values_list('profile_id', flat=True)),
+            [self.profiles[1].id, self.profiles[0].id])
+
+        # Changing a count updates the existing Purchase.
+        diff = SheetRowDiff(SheetGrid(self.sheet), [
+            row(self.profiles[1], 1, 2), row(self.profiles[0], 2, 3),
+            row(self.profiles[2], 3, 1)])
+        self.assertEqual(diff.profile_ids(),
+                         {self.profiles[0].id, self.profiles[2].id})
+        diff.apply()
+        self.assertEqual(len(purchase_ids & set(
+            Purchase.objects.values_list('id', flat=True))), 2)
+        self.assertEqual(aggregate_balance()[self.profiles[0].id],
+                         Decimal('36'))
+
+
+class TransactionBatchTest(SheetFixtureMixin, TestCase):
+    def test_save_transaction_batch(self):
+        def save(amounts):
+            existing = {o.profile_id: o for o in Transaction.objects.all()}
+            return save_transaction_batch(
+                self.session, Transaction.PAYMENT, amounts, existing, None)
+
+        p0, p1, p2 = (p.id for p in self.profiles)
+        self.assertEqual(save({p0: -10.0, p1: -20.0}), {p0, p1})
+        time = Transaction.objects.get(profile_id=p0).created_time
+        self.assertEqual(save({p0: -10.0, p2: -5.5}), {p1, p2})
+        self.assertEqual(
+            Transaction.objects.get(profile_id=p0).created_time, time)
+        self.assertEqual(aggregate_balance(),
+                         {p0: Decimal('-10'), p2: Decimal('-5.5')})
+        rollup, = TransactionRollup.objects.all()
+        self.assertEqual(rollup.amount, Decimal('-15.5'))
+
+
+class LeaderboardTest(SheetFixtureMixin, TestCase):
+    def test_leaderboard(self):
+        p0, p1, p2 = (p.id for p in self.profiles)
+        self.add_purchase(self.profiles[0], 2)
+        update_leaderboard(sheet_row_leaderboard_changes(
+            self.sheet, [], SheetGrid(self.sheet).rows(titles=False)))
+        save_transaction_batch(self.session, Transaction.PAYMENT,
+                               {p1: -30, p2: -20}, {}, None)
+        save_transaction_batch(self.session, Transaction.PAYMENT,
+                               {p1: -30},
+                               {o.profile_id: o
+                                for o in Transaction.objects.all()}, None)
+
+        def entries(objects):
+            return {(o.profile_id, o.period, o.key): o.amount
+                    for o in objects}
+
+        self.assertEqual(entries(LeaderboardEntry.objects.all()),
+                         entries(aggregate_leaderboard()))
+        board = get_leaderboard(2015, balance=True)
+        self.assertEqual([profile_id for profile_id, totals in board],
+                         [p1, p0])
+        self.assertEqual(board[0][1][LeaderboardEntry.PAID], 30)
+        self.assertEqual(board[1][1]['øl'], 2)
+        self.assertEqual(board[1][1]['balance'], 24)
+
+
+class LedgerPageTest(SheetFixtureMixin, TestCase):
+    def test_ledger_page(self):
+        p0 = self.profiles[0]
+        self.add_purchase(p0, 2)
+        self.add_transaction(p0, Decimal('-10'))
+        self.add_transaction(p0, Decimal('-4'))
+        entries, has_older = get_ledger_page(p0.id, limit=2)
+        self.assertTrue(has_older)
+        self.assertEqual([o.balance for o in entries], [10, -14])
+        older, has_older = get_ledger_page(p0.id, entries[-1].key, limit=2)
+        self.assertFalse(has_older)
+        # The payments are dated on the sheet and come before it.
+        self.assertEqual([(o.amount, o.balance) for o in older],
+                         [(-10, -10)])
+
+
+class AdminEditTest(SheetFixtureMixin, TestCase):
+    '''Transactions and sheets changed in the Django admin.'''
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='test', is_staff=True,
+                                        is_superuser=True)
+        self.client.force_login(self.user)
+        self.add_purchase(self.profiles[1], 1)
+        self.add_transaction(self.profiles[0], Decimal('-20'))
+        self.transaction = Transaction.objects.get()
+        update_leaderboard()
+        # The admin edits entries created before the latest snapshot.
+        take_balance_snapshot(timezone.now())
+
+    def change_transaction(self, amount):
+        o = self.transaction
+        url = reverse('admin:regnskab_transaction_change', args=(o.pk,))
+        time = timezone.localtime(o.time)
+        response = self.client.post(url, dict(
+            session=o.session_id, kind=o.kind, profile=o.profile_id,
+            time_0=time.date().isoformat(),
+            time_1=time.time().strftime('%H:%M:%S'),
+            period=o.period, amount=amount, note='',
+            created_by=self.user.pk))
+        self.assertEqual(response.status_code, 302)
+
+    def delete(self, model, pk):
+        url = reverse('admin:regnskab_%s_delete' % model, args=(pk,))
+        response = self.client.post(url, dict(post='yes'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_change_transaction(self):
+        update_transaction_rollups()
+        self.change_transaction('-50.00')
+        self.assertEqual(compute_balance()[self.profiles[0].id],
+                         Decimal('-50'))
+        self.assertEqual(nonzero(compute_balance()), aggregate_balance())
+        rollup, = TransactionRollup.objects.all()
+        self.assertEqual(rollup.amount, Decimal('-50'))
+
+    def test_delete_transaction(self):
+        update_transaction_rollups()
+        self.delete('transaction', self.transaction.pk)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(TransactionRollup.objects.exists())
+        self.assertEqual(nonzero(compute_balance()), aggregate_balance())
+
+    def test_delete_sheet(self):
+        self.delete('sheet', self.sheet.pk)
+        self.assertFalse(Sheet.objects.exists())
+        self.assertEqual(nonzero(compute_balance()), aggregate_balance())
+
+    def assertLeaderboard(self):
+        def entries(objects):
+            return {(o.profile_id, o.period, o.key): o.amount
+                    for o in objects}
+
+        self.assertEqual(entries(LeaderboardEntry.objects.all()),
+                         entries(aggregate_leaderboard()))
+
+    def test_leaderboard(self):
+        self.change_transaction('-50.00')
+        self.assertLeaderboard()
+        self.assertEqual(LeaderboardEntry.objects.get(
+            key=LeaderboardEntry.PAID).amount, 50)
+        url = reverse('admin:regnskab_sheet_change', args=(self.sheet.pk,))
+        response = self.client.post(url, dict(
+            session=self.session.pk, name='',
+            start_date=self.sheet.start_date.isoformat(),
+            end_date=self.sheet.end_date.isoformat(), period=2016,
+            created_by=self.user.pk))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Sheet.objects.get().period, 2016)
+        self.assertLeaderboard()
+        self.delete('transaction', self.transaction.pk)
+        self.delete('sheet', self.sheet.pk)
+        self.assertFalse(LeaderboardEntry.objects.exists())
@@ -0,0 +1,143 @@
+import time
+import random
+import datetime
+import tempfile
+import threading
+from decimal import Decimal
+from collections import defaultdict
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from tkweb.apps.regnskab.models import (
+    Profile, Sheet, SheetRow, Purchase, PurchaseKind, Transaction, Session,
+)
+from tkweb.apps.regnskab import texrender
+from tkweb.apps.regnskab.views.printing import BalancePrint
+
+
+def reference_tex_counts(period, current_session_id):
+    '''The per-purchase loop that get_tex_counts replaced.'''
+    kinds = {
+        (sheet_id, o.name): o.unit_price
+        for o in PurchaseKind.objects.all()
+        for sheet_id in o.sheets.all().values_list('id', flat=True)
+    }
+    counts = defaultdict(Decimal)
+    cur_counts = defaultdict(Decimal)
+    for p in Purchase.objects.filter(row__sheet__period=period):
+        sheet = p.row.sheet
+        name, count = p.kind.name, p.count
+        if name in ('guldølkasse', 'sodavandkasse'):
+            name = 'ølkasse'
+            count = count * (kinds[sheet.id, p.kind.name] /
+                             kinds[sheet.id, 'ølkasse'])
+        counts[p.row.profile_id, name] += count
+        if sheet.session_id == current_session_id:
+            cur_counts[p.row.profile_id, name] += count
+    start = min(s.start_date for s in Sheet.objects.filter(period=period))
+    start = timezone.get_current_timezone().localize(
+        datetime.datetime.combine(start, datetime.time()))
+    for o in Transaction.objects.filter(time__gte=start):
+        if o.kind == Transaction.PAYMENT:
+            name, amount = 'betalt', -o.amount
+        else:
+            name, amount = 'andet', o.amount
+        counts[o.profile_id, name] += amount
+        if o.session_id == current_session_id:
+            cur_counts[o.profile_id, name] += amount
+    return counts, cur_counts
+
+
+class BalancePrintTest(TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        profiles = [Profile.objects.create(name='Person %s' % i)
+                    for i in range(10)]
+        prices = [('ølkasse', '200'), ('guldølkasse', '250'),
+                  ('sodavandkasse', '150'), ('guldøl', '10'),
+                  ('øl', '8'), ('sodavand', '6')]
+        today = datetime.date(2016, 10, 1)
+        self.sessions = []
+        for i in range(3):
+            session = Session.objects.create(period=2016)
+            self.sessions.append(session)
+            sheet = Sheet.objects.create(
+                session=session, period=2016,
+                start_date=today + datetime.timedelta(30 * i),
+                end_date=today + datetime.timedelta(30 * i + 29))
+            for position, (name, price) in enumerate(prices):
+                kind = PurchaseKind.objects.create(
+                    name=name, position=position + 1,
+                    unit_price=Decimal(price) + i)
+                kind.sheets.add(sheet)
+            kinds = list(sheet.purchasekind_set.all())
+            for j in range(20):
+                row = SheetRow.objects.create(
+                    sheet=sheet, position=j + 1,
+                    profile=rng.choice(profiles + [None]))
+                for kind in rng.sample(kinds, 3):
+                    Purchase.objects.create(
+                        row=row, kind=kind,
+                        count=rng.choice([1, 2, 3, Decimal('0.5')]))
+            for p in profiles:
+                Transaction.objects.create(
+                    session=session, profile=p, period=2016,
+                    kind=rng.choice([Transaction.PAYMENT,
+                                     Transaction.PURCHASE]),
+                    time=timezone.now(), amount=rng.randrange(-100, 100))
+
+    def test_tex_counts(self):
+        current = self.sessions[1].id
+        prices, counts, cur_counts = BalancePrint.get_tex_counts(
+            2016, current)
+        expected_counts, expected_cur = reference_tex_counts(2016, current)
+
+        def rounded(d):
+            return {k: v.quantize(Decimal('0.000001'))
+                    for k, v in d.items() if v}
+
+        self.assertEqual(rounded(counts), rounded(expected_counts))
+        self.assertEqual(rounded(cur_counts), rounded(expected_cur))
+        self.assertEqual(prices['ølkasse'], Decimal('202'))
+
+
+    @override_settings(TEXRENDER_CACHE_DIR=tempfile.mkdtemp())
+    def test_pdf_date(self):
+        view = BalancePrint()
+        view.regnskab_session = self.sessions[2]
+
+        def render(date):
+            with mock.patch.object(timezone, 'localdate',
+                                   return_value=date):
+                return texrender.tex_to_pdf(view.get_tex_source(None))
+
+        # Stand-in for pdflatex, so that the real PDF cache is used.
+        with mock.patch.object(texrender, '_tex_to_pdf',
+                               lambda source, jobname: source.encode()):
+            pdf1 = render(datetime.date(2016, 12, 1))
+            pdf2 = render(datetime.date(2016, 12, 2))
+        self.assertNotEqual(pdf1, pdf2)
+        self.assertIn('2. december 2016'.encode(), pdf2)
+
+
+@override_settings(TEXRENDER_CACHE_DIR=tempfile.mkdtemp(),
+                   TEXRENDER_TIMEOUT=0.01)
+class TexRenderTest(SimpleTestCase):
+    def test_timeout(self):
+        done = threading.Event()
+
+        def slow():
+            done.wait(5)
+            return b'PDF'
+
+        with self.assertRaises(texrender.RenderError):
+            texrender.render('slow', slow)
+        # The run is cached when it finishes, though nobody waits for it.
+        done.set()
+        for i in range(500):
+            if 'slow' not in texrender._pending:
+                break
+            time.sleep(0.01)
+        self.assertEqual(texrender.cache_get('slow'), b'PDF')
@@ -0,0 +1,72 @@
+import datetime
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from tkweb.apps.regnskab import profiling
+from tkweb.apps.regnskab.models import (
+    Alias, Profile, Purchase, PurchaseKind, Session, Sheet, SheetRow,
+    SheetStatus,
+)
+from tkweb.apps.regnskab.profiling import QueryBudgetMixin
+
+
+class ProfilingTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        for i in range(30):
+            p = Profile.objects.create(name='Person %s' % i)
+            Alias.objects.create(profile=p, root='ALIAS%s' % i)
+            SheetStatus.objects.create(profile=p, start_time=timezone.now())
+        self.user = User.objects.create(
+            username='test', is_staff=True, is_superuser=True)
+        self.client.force_login(self.user)
+
+    def test_profile_search_budget(self):
+        url = reverse('regnskab:profile_search')
+        self.assertViewQueryBudget(20, url, data=dict(q='alias1', c='1'))
+
+    def make_sheet(self):
+        session = Session.objects.create(period=2016)
+        sheet = Sheet.objects.create(
+            session=session, period=2016, start_date=datetime.date.today(),
+            end_date=datetime.date.today())
+        kind = PurchaseKind.objects.create(name='øl', position=1,
+                                           unit_price=8)
+        kind.sheets.add(sheet)
+        for i, p in enumerate(Profile.objects.all()):
+            row = SheetRow.objects.create(sheet=sheet, position=i + 1,
+                                          profile=p)
+            Purchase.objects.create(row=row, kind=kind, count=2)
+        return sheet
+
+    def test_sheet_detail_budget(self):
+        sheet = self.make_sheet()
+        url = reverse('regnskab:sheet_detail', kwargs=dict(pk=sheet.pk))
+        self.assertViewQueryBudget(12, url)
+
+    def test_payment_purchase_list_budget(self):
+        sheet = self.make_sheet()
+        url = reverse('regnskab:payment_purchase_list',
+                      kwargs=dict(pk=sheet.session_id))
+        response = self.assertViewQueryBudget(15, url)
+        self.assertEqual(len(response.context['object_list']), 30)
+
+    def test_profile_detail_budget(self):
+        sheet = self.make_sheet()
+        profile = sheet.sheetrow_set.first().profile
+        url = reverse('regnskab:profile_detail', kwargs=dict(pk=profile.pk))
+        response = self.assertViewQueryBudget(15, url)
+        self.assertEqual(len(response.context['rows']), 1)
+
+    @override_settings(REGNSKAB_PROFILING=True)
+    def test_middleware(self):
+        profiling.records.clear()
+        self.client.get(reverse('regnskab:profile_list'))
+        record, = profiling.records
+        self.assertEqual(record['view'], 'regnskab:profile_list')
+        self.assertGreater(record['queries'], 0)
+        self.assertEqual(record['sections']['compute_balance']['calls'], 1)
+        response = self.client.get(reverse('regnskab:profiling_report'))
+        self.assertContains(response, 'regnskab:profile_list')
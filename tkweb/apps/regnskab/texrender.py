@@ -1,56 +1,253 @@
+'''
+Rendering of TeX documents to PDF.
+
+Renders go through three layers:
+
+- A content-addressed cache of PDFs on disk, keyed by the hash of the
+  TeX source (or of the input PDF for pdfnup), so that printing
+  unchanged data does not run TeX again. The cache is bounded by
+  TEXRENDER_CACHE_SIZE bytes; the least recently used files are removed.
+- A precompiled format file per preamble (built with mylatexformat the
+  second time a preamble is seen), so that each run skips loading the
+  document class and packages. If the format cannot be built, TeX is
+  run on the full source as before.
+- A bounded pool of TEXRENDER_WORKERS threads that run the processes,
+  so that concurrent prints do not oversubscribe the CPU. Identical
+  renders that are in progress at the same time share the result.
+'''
+
 import os
+import hashlib
+import logging
 import tempfile
+import functools
+import threading
 import subprocess
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 
+logger = logging.getLogger('regnskab')
+
 
 class RenderError(subprocess.CalledProcessError):
     pass
 
 
-def tex_to_pdf(source, jobname='django'):
+def get_cache_dir():
+    d = getattr(settings, 'TEXRENDER_CACHE_DIR', None)
+    if d is None:
+        d = os.path.join(tempfile.gettempdir(), 'tkweb-texrender')
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def source_hash(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf8')
+        h.update(hashlib.sha256(part).digest())
+    return h.hexdigest()
+
+
+def cache_get(key):
+    path = os.path.join(get_cache_dir(), key + '.pdf')
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    except FileNotFoundError:
+        return None
+    # The modification time is used as the time of last use.
+    os.utime(path)
+    return data
+
+
+def write_file(path, data):
+    # Write to a temporary file and rename it, so that other processes
+    # never see a partially written file.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+
+
+def cache_put(key, data):
+    write_file(os.path.join(get_cache_dir(), key + '.pdf'), data)
+    evict()
+
+
+def evict():
+    max_size = getattr(settings, 'TEXRENDER_CACHE_SIZE', 200 * 2 ** 20)
+    d = get_cache_dir()
+    files = []
+    for entry in os.scandir(d):
+        if entry.is_file() and entry.name.endswith(('.pdf', '.fmt')):
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for mtime, size, path in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def run(cmd, cwd):
+    p = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    with p:
+        output_bytes, _ = p.communicate()
+    if p.returncode != 0:
+        output = output_bytes.decode("utf8", errors="replace")
+        raise RenderError(p.returncode, cmd, output, stderr=None)
+
+
+def split_preamble(source):
+    i = source.find('\\begin{document}')
+    if i == -1:
+        return None
+    return source[:i]
+
+
+def get_format(preamble):
+    '''
+    Path of a format file for the given preamble (without the .fmt
+    extension), or None if there is none yet. The format is built the
+    second time a preamble is seen, since preambles that differ for
+    every document would otherwise pay for building a format each time.
+    '''
+    d = get_cache_dir()
+    name = 'fmt-' + source_hash(preamble)
+    base = os.path.join(d, name)
+    if os.path.exists(base + '.fmt'):
+        os.utime(base + '.fmt')
+        return base
+    if os.path.exists(base + '.failed'):
+        return None
+    if not os.path.exists(base + '.seen'):
+        write_file(base + '.seen', b'')
+        return None
+    with tempfile.TemporaryDirectory() as t:
+        with open(os.path.join(t, name + '.tex'), 'w', encoding='utf8') as fp:
+            fp.write(preamble + '\\begin{document}\\end{document}\n')
+        cmd = ('pdflatex', '-ini', '-jobname=' + name, '&pdflatex',
+               'mylatexformat.ltx', name + '.tex')
+        try:
+            run(cmd, t)
+            with open(os.path.join(t, name + '.fmt'), 'rb') as fp:
+                write_file(base + '.fmt', fp.read())
+        except (RenderError, OSError) as exn:
+            logger.warning("Kunne ikke lave TeX-format: %s", exn)
+            write_file(base + '.failed', b'')
+            return None
+    return base
+
+
+def _tex_to_pdf(source, jobname):
+    preamble = split_preamble(source)
+    fmt = preamble and get_format(preamble)
     with tempfile.TemporaryDirectory() as d:
         base = os.path.join(d, jobname)
         with open(base + '.tex', 'w', encoding='utf8') as fp:
             fp.write(source)
         cmd = ('pdflatex', base + '.tex')
-        p = subprocess.Popen(
-            cmd,
-            cwd=d,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-        with p:
-            output_bytes, _ = p.communicate()
-        if p.returncode != 0:
-            output = output_bytes.decode("utf8", errors="replace")
-            raise RenderError(p.returncode, cmd, output, stderr=None)
+        if fmt:
+            # mylatexformat skips the preamble that is in the format.
+            os.symlink(fmt + '.fmt', os.path.join(d, 'preamble.fmt'))
+            cmd = ('pdflatex', '-fmt=preamble', base + '.tex')
+        run(cmd, d)
         with open(base + '.pdf', 'rb') as fp:
             return fp.read()
 
 
-def pdfnup(pdf, jobname='django'):
+def _pdfnup(pdf, jobname):
     with tempfile.TemporaryDirectory() as d:
         base = os.path.join(d, jobname)
         out = base + '-nup'
         with open(base + '.pdf', 'wb') as fp:
             fp.write(pdf)
         cmd = ('pdfnup', base + '.pdf', '-o', out + '.pdf')
-        p = subprocess.Popen(
-            cmd,
-            cwd=d,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True)
-        with p:
-            output, _ = p.communicate()
-        if p.returncode != 0:
-            raise RenderError(p.returncode, cmd, output, stderr=None)
+        run(cmd, d)
         with open(out + '.pdf', 'rb') as fp:
             return fp.read()
 
 
+_executor = None
+_pending = {}
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            workers = getattr(settings, 'TEXRENDER_WORKERS',
+                              os.cpu_count() or 1)
+            _executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='texrender')
+        return _executor
+
+
+def _finish(key, future):
+    '''
+    Cache the result of a finished run and forget it, also when the
+    callers have stopped waiting for it.
+    '''
+    try:
+        if not future.cancelled() and future.exception() is None:
+            cache_put(key, future.result())
+    except OSError as exn:
+        logger.warning("Kunne ikke gemme PDF i cachen: %s", exn)
+    finally:
+        with _lock:
+            if _pending.get(key) is future:
+                del _pending[key]
+
+
+def render(key, fn, *args):
+    '''
+    Return the cached result for key, or run fn(*args) in the worker
+    pool and cache the result. Concurrent calls with the same key wait
+    for the same run.
+    '''
+    data = cache_get(key)
+    if data is not None:
+        return data
+    executor = get_executor()
+    with _lock:
+        future = _pending.get(key)
+        submitted = future is None
+        if submitted:
+            future = _pending[key] = executor.submit(fn, *args)
+    if submitted:
+        # Outside the lock, since the callback runs here if the future
+        # is already done.
+        future.add_done_callback(functools.partial(_finish, key))
+    timeout = getattr(settings, 'TEXRENDER_TIMEOUT', None)
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        raise RenderError(1, fn.__name__,
+                          'Tidsgrænsen på %s s blev overskredet' % timeout)
+
+
+def tex_to_pdf(source, jobname='django'):
+    return render(source_hash('pdflatex', source), _tex_to_pdf,
+                  source, jobname)
+
+
+def pdfnup(pdf, jobname='django'):
+    return render(source_hash('pdfnup', pdf), _pdfnup, pdf, jobname)
+
+
 def run_lp(pdf, duplex=True, hostname=None, destination=None):
     if hostname is None:
         hostname = getattr(settings, 'CUPS_HOSTNAME', 'localhost')
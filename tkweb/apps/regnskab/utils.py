@@ -1,5 +1,9 @@
 import re
+from decimal import Decimal
+from email.mime.base import MIMEBase
 from unittest.mock import patch
+
+import numpy as np
 from django.db.models import F, Sum
 from django.utils import html, safestring
 from django.core.mail import EmailMessage, SafeMIMEMultipart
@@ -30,6 +34,140 @@ def sum_vector(qs, index_spec, value_spec):
     return res
 
 
+def _to_decimal(value):
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+def _decimal_places(value):
+    return max(0, -_to_decimal(value).as_tuple().exponent)
+
+
+class Aggregate:
+    '''
+    Sums over a queryset as a dense matrix over indexed axes.
+
+    values[i, j] is the sum for row_keys[i] and column_keys[j] as an
+    integer in units of 10**-places (øre for places=2), and present[i, j]
+    tells whether the database returned a sum for the cell at all.
+    Values are converted back to exact Decimals by the accessors.
+    '''
+
+    def __init__(self, row_keys, column_keys, values, present, places):
+        self.row_keys = list(row_keys)
+        self.column_keys = list(column_keys)
+        self.values = values
+        self.present = present
+        self.places = places
+
+    @classmethod
+    def from_records(cls, records, places=None):
+        '''
+        Make an Aggregate from (row, column, value) triples. Values for
+        the same cell are added. If places is None, it is the largest
+        number of decimal places among the values.
+        '''
+        records = [(r, c, _to_decimal(v or 0)) for r, c, v in records]
+        if places is None:
+            places = max((_decimal_places(v) for r, c, v in records),
+                         default=0)
+        row_index = {}
+        column_index = {}
+        for r, c, v in records:
+            row_index.setdefault(r, len(row_index))
+            column_index.setdefault(c, len(column_index))
+        shape = (len(row_index), len(column_index))
+        values = np.zeros(shape, np.int64)
+        present = np.zeros(shape, bool)
+        if records:
+            n = len(records)
+            rows = np.fromiter((row_index[r] for r, c, v in records),
+                               np.intp, n)
+            columns = np.fromiter((column_index[c] for r, c, v in records),
+                                  np.intp, n)
+            units = [v.scaleb(places) for r, c, v in records]
+            if any(u != u.to_integral_value() for u in units):
+                raise ValueError('Values have more than %s decimal places' %
+                                 places)
+            np.add.at(values, (rows, columns),
+                      np.fromiter(map(int, units), np.int64, n))
+            present[rows, columns] = True
+        return cls(row_index, column_index, values, present, places)
+
+    def to_decimal(self, units):
+        return Decimal(int(units)).scaleb(-self.places)
+
+    def nonempty_columns(self):
+        return {k for k, p in zip(self.column_keys, self.present.any(axis=0))
+                if p}
+
+    def column(self, column_key):
+        '''Mapping from row key to sum for the given column.'''
+        try:
+            j = self.column_keys.index(column_key)
+        except ValueError:
+            return {}
+        (rows,) = self.present[:, j].nonzero()
+        return {self.row_keys[i]: self.to_decimal(v)
+                for i, v in zip(rows, self.values[rows, j])}
+
+    def row_sums(self):
+        '''Mapping from row key to sum over all columns.'''
+        (rows,) = self.present.any(axis=1).nonzero()
+        sums = self.values.sum(axis=1)
+        return {self.row_keys[i]: self.to_decimal(sums[i]) for i in rows}
+
+    def _nested(self, values, present, outer_keys, inner_keys):
+        result = {}
+        outer, inner = present.nonzero()
+        for i, j, v in zip(outer, inner, values[outer, inner]):
+            result.setdefault(outer_keys[i], {})[inner_keys[j]] = (
+                self.to_decimal(v))
+        return result
+
+    def row_dicts(self):
+        '''Nested mapping d[row][column] of the present cells.'''
+        return self._nested(self.values, self.present,
+                            self.row_keys, self.column_keys)
+
+    def column_dicts(self):
+        '''Nested mapping d[column][row] of the present cells.'''
+        return self._nested(self.values.T, self.present.T,
+                            self.column_keys, self.row_keys)
+
+
+def aggregate_matrix(specs, places=None):
+    '''
+    Sum the values of several querysets, grouping over two dimensions.
+
+    `specs` is a list of (qs, column_spec, row_spec, value_spec).
+    If the database supports it, all the sums are computed by a single
+    UNION ALL query. If places is given, the sums are computed with
+    that many decimal places.
+    '''
+    from django.db import connection
+    from django.db.models import DecimalField
+
+    querysets = []
+    for qs, column_spec, row_spec, value_spec in specs:
+        if places is None:
+            value = Sum(value_spec)
+        else:
+            value = Sum(value_spec, output_field=DecimalField(
+                max_digits=30, decimal_places=places))
+        qs = qs.order_by()
+        qs = qs.annotate(row_spec=F(row_spec), column_spec=F(column_spec))
+        qs = qs.values('row_spec', 'column_spec')
+        qs = qs.annotate(value_spec=value)
+        querysets.append(
+            qs.values_list('row_spec', 'column_spec', 'value_spec'))
+    if len(querysets) > 1 and connection.features.supports_select_union:
+        querysets = [querysets[0].union(*querysets[1:], all=True)]
+    return Aggregate.from_records(
+        (record for qs in querysets for record in qs), places)
+
+
 def sum_matrix(qs, column_spec, row_spec, value_spec):
     '''
     Sum queryset values, grouping over two dimensions.
@@ -41,19 +179,8 @@ def sum_matrix(qs, column_spec, row_spec, value_spec):
     The result is a nested mapping `d` such that d[x1][x2]
     is the sum of z values where c1 = x1 and c2 = x2.
     '''
-    qs = qs.order_by()
-    qs = qs.annotate(row_spec=F(row_spec), column_spec=F(column_spec))
-    qs = qs.values('row_spec', 'column_spec')
-    qs = qs.annotate(value_spec=Sum(value_spec))
-    res = {}
-    for record in qs:
-        row = record.pop('row_spec')
-        column = record.pop('column_spec')
-        value = record.pop('value_spec')
-        cells = res.setdefault(column, {})
-        assert row not in cells
-        cells[row] = value
-    return res
+    return aggregate_matrix(
+        [(qs, column_spec, row_spec, value_spec)]).column_dicts()
 
 
 def line_to_html(line):
@@ -103,12 +230,24 @@ class EmailMultiRelated(EmailMessage):
         assert mimetype is not None
         self.alternatives.append((content, mimetype))
 
-    def attach_related(self, content, mimetype, cid):
-        """Attach an alternative content representation."""
+    def attach_related(self, content, mimetype=None, cid=None):
+        """
+        Attach an inline part, either from content or as a MIMEBase
+        object made by create_related, which may be shared by messages.
+        """
         assert content is not None
-        assert mimetype is not None
-        assert cid is not None
-        self.relateds.append((content, mimetype, cid))
+        if isinstance(content, MIMEBase):
+            self.relateds.append(content)
+        else:
+            assert mimetype is not None
+            assert cid is not None
+            self.relateds.append((content, mimetype, cid))
+
+    def create_related(self, content, mimetype, cid):
+        attachment = self._create_mime_attachment(content, mimetype)
+        attachment['Content-ID'] = '<%s>' % cid
+        attachment['Content-Disposition'] = 'inline'
+        return attachment
 
     def _create_message(self, msg):
         return self._create_attachments(
@@ -133,9 +272,8 @@ class EmailMultiRelated(EmailMessage):
             msg = SafeMIMEMultipart(_subtype=self.related_subtype,
                                     encoding=encoding)
             msg.attach(body_msg)
-            for content, mimetype, cid in self.relateds:
-                attachment = self._create_mime_attachment(content, mimetype)
-                attachment['Content-ID'] = '<%s>' % cid
-                attachment['Content-Disposition'] = 'inline'
-                msg.attach(attachment)
+            for related in self.relateds:
+                if not isinstance(related, MIMEBase):
+                    related = self.create_related(*related)
+                msg.attach(related)
         return msg
@@ -1,4 +1,3 @@
-import difflib
 import logging
 import operator
 import itertools
@@ -8,9 +7,9 @@ import json
 
 from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.urls import reverse
-from django.conf import settings
 from django.http import Http404, HttpResponse
-from django.db.models import F, Sum
+from django.db import transaction
+from django.db.models import Sum
 from django.utils import timezone
 from django.utils.html import format_html, format_html_join
 from django.template.defaultfilters import floatformat
@@ -25,17 +24,24 @@ from tkweb.apps.regnskab.forms import (
     ProfileListForm,
 )
 from tkweb.apps.regnskab.models import (
-    Sheet, SheetRow, SheetStatus, Profile, Alias, Title, Email,
-    EmailTemplate, Session, PurchaseKind,
+    Sheet, SheetGrid, SheetRowDiff, SheetStatus, Profile, Alias, Title,
+    EmailTemplate, Session, PurchaseKind, ExtractionJob,
     Transaction, Purchase,
     compute_balance, get_inka,
     config, get_profiles_title_status,
+    take_balance_snapshot, update_balance_snapshots,
+    sheet_row_balance_changes, update_purchase_rollups,
+    sheet_row_leaderboard_changes, update_leaderboard, delete_sheet,
+    PurchaseRollup, TransactionRollup, save_transaction_batch,
 )
 from tkweb.apps.regnskab.rules import (
     get_max_debt, get_max_debt_after_payment, get_default_prices,
 )
 from .auth import regnskab_permission_required_method
-from tkweb.apps.regnskab.utils import sum_matrix
+from tkweb.apps.regnskab.utils import sum_matrix, aggregate_matrix, Aggregate
+from tkweb.apps.regnskab.search import get_search_index
+from tkweb.apps.regnskab import ledger
+from tkweb.apps.regnskab.ledger import get_ledger_page
 
 import tktitler as tk
 
@@ -97,6 +103,7 @@ class SessionCreate(TemplateView):
         session = Session(created_by=self.request.user, period=config.GFYEAR,
                           email_template=email_template)
         session.save()
+        take_balance_snapshot(session.created_time)
         logger.info("%s: Opret ny opgørelse id=%s",
                     self.request.user, session.pk)
         if session.email_template:
@@ -132,8 +139,6 @@ class SheetCreate(FormView):
         return kwargs
 
     def form_valid(self, form):
-        from tkweb.apps.regnskab.images.extract import extract_images
-
         data = form.cleaned_data
         sheet = Sheet(name=data['name'],
                       start_date=data['start_date'],
@@ -148,27 +153,13 @@ class SheetCreate(FormView):
                 position=i + 1,
                 unit_price=kind['unit_price'])
             for i, kind in enumerate(data['kinds'])]
-        if data['image_file']:
-            # extract_images sets sheet.row_image
-            try:
-                images, rows, purchases = extract_images(sheet, kinds)
-            except Exception as exn:
-                if settings.DEBUG and not isinstance(exn, ValidationError):
-                    raise
-                form.add_error(None, exn)
-                return self.form_invalid(form)
-        else:
-            images, rows, purchases = [], [], []
         sheet.save()
-        for o in images + rows:
-            o.sheet = o.sheet  # Update sheet_id
-        for o in images + rows:
-            o.save()
         for o in kinds:
             o.sheets.add(sheet)
-        for o in purchases:
-            o.row = o.row  # Update row_id
-        Purchase.objects.bulk_create(purchases)
+        if data['image_file']:
+            # The extractworker management command runs extract_images
+            # and creates the rows of the sheet.
+            ExtractionJob.objects.create(sheet=sheet)
         logger.info("%s: Opret ny krydsliste id=%s i opgørelse=%s " +
                     "med priser %s",
                     self.request.user, sheet.pk, self.regnskab_session.pk,
@@ -189,7 +180,7 @@ class SheetDelete(TemplateView):
         sheet = self.get_sheet()  # type: Sheet
         session = sheet.session
         assert session is not None
-        sheet.delete()
+        delete_sheet(sheet)
         return redirect('regnskab:session_update', pk=session.pk)
 
     def get_sheet(self):
@@ -211,16 +202,16 @@ class SheetDetail(TemplateView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_template_names(self):
-        if self.get_sheet().legacy_style():
+        if self.sheet.legacy_style():
             return ['regnskab/sheet_legacy.html']
         else:
             return ['regnskab/sheet_detail.html']
 
     def get(self, request, *args, **kwargs):
-        s = self.get_sheet()  # type: Sheet
-        qs = SheetRow.objects.filter(sheet=s)
-        if not qs.exists():
-            return redirect('regnskab:sheet_update', pk=s.pk)
+        self.sheet = self.get_sheet()  # type: Sheet
+        self.grid = SheetGrid(self.sheet)
+        if not self.grid.row_objects:
+            return redirect('regnskab:sheet_update', pk=self.sheet.pk)
         else:
             return super().get(request, *args, **kwargs)
 
@@ -229,7 +220,9 @@ class SheetDetail(TemplateView):
 
     def get_context_data(self, **kwargs):
         context_data = super(SheetDetail, self).get_context_data(**kwargs)
-        sheet = context_data['sheet'] = self.get_sheet()
+        sheet = context_data['sheet'] = self.sheet
+        context_data['columns'] = self.grid.kinds
+        context_data['rows'] = self.grid.rows()
         context_data['sheet_images'] = list(sheet.sheetimage_set.all())
         try:
             context_data['highlight_profile'] = int(
@@ -287,30 +280,29 @@ class SheetRowUpdate(FormView):
         return result
 
     def get_initial_data(self):
-        row_objects = self.sheet.rows()
-        row_data = []
-        for r in row_objects:
-            counts = []
-            for k in r['kinds']:
-                counts.append(float(k.count) if k.id else None)
-
-            row_data.append(dict(
-                profile_id=r['profile'] and r['profile'].id,
-                name=r['name'] or '',
-                counts=counts,
-                image=r['image'],
-            ))
-        return json.dumps(row_data, indent=2)
+        return json.dumps(SheetGrid(self.sheet).editor_data(), indent=2)
+
+    def get_extraction_job(self):
+        try:
+            return self.sheet.extractionjob_set.latest()
+        except ExtractionJob.DoesNotExist:
+            return None
 
     def get_context_data(self, **kwargs):
         context_data = super(SheetRowUpdate, self).get_context_data(**kwargs)
         context_data['sheet'] = self.sheet
+        context_data['extraction_job'] = self.get_extraction_job()
         profiles = self.get_profiles()
         context_data['profiles_json'] = json.dumps(profiles, indent=2)
         context_data['session'] = self.regnskab_session
         return context_data
 
     def clean(self, data_json):
+        def to_count(c):
+            # Round like Purchase.count so that unchanged counts compare
+            # equal to the saved ones.
+            return Decimal(str(c or 0)).quantize(Decimal('0.0001'))
+
         sheet = self.sheet
         kinds = list(sheet.columns())
         try:
@@ -327,6 +319,9 @@ class SheetRowUpdate(FormView):
                 raise ValidationError("Wrong type of counts %s" % (counts,))
             if len(counts) != len(kinds):
                 raise ValidationError("Wrong number of counts %s" % (counts,))
+            for c in counts:
+                if c is not None and not isinstance(c, (int, float)):
+                    raise ValidationError("Invalid count %r" % (c,))
             p_id = row['profile_id']
             if p_id is not None and not isinstance(p_id, int):
                 raise ValidationError("profile_id must be an int")
@@ -345,63 +340,41 @@ class SheetRowUpdate(FormView):
                  position=i + 1,
                  image_start=row['image'] and row['image']['start'],
                  image_stop=row['image'] and row['image']['stop'],
-                 kinds=[Purchase(kind=kind, count=c or 0)
+                 kinds=[Purchase(kind=kind, count=to_count(c))
                         for kind, c in zip(kinds, row['counts'])])
             for i, row in enumerate(row_data)
             if any(c is not None for c in row['counts']) or row['image']
         ]
 
     def save_rows(self, rows):
-        def data(r):
-            return (r['profile'] and r['profile'].id, r['name'], r['position'],
-                    [(p.kind_id, p.count) for p in r['kinds']])
-
         sheet = self.sheet
-        existing = sheet.rows()
-
-        delete = []
-        save = []
+        diff = SheetRowDiff(SheetGrid(sheet), rows)
 
-        for r_new, r_old in zip(rows, existing):
-            if data(r_new) != data(r_old):
-                delete.append(r_old)
-                save.append(r_new)
-        delete.extend(existing[len(rows):])
-        save.extend(rows[len(existing):])
-
-        for row in delete:
+        for row in diff.old_rows():
             logger.info("%s: Slet række %s i krydsliste %s: %r %r %s",
                         self.request.user, row['position'], sheet.pk,
                         row['name'], str(row['profile']),
                         ' '.join('%s=%s' % (c.kind.name, c.count)
                                  for c in row['kinds']))
-
-        save_rows = []
-        save_purchases = []
-        for o in save:
-            save_rows.append(SheetRow(
-                sheet=sheet, profile=o['profile'],
-                name=o['name'], position=o['position'],
-                image_start=o['image_start'], image_stop=o['image_stop'],
-            ))
-            for c in o['kinds']:
-                if c.count:
-                    c.row = save_rows[-1]
-                    save_purchases.append(c)
+        for old, new in diff.moved:
+            logger.info("%s: Flyt række %s til %s i krydsliste %s: %r %r",
+                        self.request.user, old['position'], new['position'],
+                        sheet.pk, new['name'], str(new['profile']))
+        for o in diff.new_rows():
             logger.info("%s: Gem række %s i krydsliste %s: %r %r %s",
                         self.request.user, o['position'], sheet.pk,
                         o['name'], str(o['profile']),
                         ' '.join('%s=%s' % (c.kind.name, c.count)
                                  for c in o['kinds']))
 
-        # print("Create %s, delete %s" % (len(save_rows), len(delete)))
-        delete_ids = set(d['id'] for d in delete if d['id'])
-        SheetRow.objects.filter(id__in=delete_ids).delete()
-        for o in save_rows:
-            o.save()
-        for o in save_purchases:
-            o.row = o.row  # Update o.row_id
-        Purchase.objects.bulk_create(save_purchases)
+        with transaction.atomic():
+            diff.apply()
+            update_balance_snapshots(sheet_row_balance_changes(
+                sheet, diff.old_rows(), diff.new_rows()))
+            update_leaderboard(sheet_row_leaderboard_changes(
+                sheet, diff.old_rows(), diff.new_rows()))
+            update_purchase_rollups([sheet.id])
+        return diff.profile_ids()
 
     def form_valid(self, form):
         try:
@@ -409,12 +382,13 @@ class SheetRowUpdate(FormView):
         except ValidationError as exn:
             form.add_error(None, exn)
             return self.form_invalid(form)
-        self.sheet.start_date = form.cleaned_data['start_date']
-        self.sheet.end_date = form.cleaned_data['end_date']
-        self.sheet.save()
-        self.save_rows(row_objects)
-        if self.regnskab_session.email_template:
-            self.regnskab_session.regenerate_emails()
+        with transaction.atomic():
+            self.sheet.start_date = form.cleaned_data['start_date']
+            self.sheet.end_date = form.cleaned_data['end_date']
+            self.sheet.save()
+            changed_profile_ids = self.save_rows(row_objects)
+        if self.regnskab_session.email_template and changed_profile_ids:
+            self.regnskab_session.regenerate_emails(changed_profile_ids)
         return self.render_to_response(
             self.get_context_data(form=form, saved=True))
 
@@ -513,10 +487,14 @@ class PurchaseStatsTable:
         return transpose
 
     def add_data(self, matrix_columns, row_keys=None):
-        matrix_rows = self.transpose_sparse(matrix_columns)
+        if isinstance(matrix_columns, Aggregate):
+            matrix_rows = matrix_columns.row_dicts()
+            self.empty_columns -= matrix_columns.nonempty_columns()
+        else:
+            matrix_rows = self.transpose_sparse(matrix_columns)
+            self.empty_columns -= matrix_columns.keys()
         if row_keys is None:
             row_keys = {k: k for k in matrix_rows}
-        self.empty_columns -= matrix_columns.keys()
         rows = []
         for dict_key, row_key in sorted(row_keys.items()):
             row = matrix_rows.get(dict_key, {})
@@ -642,11 +620,11 @@ class SessionList(TemplateView):
         except (ValueError, KeyError):
             period = config.GFYEAR
 
-        by_year = sum_matrix(
-            Purchase.objects.all(),
-            'kind__name', 'row__sheet__period', 'count')
-        by_year.update(sum_matrix(
-            Transaction.objects.all(), 'kind', 'period', 'amount'))
+        by_year = aggregate_matrix([
+            (PurchaseRollup.objects.all(),
+             'kind_name', 'sheet__period', 'count'),
+            (TransactionRollup.objects.all(), 'kind', 'period', 'amount'),
+        ], places=4)
         period_table = PurchaseStatsTable(self.request)
         period_table.columns_before = (('period', 'Årgang', 'key'),)
         period_table.sortable(self.request.GET, 'y')
@@ -654,23 +632,23 @@ class SessionList(TemplateView):
             r['period'] = format_html(
                 '<a href="?year={0}">{0}</a>', r['key'])
 
-        purchases_by_session_qs = Purchase.objects.filter(
-            row__sheet__session__period=period)
+        purchases_by_session_qs = PurchaseRollup.objects.filter(
+            sheet__session__period=period)
         by_session = sum_matrix(
             purchases_by_session_qs,
-            'kind__name', 'row__sheet__session_id', 'count')
-        purchases_by_sheet_qs = Purchase.objects.filter(
-            row__sheet__session=None,
-            row__sheet__period=period)
+            'kind_name', 'sheet__session_id', 'count')
+        purchases_by_sheet_qs = PurchaseRollup.objects.filter(
+            sheet__session=None,
+            sheet__period=period)
         by_sheet = sum_matrix(
             purchases_by_sheet_qs,
-            'kind__name', 'row__sheet_id', 'count')
+            'kind_name', 'sheet_id', 'count')
 
-        transactions_by_session_qs = Transaction.objects.filter(
+        transactions_by_session_qs = TransactionRollup.objects.filter(
             session__period=period)
         by_session.update(sum_matrix(
             transactions_by_session_qs, 'kind', 'session_id', 'amount'))
-        transactions_by_sheet_qs = Transaction.objects.filter(
+        transactions_by_sheet_qs = TransactionRollup.objects.filter(
             session=None, period=period)
         by_sheet_time = sum_matrix(
             transactions_by_sheet_qs, 'kind', 'time', 'amount')
@@ -844,8 +822,7 @@ class ProfileList(TemplateView):
         else:
             purchases_after = None
         profiles = get_profiles_title_status()
-        for i, p in enumerate(profiles):
-            p.table_position = i
+        positions = {p.id: i for i, p in enumerate(profiles)}
         profile_dict = {p.id: p for p in profiles}
 
         balances, purchases = compute_balance(
@@ -865,7 +842,7 @@ class ProfileList(TemplateView):
                 p.title_name)
             row['status'] = p.status.since() if p.status else ''
             row['balance'] = balances.get(p.id)
-            row['position'] = p.table_position
+            row['position'] = positions[p.id]
         context_data['table'] = table
         return context_data
 
@@ -989,75 +966,53 @@ class ProfileDetail(TemplateView):
     def post_error(self, msg):
         return self.render_to_response(self.get_context_data(error=msg))
 
-    def get_sheets(self):
-        qs = Purchase.objects.all()
-        qs = qs.filter(row__profile=self.profile)
-        qs = qs.annotate(
-            amount=F('kind__unit_price') * F('count'))
-        qs = qs.annotate(date=F('row__sheet__end_date'))
-        qs = qs.annotate(sheet=F('row__sheet_id'))
-        qs = qs.annotate(session=F('row__sheet__session_id'))
-        qs = qs.values(
-            'sheet', 'date', 'count', 'kind__name', 'amount',
-            'session')
-        qs = qs.order_by('date', 'sheet')
-        groups = itertools.groupby(qs, key=lambda o: o['sheet'])
-        result = []
-        session_start = {}
-        for sheet_id, xs in groups:
-            xs = list(xs)
-            href = (
-                '%s?highlight_profile=%s' %
-                (reverse('regnskab:sheet_detail', kwargs=dict(pk=sheet_id)),
-                 self.profile.id))
-            session, = set(x['session'] for x in xs)
-            date, = set(x['date'] for x in xs)
-            if session:
-                session_start.setdefault(session, date)
-            assert all(x['amount'] is not None for x in xs)
-            amount = sum(x['amount'] for x in xs)
-            name = ', '.join(
-                '%s× %s' % (floatformat(o['count']), o['kind__name'])
-                for o in xs
-            )
-            result.append((date, href, amount, name))
-        return result, session_start
-
-    def get_transactions(self, session_start):
-        qs = Transaction.objects.all()
-        qs = qs.filter(profile=self.profile)
-        qs = qs.values_list('kind', 'time', 'note', 'amount', 'session_id')
-        for kind, time, note, amount, session in qs:
-            name = Transaction(kind=kind, note=note).get_kind_display()
+    def get_rows(self):
+        entries, has_older = get_ledger_page(
+            self.profile.id, self.request.GET.get('before'))
+        sheet_ids = [o.ref_id for o in entries if o.order == ledger.SHEET]
+        transaction_ids = [o.ref_id for o in entries
+                           if o.order == ledger.TRANSACTION]
+        purchases = {}
+        if sheet_ids:
+            qs = Purchase.objects.filter(row__profile=self.profile,
+                                         row__sheet_id__in=sheet_ids)
+            qs = qs.order_by('row__sheet_id', 'row_id', 'kind__position')
+            qs = qs.values_list('row__sheet_id', 'count', 'kind__name')
+            for sheet_id, count, kind_name in qs:
+                purchases.setdefault(sheet_id, []).append(
+                    '%s× %s' % (floatformat(count), kind_name))
+        transactions = {}
+        if transaction_ids:
+            qs = Transaction.objects.filter(id__in=transaction_ids)
+            for pk, kind, note in qs.values_list('id', 'kind', 'note'):
+                transactions[pk] = Transaction(
+                    kind=kind, note=note).get_kind_display()
+
+        rows = []
+        for o in entries:
             href = None
-            if kind == Transaction.PAYMENT:
-                date = session_start.get(session, time.date())
+            if o.order == ledger.SHEET:
+                href = '%s?highlight_profile=%s' % (
+                    reverse('regnskab:sheet_detail', kwargs=dict(pk=o.ref_id)),
+                    self.profile.id)
+                name = ', '.join(purchases.get(o.ref_id, ()))
+            elif o.order == ledger.TRANSACTION:
+                name = transactions[o.ref_id]
             else:
-                date = time.date()
-            yield date, href, amount, name
-
-    def get_emails(self):
-        qs = Email.objects.all()
-        qs = qs.filter(profile=self.profile)
-        qs = qs.exclude(session__send_time=None)
-        qs = qs.annotate(time=F('session__send_time'))
-        qs = qs.values('session_id', 'time')
-        emails = list(qs)
-        for o in emails:
-            href = reverse('regnskab:email_detail',
-                           kwargs=dict(pk=o['session_id'],
-                                       profile=self.profile.id))
-            amount = None
-            date = o['time'].date()
-            name = 'Email'
-            yield date, href, amount, name
-
-    def get_rows(self):
-        sheets, session_start = self.get_sheets()
-        transactions = list(self.get_transactions(session_start))
-        emails = list(self.get_emails())
+                href = reverse('regnskab:email_detail',
+                               kwargs=dict(pk=o.session_id,
+                                           profile=self.profile.id))
+                name = 'Email'
+            amount = '' if o.amount is None else floatformat(o.amount, 2)
+            rows.append(dict(
+                date=o.date,
+                href=href,
+                name=name,
+                amount=amount,
+                balance=floatformat(o.balance, 2),
+            ))
         # TODO: List SheetStatus, Alias, Title
-        return sorted(transactions + sheets + emails, key=lambda x: x[0])
+        return rows, entries[-1].key if has_older else None
 
     @tk.set_gfyear(lambda: config.GFYEAR)
     def get_names(self):
@@ -1109,20 +1064,7 @@ class ProfileDetail(TemplateView):
         context_data['profile'] = self.profile
         context_data['sheetstatus'] = self.sheetstatus
 
-        rows = []
-        balance = Decimal()
-        for date, href, amount, name in self.get_rows():
-            if amount is not None:
-                balance += amount
-            rows.append(dict(
-                date=date,
-                href=href,
-                name=name,
-                amount=floatformat(amount, 2) if amount is not None else '',
-                balance=floatformat(balance, 2),
-            ))
-
-        context_data['rows'] = rows
+        context_data['rows'], context_data['older'] = self.get_rows()
         context_data['names'] = self.get_names()
         alias_key, alias_value = self.get_alias_data()
         context_data[alias_key] = alias_value
@@ -1136,64 +1078,15 @@ class ProfileSearch(TemplateView):
     def dispatch(self, request, *args, **kwargs):
         return super().dispatch(request, *args, **kwargs)
 
-    @tk.set_gfyear(lambda: config.GFYEAR)
     def get_results(self, q, only_current):
         if not q:
             return
 
-        results = []
-
-        matcher = difflib.SequenceMatcher()
-        matcher.set_seq2(q.lower())
-        alias_qs = Alias.objects.all()
-        if only_current:
-            alias_qs = alias_qs.filter(end_time=None)
-            alias_qs = alias_qs.exclude(profile__sheetstatus=None)
-            alias_qs = alias_qs.filter(profile__sheetstatus__end_time=None)
-        for o in alias_qs:
-            input_title = tk.prefix(o) if o.period else o.root
-            if input_title.lower() == q.lower():
-                sort_key = (4, o.profile_id)
-            else:
-                matcher.set_seq1(input_title.lower())
-                sort_key = (0, matcher.ratio(), input_title, o.pk)
-            value = (input_title, o.profile)
-            results.append((sort_key, value))
-
-        title_qs = Title.objects.all()
-        if only_current:
-            title_qs = title_qs.exclude(profile__sheetstatus=None)
-            title_qs = title_qs.filter(profile__sheetstatus__end_time=None)
-        for o in title_qs:
-            input_title = tk.prefix(o) if o.period else o.root
-            if q.upper().replace('$', 'S') == input_title.replace('$', 'S'):
-                sort_key = (4, o.profile_id)
-                value = (input_title, o.profile)
-                results.append((sort_key, value))
-            elif o.kind == Title.FU and q.upper() == o.root != 'FUAN':
-                sort_key = (3, o.profile_id)
-                value = (input_title, o.profile)
-                results.append((sort_key, value))
-
-        profile_qs = Profile.objects.all()
-        if only_current:
-            profile_qs = profile_qs.exclude(sheetstatus=None)
-            profile_qs = profile_qs.filter(sheetstatus__end_time=None)
-        for o in profile_qs:
-            if q.lower() in o.name.lower().split():
-                sort_key = (3, o.name, o.pk)
-            elif q.lower() in o.name.lower():
-                sort_key = (2, o.name, o.pk)
-            else:
-                matcher.set_seq1(o.name.lower())
-                sort_key = (0, matcher.ratio(), o.name, o.pk)
-            value = (o.name, o)
-            results.append((sort_key, value))
-
-        results.sort(reverse=True)
-        results = results[:50]
-        results = [value for sort_key, value in results]
-        return results
+        index = get_search_index(config.GFYEAR)
+        results = index.search(q, only_current)
+        profiles = Profile.objects.in_bulk({p_id for t, p_id in results})
+        return [(input_title, profiles[p_id])
+                for input_title, p_id in results if p_id in profiles]
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
@@ -1251,47 +1144,15 @@ class TransactionBatchCreateBase(FormView):
         return ''
 
     def form_valid(self, form):
-        existing_qs = self.get_existing()
-        existing = {o.profile_id: o for o in existing_qs}
-
-        save = []
-        new = []
-        delete = []
-
-        now = timezone.now()
-        for profile, amount, selected in form.profile_data():
-            if selected:
-                o = Transaction(
-                    period=self.regnskab_session.period,
-                    kind=self.get_transaction_kind(),
-                    profile=profile, time=now, amount=self.sign * amount,
-                    created_by=self.request.user, created_time=now,
-                    note=self.get_note(),
-                    session=self.regnskab_session)
-                logger.info("%s: Sæt %r for %s i opgørelse %s til %s",
-                            self.request.user, o.get_kind_display(),
-                            profile, self.regnskab_session.pk,
-                            o.amount)
-                if profile.id in existing:
-                    o.id = existing[profile.id].id
-                    save.append(o)
-                else:
-                    new.append(o)
-            elif profile.id in existing:
-                e = existing[profile.id]
-                logger.info("%s: Fjern %r for %s i opgørelse %s",
-                            self.request.user, e.get_kind_display(),
-                            profile, self.regnskab_session.pk)
-                delete.append(e)
-
-        Transaction.objects.bulk_create(new)
-        for o in save:
-            o.save()
-        delete_ids = [o.id for o in delete]
-        Transaction.objects.filter(id__in=delete_ids).delete()
-
-        if self.regnskab_session.email_template:
-            self.regnskab_session.regenerate_emails()
+        existing = {o.profile_id: o for o in self.get_existing()}
+        amounts = {profile.id: self.sign * amount
+                   for profile, amount, selected in form.profile_data()
+                   if selected}
+        changed_profile_ids = save_transaction_batch(
+            self.regnskab_session, self.get_transaction_kind(), amounts,
+            existing, self.request.user, note=self.get_note())
+        if self.regnskab_session.email_template and changed_profile_ids:
+            self.regnskab_session.regenerate_emails(changed_profile_ids)
         return self.get_success_view()
 
     def get_period(self):
@@ -1457,20 +1318,18 @@ class PaymentPurchaseList(TemplateView):
             payments[p_id] = payments.get(p_id, Decimal()) - amount
         # payments[p_id] is the sum of payment amounts
 
+        # profile_sheets[p_id][sheet_id][row_id][kind name] is the count
         profile_sheets = {}
         purchase_qs = Purchase.objects.filter(
             row__sheet__session=self.regnskab_session)
-        purchase_qs = purchase_qs.annotate(
-            amount=F('kind__unit_price') * F('count'))
-        purchase_qs = purchase_qs.annotate(
-            profile_id=F('row__profile_id'))
-        purchase_qs = purchase_qs.annotate(
-            sheet_id=F('row__sheet_id'))
-
-        for o in purchase_qs:
-            p_id = o.profile_id
-            x = profile_sheets.setdefault(p_id, {})
-            x.setdefault(o.sheet_id, []).append(o)
+        purchase_qs = purchase_qs.order_by(
+            'row__sheet__start_date', 'row__sheet_id', 'row_id')
+        purchase_qs = purchase_qs.values_list(
+            'row__profile_id', 'row__sheet_id', 'row_id', 'kind__name')
+        purchase_qs = purchase_qs.annotate(Sum('count'))
+        for p_id, s_id, row_id, name, count in purchase_qs:
+            x = profile_sheets.setdefault(p_id, {}).setdefault(s_id, {})
+            x.setdefault(row_id, {})[name] = count
 
         profile_ids = set(payments.keys()) | set(profile_sheets.keys())
         initial_balances = compute_balance(
@@ -1481,50 +1340,47 @@ class PaymentPurchaseList(TemplateView):
                         for s_id in sheets.keys())
         sheets = {o.id: o for o in Sheet.objects.filter(id__in=sheet_ids)}
 
+        max_debt = context_data['max_debt']
+        max_debt_paid = context_data['max_debt_paid']
         profiles = get_profiles_title_status()
         rows = []
         for p in profiles:
-            p.b0 = initial_balances.get(p.id, Decimal())
-            p.b1 = p.b0 - payments.get(p.id, Decimal())
-            p.sheets = []
-            for s_id, purchases in profile_sheets.get(p.id, {}).items():
-                purchases_str = self.describe_purchases(purchases)
-                n_rows = len(set(p.row_id for p in purchases))
-                p.sheets.append(
-                    (sheets[s_id], purchases_str, n_rows, n_rows > 1))
-            if not p.sheets:
+            p_sheets = [
+                (sheets[s_id], self.describe_purchases(sheet_rows),
+                 len(sheet_rows), len(sheet_rows) > 1)
+                for s_id, sheet_rows in profile_sheets.get(p.id, {}).items()]
+            if not p_sheets:
                 continue
-
-            max_debt = get_max_debt()
-            max_debt_paid = get_max_debt_after_payment()
-
-            p.warn = max_debt < p.b0 and max_debt_paid < p.b1 and p.sheets
-            rows.append(p)
+            b0 = initial_balances.get(p.id, Decimal())
+            b1 = b0 - payments.get(p.id, Decimal())
+            rows.append(dict(
+                pk=p.pk, title_name=p.title_name, status=p.status,
+                b0=b0, b1=b1, sheets=p_sheets,
+                warn=max_debt < b0 and max_debt_paid < b1))
 
         context_data['object_list'] = rows
         return context_data
 
     @staticmethod
-    def describe_purchases(purchases):
-        sheet_rows = set(p.row_id for p in purchases)
+    def describe_purchases(sheet_rows):
+        '''
+        Describe the purchases of each row in sheet_rows, a dict mapping
+        row id to a dict mapping kind name to count.
+        '''
+        order = ['øl', 'guldøl', 'sodavand']
         result = []
-        for i in sorted(sheet_rows):
+        for row_id in sorted(sheet_rows):
             single = {}
             kasse = {}
-            for p in purchases:
-                if p.row_id != i:
-                    continue
-                if p.kind.name.endswith('kasse'):
-                    kind = p.kind.name[:-5]
-                    kasse[kind] = kasse.get(kind, Decimal()) + p.count
+            for name, count in sheet_rows[row_id].items():
+                if name.endswith('kasse'):
+                    kasse[name[:-5]] = count
                 else:
-                    kind = p.kind.name
-                    single[kind] = single.get(kind, Decimal()) + p.count
-            order = ['øl', 'guldøl', 'sodavand']
+                    single[name] = count
             x = []
             for k in order:
-                s = single.pop(k, 0)
-                k = kasse.pop(k, None)
+                s = single.get(k, 0)
+                k = kasse.get(k)
                 x.append('%g' % s if k is None else '%g+%gks' % (s, k))
             result.append('(%s)' % ', '.join(x))
         return ' '.join(result)
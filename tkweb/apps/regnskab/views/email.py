@@ -1,7 +1,6 @@
 import logging
 import itertools
 
-import django.core.mail
 from django.core.exceptions import ValidationError
 from django.http import Http404
 from django.utils import timezone
@@ -15,9 +14,13 @@ from tkweb.apps.regnskab.models import (
     EmailTemplate, Email,
     Profile, Session,
     get_profiles_title_status, config,
-    Newsletter, NewsletterEmail,
+    Newsletter, NewsletterEmail, take_balance_snapshot,
+)
+from tkweb.apps.regnskab.images.utils import png_data_uri
+from tkweb.apps.regnskab.emailsend import send_emails
+from tkweb.apps.regnskab.images.attachments import (
+    build_row_images, preview_row_image, row_image_png,
 )
-from tkweb.apps.regnskab.images.utils import save_png, png_data_uri
 
 from .auth import regnskab_permission_required_method
 
@@ -120,6 +123,7 @@ class NewsletterCreate(FormView):
             period=config.GFYEAR,
             created_by=self.request.user)
         newsletter.save()
+        take_balance_snapshot(newsletter.created_time)
         try:
             template.clean()
             newsletter.regenerate_emails()
@@ -180,19 +184,20 @@ class EmailListBase(TemplateView):
         profile_list = get_profiles_title_status(period=period, time=time)
         order = {p.id: i for i, p in enumerate(profile_list)}
         profiles = {p.id: p for p in profile_list}
-        emails = list(self.object.email_set.all())
+        emails = list(self.object.email_set.select_related('profile'))
         emails.sort(key=lambda o: order.get(o.profile_id, 0))
         for o in emails:
             try:
-                o.profile = profiles[o.profile_id]
+                o.title_name = profiles[o.profile_id].title_name
             except KeyError:
-                pass
-            o.title_name = getattr(o.profile, 'title_name', o.profile.name)
+                o.title_name = o.profile.name
         return emails
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
-        context_data['object_list'] = self.get_emails()
+        emails = self.get_emails()
+        context_data['object_list'] = emails
+        context_data['sent_count'] = sum(1 for o in emails if o.send_time)
         return context_data
 
 
@@ -226,51 +231,6 @@ class NewsletterEmailList(EmailListBase):
         return context_data
 
 
-def get_image_for_emails(emails):
-    import numpy as np
-    import imageio
-
-    assert all(isinstance(email, Email) for email in emails)
-    if not emails:
-        return []
-
-    session = emails[0].session
-    assert all(email.session == session for email in emails)
-    assert all(email.profile_id for email in emails)
-    sheets = session.sheet_set.exclude(row_image=None)
-    sheets = sheets.prefetch_related('sheetrow_set')
-    rows_by_profile = {email.profile_id: [] for email in emails}
-    for sheet in sheets:
-        if not sheet.row_image:
-            continue
-        row_image = np.asarray(imageio.imread(sheet.row_image))
-        for row in sheet.sheetrow_set.all():
-            try:
-                p = rows_by_profile[row.profile_id]
-            except KeyError:
-                continue
-            p.append(row_image[row.image_start:row.image_stop])
-    for email in emails:
-        images = rows_by_profile.pop(email.profile_id)
-        if not images:
-            yield None
-            continue
-        image_width = max(image.shape[1] for image in images)
-        for i, image in enumerate(images):
-            if image.shape[1] < image_width:
-                images[i] = np.pad(
-                    image,
-                    [(0, 0), (0, image_width - image.shape[1])],
-                    'maximum')
-        images_concat = np.concatenate(images)
-        yield images_concat
-
-
-def get_image_for_email(email):
-    result, = get_image_for_emails([email])
-    return result
-
-
 class EmailDetail(DetailView):
     template_name = 'regnskab/email_detail.html'
 
@@ -290,16 +250,15 @@ class EmailDetail(DetailView):
         return context_data
 
     def get_images(self):
-        together = get_image_for_email(self.get_object())
-        if together is not None:
-            png_data = save_png(together)
+        png_data = preview_row_image(self.regnskab_session, self.object)
+        if png_data is not None:
             return png_data_uri(png_data)
 
     def get_object(self):
         return get_object_or_404(
             Email.objects,
             session_id=self.kwargs['pk'],
-            profile_id=self.kwargs['profile'])
+            profile_id=self.kwargs['profile']).render()
 
 
 class NewsletterEmailDetail(DetailView):
@@ -322,7 +281,7 @@ class NewsletterEmailDetail(DetailView):
         return get_object_or_404(
             NewsletterEmail,
             newsletter_id=self.kwargs['pk'],
-            profile_id=self.kwargs['profile'])
+            profile_id=self.kwargs['profile']).render()
 
 
 class EmailSend(View):
@@ -342,17 +301,21 @@ class EmailSend(View):
         if not emails:
             raise Http404()
 
-        messages = [e.to_message() for e in emails]
-        for message, image in zip(messages, get_image_for_emails(emails)):
-            if image is not None:
-                png_data = save_png(image)
-                message.attach('krydser.png', png_data, 'image/png')
-        override_recipient = (len(messages) == 1 and
+        override_recipient = (len(emails) == 1 and
                               self.request.POST.get('override_recipient'))
-        if override_recipient:
-            for m in messages:
-                m.to = [override_recipient]
-        email_backend = django.core.mail.get_connection()
+        if profile is None:
+            # Resume where an interrupted send stopped.
+            emails = [e for e in emails if e.send_time is None]
+
+        # Decode the row images of the session once for the whole send.
+        build_row_images(regnskab_session, emails)
+
+        def attach_row_images(batch, messages):
+            for message, email in zip(messages, batch):
+                png_data = row_image_png(email)
+                if png_data is not None:
+                    message.attach('krydser.png', png_data, 'image/png')
+
         if profile:
             logger.info("%s: Send email for %s i opgørelse %s til %s",
                         self.request.user, p, regnskab_session.pk,
@@ -360,9 +323,9 @@ class EmailSend(View):
         else:
             logger.info("%s: Send emails i opgørelse %s",
                         self.request.user, regnskab_session.pk)
-        email_backend.send_messages(messages)
+        send_emails(emails, override_recipient, attach_row_images)
         if override_recipient:
-            return redirect('regnskab:email_list', pk=emails[0].session_id)
+            return redirect('regnskab:email_list', pk=regnskab_session.pk)
         else:
             regnskab_session.send_time = timezone.now()
             regnskab_session.save()
@@ -387,13 +350,11 @@ class NewsletterEmailSend(View):
         if not emails:
             raise Http404()
 
-        messages = [e.to_message() for e in emails]
-        override_recipient = (len(messages) == 1 and
+        override_recipient = (len(emails) == 1 and
                               self.request.POST.get('override_recipient'))
-        if override_recipient:
-            for m in messages:
-                m.to = [override_recipient]
-        email_backend = django.core.mail.get_connection()
+        if profile is None:
+            # Resume where an interrupted send stopped.
+            emails = [e for e in emails if e.send_time is None]
         if profile:
             logger.info("%s: Send email for %s i nyhedsbrev %s til %s",
                         self.request.user, p, newsletter.pk,
@@ -401,7 +362,7 @@ class NewsletterEmailSend(View):
         else:
             logger.info("%s: Send emails i nyhedsbrev %s",
                         self.request.user, newsletter.pk)
-        email_backend.send_messages(messages)
+        send_emails(emails, override_recipient)
         if not override_recipient:
             newsletter.send_time = timezone.now()
             newsletter.save()
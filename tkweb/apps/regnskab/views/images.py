@@ -10,13 +10,13 @@ from django.views.generic import (
 )
 from django.shortcuts import get_object_or_404
 from django.utils.html import format_html, format_html_join
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 
-from tkweb.apps.regnskab.models import SheetImage, Purchase
-from .auth import regnskab_permission_required_method
-from tkweb.apps.regnskab.images.quadrilateral import (
-    Quadrilateral, extract_quadrilateral,
+from tkweb.apps.regnskab.models import (
+    Sheet, SheetImage, ExtractionJob, replace_sheet_rows,
 )
+from .auth import regnskab_permission_required_method
+from tkweb.apps.regnskab.images.quadrilateral import Quadrilateral
 from tkweb.apps.regnskab.images.forms import (
     SheetImageCrossesForm, SheetImageParametersForm,
 )
@@ -53,6 +53,26 @@ class SheetImageList(TemplateView):
         return context_data
 
 
+class SheetExtractionProgress(View):
+    '''
+    Polled by sheet_update.html while an ExtractionJob is running.
+    '''
+
+    @regnskab_permission_required_method
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, pk):
+        sheet = get_object_or_404(Sheet.objects, pk=pk)
+        try:
+            job = sheet.extractionjob_set.latest()
+        except ExtractionJob.DoesNotExist:
+            return JsonResponse(dict(state=None, error='', pages=[]))
+        pages = sheet.sheetimage_set.order_by('page').values('page', 'state')
+        return JsonResponse(dict(state=job.state, error=job.error,
+                                 pages=list(pages)))
+
+
 class SheetImageMixin:
     def get_sheet_image(self):
         return get_object_or_404(
@@ -67,11 +87,12 @@ class SheetImageFile(View, SheetImageMixin):
 
     def get(self, request, **kwargs):
         sheet_image = self.get_sheet_image()
-        im_data = sheet_image.get_image()
         if self.kwargs.get('projected'):
-            quad = Quadrilateral(sheet_image.quad)
-            im_data = extract_quadrilateral(im_data, quad)
-        im_data = (255 * im_data).astype(np.uint8)
+            im_data = sheet_image.get_projected_image()
+        else:
+            im_data = sheet_image.get_image()
+        if im_data.dtype != np.uint8:
+            im_data = (255 * im_data).astype(np.uint8)
         img = PIL.Image.fromarray(im_data)
         output = io.BytesIO()
         img.save(output, 'PNG')
@@ -163,12 +184,7 @@ class SheetImageParameters(FormView, SheetImageMixin):
         sheet_image.set_verified(False)
         sheet_image.save()  # Save computed values
         if form.cleaned_data['reset']:
-            sheet.sheetrow_set.all().delete()
-            for o in rows:
-                o.save()
-            for o in purchases:
-                o.row = o.row  # Update row_id
-            Purchase.objects.bulk_create(purchases)
+            replace_sheet_rows(sheet, rows, purchases)
         return self.render_to_response(
             self.get_context_data(form=form, saved=True))
 
@@ -11,8 +11,9 @@ from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse, HttpResponseRedirect
 from django.conf import settings
-from django.db.models import F, Min
-from django.utils import timezone
+from django.db.models import Min, Sum
+from django.utils import timezone, translation
+from django.utils.formats import date_format
 from django.shortcuts import get_object_or_404
 from django.views.generic import FormView
 
@@ -54,7 +55,7 @@ BALANCE_PRINT_TEX = r"""
 \checkandfixthelayout
 \pagestyle{empty}
 \begin{document}
-\strut \hfill \today\\[2mm]
+\strut \hfill %(today)s\\[2mm]
 \definecolor{pink}{rgb}{1,0.80,0.88}
 \renewcommand{\hl}{\cellcolor{pink}}
 
@@ -98,6 +99,15 @@ def title_to_tex(s):
     return re.sub(pattern, repl, s)
 
 
+def profile_tex_alias(p, period):
+    '''The title of p (from get_profiles_title_status) in TeX, or the name.'''
+    if not p.title:
+        return p.name
+    if p.title.period is None:
+        return title_to_tex(p.title.root)
+    return tk.prefix(p.title, period, type='tex')
+
+
 class BalancePrint(FormView):
     form_class = BalancePrintForm
     template_name = 'regnskab/balance_print_form.html'
@@ -109,31 +119,22 @@ class BalancePrint(FormView):
         return super().dispatch(request, *args, **kwargs)
 
     @staticmethod
-    def get_tex_context_data(
-        period=None, time=None, current_session_id=None, threshold=None
-    ):
-        if threshold is None:
-            threshold = float('inf')
-        if period is None:
-            period = config.GFYEAR
-        if time is None:
-            time = timezone.now()
-
-        purchase_qs = Purchase.objects.all().order_by().filter(
-            row__sheet__period=period)
-        purchase_qs = purchase_qs.annotate(
-            name=F('kind__name'),
-            sheet_id=F('row__sheet_id'),
-            profile_id=F('row__profile_id'),
-            session_id=F('row__sheet__session_id'))
-        purchase_qs = purchase_qs.values_list(
-            'sheet_id', 'name', 'profile_id', 'session_id', 'count')
-
-        kinds = {
-            (sheet_id, o.name): o.unit_price
-            for o in PurchaseKind.objects.all()
-            for sheet_id in o.sheets.all().values_list('id', flat=True)
-        }
+    def get_tex_counts(period, current_session_id=None):
+        '''
+        Return (prices, counts, cur_counts) where counts and cur_counts
+        map (profile_id, name) to the total and the current session
+        count of each kind name (with box kinds converted to ølkasse by
+        price) and to the 'betalt' and 'andet' amounts since the start
+        of the period.
+
+        Purchases and transactions are summed by the database, grouped
+        by profile, sheet/session and kind, so only the box conversion
+        is done here.
+        '''
+        sheet_kinds = PurchaseKind.sheets.through.objects.values_list(
+            'sheet_id', 'purchasekind__name', 'purchasekind__unit_price')
+        kinds = {(sheet_id, name): unit_price
+                 for sheet_id, name, unit_price in sheet_kinds}
 
         kind_last_sheet = {}
         for sheet_id, name in kinds.keys():
@@ -148,7 +149,18 @@ class BalancePrint(FormView):
         counts = defaultdict(Decimal)
         cur_counts = defaultdict(Decimal)
 
-        for sheet_id, name, profile_id, session_id, count in purchase_qs:
+        def add(profile_id, name, session_id, count):
+            counts[profile_id, name] += count
+            if session_id == current_session_id:
+                cur_counts[profile_id, name] += count
+
+        purchase_qs = Purchase.objects.order_by().filter(
+            row__sheet__period=period)
+        purchase_qs = purchase_qs.values_list(
+            'row__profile_id', 'row__sheet_id', 'row__sheet__session_id',
+            'kind__name')
+        purchase_qs = purchase_qs.annotate(count_sum=Sum('count'))
+        for profile_id, sheet_id, session_id, name, count in purchase_qs:
             if name in ('guldølkasse', 'sodavandkasse'):
                 real_name = 'ølkasse'
                 real_count = count * (kinds[sheet_id, name] /
@@ -158,26 +170,37 @@ class BalancePrint(FormView):
                 real_count = count
             else:
                 real_name, real_count = name, count
-            counts[profile_id, real_name] += real_count
-            if session_id == current_session_id:
-                cur_counts[profile_id, real_name] += real_count
+            add(profile_id, real_name, session_id, real_count)
 
-        transaction_qs = Transaction.objects.all()
         period_start_date, = (
             Sheet.objects.filter(period=period).aggregate(Min('start_date')).values())
         period_start_time = timezone.get_current_timezone().localize(
             datetime.datetime.combine(period_start_date, datetime.time()))
-        transaction_qs = transaction_qs.filter(time__gte=period_start_time)
-        for o in transaction_qs:
-            if o.kind == Transaction.PAYMENT:
-                real_name = 'betalt'
-                amount = -o.amount
+        transaction_qs = Transaction.objects.order_by().filter(
+            time__gte=period_start_time)
+        transaction_qs = transaction_qs.values_list(
+            'profile_id', 'session_id', 'kind')
+        transaction_qs = transaction_qs.annotate(amount_sum=Sum('amount'))
+        for profile_id, session_id, kind, amount in transaction_qs:
+            if kind == Transaction.PAYMENT:
+                add(profile_id, 'betalt', session_id, -amount)
             else:
-                real_name = 'andet'
-                amount = o.amount
-            counts[o.profile_id, real_name] += amount
-            if o.session_id == current_session_id:
-                cur_counts[o.profile_id, real_name] += amount
+                add(profile_id, 'andet', session_id, amount)
+        return prices, counts, cur_counts
+
+    @staticmethod
+    def get_tex_context_data(
+        period=None, time=None, current_session_id=None, threshold=None
+    ):
+        if threshold is None:
+            threshold = float('inf')
+        if period is None:
+            period = config.GFYEAR
+        if time is None:
+            time = timezone.now()
+
+        prices, counts, cur_counts = BalancePrint.get_tex_counts(
+            period, current_session_id)
 
         context = {}
         for name, unit_price in prices.items():
@@ -199,15 +222,11 @@ class BalancePrint(FormView):
             p_context = {}
             p_context['balance'] = balances.get(p.id, 0)
             context['total_balance'] += p_context['balance']
+            p_context['alias'] = profile_tex_alias(p, period)
             if p.title:
-                if p.title.period is None:
-                    title_str = title_to_tex(p.title.root)
-                else:
-                    title_str = tk.prefix(p.title, period, type='tex')
-                p_context['alias'] = title_str
-                p_context['name'] = '%s %s' % (title_str, p.name)
+                p_context['name'] = '%s %s' % (p_context['alias'], p.name)
             else:
-                p_context['alias'] = p_context['name'] = p.name
+                p_context['name'] = p.name
             p_context['last'] = {
                 k: cur_counts.get((p.id, k), 0) for k in keys
             }
@@ -243,6 +262,9 @@ class BalancePrint(FormView):
             rows.append(BALANCE_ROW % p_context)
 
         context['personer'] = '\n'.join(rows)
+        # Not \today, since the PDF is cached by the hash of the source.
+        with translation.override('da'):
+            context['today'] = date_format(timezone.localdate(), 'j. F Y')
 
         tex_source = BALANCE_PRINT_TEX % context
 
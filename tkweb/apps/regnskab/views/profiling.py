@@ -0,0 +1,23 @@
+from django.contrib.auth.decorators import user_passes_test
+from django.utils.decorators import method_decorator
+from django.views.generic import TemplateView
+from django.conf import settings
+
+from tkweb.apps.regnskab.profiling import get_report
+
+
+class ProfilingReport(TemplateView):
+    template_name = 'regnskab/profiling_report.html'
+
+    @method_decorator(user_passes_test(lambda u: u.is_superuser))
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        recent, summary = get_report()
+        context_data['enabled'] = getattr(settings, 'REGNSKAB_PROFILING',
+                                          False)
+        context_data['summary'] = summary
+        context_data['recent'] = recent
+        return context_data
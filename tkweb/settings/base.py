@@ -189,6 +189,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'tkweb.apps.regnskab.profiling.ProfilingMiddleware',
 ]
 
 # Clickjacking middleware
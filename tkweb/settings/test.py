@@ -1,3 +1,5 @@
+import tempfile
+
 from tkweb.settings.base import *
 
 SECRET_KEY = 'This.is.not.a.secret.key'
@@ -12,6 +14,9 @@ DATABASES = {
     }
 }
 
+# Uploaded files are written outside the working tree
+MEDIA_ROOT = tempfile.mkdtemp(prefix='tkweb-test-media-')
+
 # TEST_RUNNER = 'rainbowtests.test.runner.RainbowDiscoverRunner' # Fancy colors
 
 RAINBOWTESTS_SHOW_MESSAGES = False